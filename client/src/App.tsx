@@ -81,10 +81,39 @@ const App: React.FC = () => {
 
   useEffect(() => {
     loadKnowledgeBase();
-    loadLogs();
     loadKBFiles();
+    // 先拉一次历史日志，之后由 /logs/stream 推送新日志（断线重连时浏览器自动带 Last-Event-ID 续传）
+    let source: EventSource | null = null;
+    let closed = false;
+    loadLogs().then(lastId => {
+      if (closed) return;
+      source = new EventSource(`http://localhost:8000/logs/stream?last_id=${lastId}`);
+      source.addEventListener('log', (e) => {
+        const log = JSON.parse((e as MessageEvent).data);
+        upsertTrace({
+          key: log.id,
+          index: 1,
+          input: log.user_input,
+          tokens: log.total_tokens || 0,
+          latency: `${((log.latency_ms || 0) / 1000).toFixed(1)}s`,
+          trace: { ...log, token_usage: { total_tokens: log.total_tokens } },
+        });
+      });
+    });
+    return () => {
+      closed = true;
+      source?.close();
+    };
   }, []);
 
+  // 新记录插入到最前面（已有同一条日志时不重复插入），更新其他记录的 index
+  const upsertTrace = (record: TraceRecord) => {
+    setTraces(prev => {
+      if (prev.some(t => t.key === record.key)) return prev;
+      return [record, ...prev].map((t, i) => ({ ...t, index: i + 1 }));
+    });
+  };
+
   useEffect(() => {
     messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' });
   }, [messages]);
@@ -129,7 +158,8 @@ const App: React.FC = () => {
     }
   };
 
-  const loadLogs = async () => {
+  // 返回已加载的最大日志 id，作为推送的续传起点
+  const loadLogs = async (): Promise<number> => {
     try {
       const res = await axios.get('http://localhost:8000/logs?limit=50');
       const logs = res.data.map((log: any, idx: number) => {
@@ -158,8 +188,10 @@ const App: React.FC = () => {
         };
       });
       setTraces(logs);  // 后端已按倒序返回
+      return res.data.length ? res.data[0].id : 0;
     } catch (e) {
       console.error('Failed to load logs', e);
+      return 0;
     }
   };
 
@@ -273,17 +305,14 @@ const App: React.FC = () => {
       };
       setMessages(prev => [...prev, agentMsg]);
 
-      setTraces(prev => {
-        const newTrace: TraceRecord = {
-          key: Date.now(),
-          index: 1,
-          input: userMsg.content,
-          tokens: data.token_usage?.total_tokens || 0,
-          latency: `${((data.latency_ms || 0) / 1000).toFixed(1)}s`,
-          trace: { ...data, user_input: userMsg.content },
-        };
-        // 新记录插入到最前面，更新其他记录的 index
-        return [newTrace, ...prev.map((t, i) => ({...t, index: i + 2}))];
+      // 推送可能先到，按日志 id 去重
+      upsertTrace({
+        key: data.log_id ?? Date.now(),
+        index: 1,
+        input: userMsg.content,
+        tokens: data.token_usage?.total_tokens || 0,
+        latency: `${((data.latency_ms || 0) / 1000).toFixed(1)}s`,
+        trace: { ...data, user_input: userMsg.content },
       });
     } catch (e) {
       console.error(e);
@@ -1,4 +1,6 @@
 #!/bin/bash
+# usage: ./run_backend.sh          开发模式（单进程，代码热重载）
+#        ./run_backend.sh prod [N] 生产模式（N 个 worker，默认 CPU 核数，共享存储见 STORE_BACKEND）
 cd "$(dirname "$0")/server"
 
 # Set your DashScope API key here or export it in your shell
@@ -9,4 +11,28 @@ if [ -z "$DASHSCOPE_API_KEY" ]; then
 fi
 
 source ../.venv/bin/activate
-uvicorn main_v2:app --reload --host 0.0.0.0 --port 8000
+
+if [ "$1" != "prod" ]; then
+    uvicorn main_v2:app --reload --host 0.0.0.0 --port 8000
+    exit
+fi
+
+WORKERS="${2:-${WORKERS:-$(nproc)}}"
+# 多 worker 时会话、车辆状态和限流必须共享，默认用本机 socket 存储
+export STORE_BACKEND="${STORE_BACKEND:-socket}"
+export STORE_SOCKET="${STORE_SOCKET:-/tmp/car_bot_store.sock}"
+
+# 建表只做一次，避免多个 worker 同时 create_all
+python -c "from database import init_db; init_db()"
+
+if [ "$STORE_BACKEND" = "socket" ]; then
+    python shared_store.py serve --socket "$STORE_SOCKET" &
+    STORE_PID=$!
+    trap 'kill $STORE_PID 2>/dev/null' EXIT
+    for _ in $(seq 50); do
+        [ -S "$STORE_SOCKET" ] && break
+        sleep 0.1
+    done
+fi
+
+uvicorn main_v2:app --host 0.0.0.0 --port 8000 --workers "$WORKERS"
@@ -0,0 +1,334 @@
+"""Build the knowledge base from any number of feature-list workbooks.
+
+Every domain in a workbook is a pair of sheets: `<Domain>` holds the numbered
+rules (column 1) and `<Domain> Query` holds the Ability/Feature/Intent/Query
+rows. Each sheet is parsed in a process pool; parsed sheets are cached by the
+workbook's content hash so unchanged workbooks are not opened again. Results
+are merged in input order (workbooks sorted by path, sheets in workbook order),
+so the output does not depend on which worker finishes first. A workbook
+that cannot be opened is reported and skipped like a sheet that fails to parse.
+
+The JSON output file is only a copy of the result: the v2 server serves the
+active version of its KB store, so use --store (and --activate) to publish.
+
+    python scripts/ingest.py catalogue/*.xlsx
+    python scripts/ingest.py catalogue/ --store catalogue --activate
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+OUTPUT_FILE = os.path.join(ROOT, 'server', 'data', 'knowledge_base.json')
+CACHE_FILE = os.path.join(ROOT, 'server', 'data', '.ingest_cache.json')
+QUERY_SUFFIX = ' Query'
+# Bump when the sheet parsers change so cached sheets are re-parsed
+PARSER_VERSION = 1
+
+
+def clean_text(text):
+    import pandas as pd
+    if pd.isna(text):
+        return ""
+    return str(text).strip()
+
+
+def file_hash(path: str) -> str:
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def find_workbooks(inputs: List[str]) -> List[str]:
+    """Expand directories to the .xlsx/.xls files inside; result is sorted and de-duplicated."""
+    paths = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            for dirpath, _, files in os.walk(item):
+                paths.update(os.path.join(dirpath, f) for f in files
+                             if f.endswith(('.xlsx', '.xls')) and not f.startswith('~$'))
+        else:
+            paths.add(item)
+    return sorted(os.path.abspath(p) for p in paths)
+
+
+def domain_sheets(sheet_names: List[str]) -> List[Tuple[str, str, str]]:
+    """[(sheet, domain, kind)] in workbook order; kind is 'rules' or 'intents'."""
+    domains = {name[:-len(QUERY_SUFFIX)].strip() for name in sheet_names if name.endswith(QUERY_SUFFIX)}
+    tasks = []
+    for name in sheet_names:
+        if name.endswith(QUERY_SUFFIX):
+            tasks.append((name, name[:-len(QUERY_SUFFIX)].strip(), 'intents'))
+        elif name.strip() in domains:
+            tasks.append((name, name.strip(), 'rules'))
+    return tasks
+
+
+def extract_rules(path: str, sheet: str) -> Dict[str, Any]:
+    """Numbered rules ("2. 若实际车型…") from column 1 of a domain sheet."""
+    import pandas as pd
+    df = pd.read_excel(path, sheet_name=sheet, header=None)
+    rules = []
+    if df.shape[1] > 1:
+        for val in df.iloc[:, 1]:
+            val_str = clean_text(val)
+            if len(val_str) > 10 and val_str[0].isdigit():
+                rules.append(val_str)
+    return {"rules": rules, "rows": len(df)}
+
+
+def extract_intents(path: str, sheet: str, domain: str) -> Dict[str, Any]:
+    """One entry per intent from a `<Domain> Query` sheet; empty cells inherit from the row above."""
+    import pandas as pd
+    df = pd.read_excel(path, sheet_name=sheet)
+    df.columns = [str(c).strip() for c in df.columns]
+    if 'Intent' not in df.columns or 'Query' not in df.columns:
+        return {"intents": [], "rows": len(df), "duplicates": 0, "error": "missing Intent/Query columns"}
+
+    intents = []
+    seen_intents = set()
+    duplicates = 0
+    last_ability = ''
+    last_feature = ''
+    last_intent = ''
+    for _, row in df.iterrows():
+        ability = clean_text(row.get('Ability', ''))
+        feature = clean_text(row.get('Feature', ''))
+        intent = clean_text(row.get('Intent', ''))
+        query = clean_text(row.get('Query', ''))
+
+        if ability:
+            last_ability = ability
+        if feature:
+            last_feature = feature
+        if intent:
+            last_intent = intent
+
+        if query and last_intent:
+            if last_intent not in seen_intents:
+                seen_intents.add(last_intent)
+                intents.append({
+                    "domain": domain,
+                    "ability": last_ability,
+                    "feature": last_feature,
+                    "intent": last_intent,
+                    "query": query
+                })
+            else:
+                duplicates += 1
+    return {"intents": intents, "rows": len(df), "duplicates": duplicates}
+
+
+def list_sheets(path: str) -> List[str]:
+    import pandas as pd
+    with pd.ExcelFile(path) as xls:
+        return list(xls.sheet_names)
+
+
+def parse_sheet(path: str, sheet: str, domain: str, kind: str) -> Dict[str, Any]:
+    """Worker entry point: parse one sheet."""
+    started = time.perf_counter()
+    try:
+        if kind == 'rules':
+            result = extract_rules(path, sheet)
+        else:
+            result = extract_intents(path, sheet, domain)
+    except Exception as e:
+        result = {"error": f"{type(e).__name__}: {e}", "failed": True}
+    result.update(sheet=sheet, domain=domain, kind=kind, ms=int((time.perf_counter() - started) * 1000))
+    return result
+
+
+class SheetCache:
+    """workbook sha1 -> parsed sheets, stored as one JSON file next to the output."""
+
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self.entries: Dict[str, Any] = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if data.get("parser_version") == PARSER_VERSION:
+                    self.entries = data["workbooks"]
+            except (OSError, ValueError, KeyError):
+                self.entries = {}
+
+    def get(self, digest: str) -> Optional[List[Dict[str, Any]]]:
+        return self.entries.get(digest)
+
+    def save(self, workbooks: Dict[str, List[Dict[str, Any]]]):
+        """Keep only the workbooks seen in this run, so the cache does not grow forever."""
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({"parser_version": PARSER_VERSION, "workbooks": workbooks}, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+
+def parse_workbooks(paths: List[str], workers: int, cache: SheetCache
+                    ) -> Tuple[List[Tuple[str, List[Dict[str, Any]]]], Dict[str, int]]:
+    """[(path, parsed sheets in workbook order)] in input order, plus counters."""
+    digests = {path: file_hash(path) for path in paths}
+    parsed: Dict[str, List[Dict[str, Any]]] = {}
+    stale = []
+    for path in paths:
+        cached = cache.get(digests[path])
+        if cached is not None:
+            parsed[path] = cached
+        else:
+            stale.append(path)
+
+    counters = {"workbooks": len(paths), "cached": len(paths) - len(stale), "sheets_parsed": 0,
+                "unreadable": 0}
+    if stale:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            listings = {path: pool.submit(list_sheets, path) for path in stale}
+            futures = {}
+            for path in stale:
+                try:
+                    sheets = listings[path].result()
+                except Exception as e:
+                    # Unreadable workbook: recorded like a failed sheet, the other workbooks still go through
+                    parsed[path] = [{"sheet": None, "domain": None, "kind": "workbook",
+                                     "error": f"{type(e).__name__}: {e}", "failed": True}]
+                    counters["unreadable"] += 1
+                    continue
+                futures[path] = [pool.submit(parse_sheet, path, *task) for task in domain_sheets(sheets)]
+            for path, sheet_futures in futures.items():
+                parsed[path] = [future.result() for future in sheet_futures]
+                counters["sheets_parsed"] += len(parsed[path])
+
+    # Workbooks with a sheet that failed to read are parsed again next time
+    cache.save({digests[path]: parsed[path] for path in paths
+                if not any(sheet.get("failed") for sheet in parsed[path])})
+    return [(path, parsed[path]) for path in paths], counters
+
+
+def merge(workbooks: List[Tuple[str, List[Dict[str, Any]]]]) -> Tuple[Dict[str, Any], Dict[str, Dict[str, int]]]:
+    """Merge in order; the first workbook that defines a (domain, intent) or a rule wins."""
+    rules: List[str] = []
+    seen_rules = set()
+    intents: List[Dict[str, Any]] = []
+    seen_intents = set()
+    stats: Dict[str, Dict[str, int]] = OrderedDict()
+
+    for path, sheets in workbooks:
+        for sheet in sheets:
+            if sheet["kind"] == 'workbook':
+                print(f"  ! {os.path.basename(path)}: {sheet['error']}", file=sys.stderr)
+                continue
+            s = stats.setdefault(sheet["domain"], {"workbooks": 0, "rows": 0, "rules": 0, "intents": 0,
+                                                   "dup_in_sheet": 0, "dup_across": 0, "errors": 0})
+            if sheet.get("error"):
+                s["errors"] += 1
+                print(f"  ! {os.path.basename(path)} [{sheet['sheet']}]: {sheet['error']}", file=sys.stderr)
+            s["rows"] += sheet.get("rows", 0)
+            if sheet["kind"] == 'rules':
+                for rule in sheet.get("rules", []):
+                    if rule not in seen_rules:
+                        seen_rules.add(rule)
+                        rules.append(rule)
+                        s["rules"] += 1
+                continue
+            s["workbooks"] += 1
+            s["dup_in_sheet"] += sheet.get("duplicates", 0)
+            for item in sheet.get("intents", []):
+                key = (item["domain"], item["intent"])
+                if key in seen_intents:
+                    s["dup_across"] += 1
+                    continue
+                seen_intents.add(key)
+                intents.append(item)
+                s["intents"] += 1
+
+    return {"rules": rules, "intents": intents}, stats
+
+
+def print_stats(stats: Dict[str, Dict[str, int]]):
+    columns = ("workbooks", "rows", "rules", "intents", "dup_in_sheet", "dup_across", "errors")
+    width = max([len("domain")] + [len(d) for d in stats])
+    print(f"{'domain':<{width}}  " + "  ".join(f"{c:>12}" for c in columns))
+    for domain, s in stats.items():
+        print(f"{domain:<{width}}  " + "  ".join(f"{s[c]:>12}" for c in columns))
+
+
+def write_output(kb: Dict[str, Any], path: str) -> bool:
+    """Write the JSON knowledge base; returns False when the file already has this content."""
+    data = json.dumps(kb, indent=2, ensure_ascii=False)
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            if f.read() == data:
+                return False
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(data)
+    os.replace(tmp, path)
+    return True
+
+
+def store_kb(kb: Dict[str, Any], name: str, activate: bool) -> str:
+    """Register the result as a version in the server's knowledge base store."""
+    sys.path.insert(0, os.path.join(ROOT, 'server'))
+    from kb_store import KBStore
+    store = KBStore(os.path.join(ROOT, 'server', 'data', 'kb'))
+    stored, duplicate = store.put(kb, name)
+    if activate:
+        store.activate(stored)
+    return f"{stored} ({'unchanged' if duplicate else 'new version'}{', active' if activate else ''})"
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Build the knowledge base from feature-list workbooks")
+    parser.add_argument("inputs", nargs="+", help="Workbooks or directories containing them")
+    parser.add_argument("-o", "--output", default=OUTPUT_FILE,
+                        help="JSON copy of the result (default: %(default)s); the v2 server does not read "
+                             "this file, use --store to publish")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--cache", default=CACHE_FILE, help="Parsed-sheet cache file")
+    parser.add_argument("--no-cache", action="store_true", help="Re-parse every workbook")
+    parser.add_argument("--store", metavar="NAME",
+                        help="Save the result to the server's KB store under NAME (what the v2 server serves)")
+    parser.add_argument("--activate", action="store_true", help="Activate the stored version (with --store)")
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    paths = find_workbooks(args.inputs)
+    missing = [p for p in paths if not os.path.exists(p)]
+    if missing or not paths:
+        print("Error: no workbooks found" + (f" ({', '.join(missing)} missing)" if missing else ""), file=sys.stderr)
+        return 1
+
+    cache = SheetCache(None if args.no_cache else args.cache)
+    workbooks, counters = parse_workbooks(paths, max(1, args.workers), cache)
+    kb, stats = merge(workbooks)
+
+    print_stats(stats)
+    print(f"Workbooks: {counters['workbooks']} ({counters['cached']} unchanged), "
+          f"sheets parsed: {counters['sheets_parsed']}"
+          + (f", unreadable workbooks: {counters['unreadable']}" if counters['unreadable'] else ""))
+    print(f"Total rules: {len(kb['rules'])}")
+    print(f"Total intents: {len(kb['intents'])}")
+    if write_output(kb, args.output):
+        print(f"Knowledge base saved to {args.output}")
+    else:
+        print(f"Knowledge base unchanged: {args.output}")
+    if args.store:
+        print(f"Stored as {store_kb(kb, args.store, args.activate)}")
+    print(f"Done in {time.perf_counter() - started:.2f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,165 @@
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+
+from agents.router import RouterAgent
+from shared_store import store
+
+# 优先级: 数值越小越先处理
+PRIORITY_SAFETY = 0   # 除霜/除雾、灯光等行车安全相关
+PRIORITY_CONTROL = 1  # 空调、座椅、车窗、导航
+PRIORITY_MEDIA = 2    # 媒体娱乐
+PRIORITY_BATCH = 3    # 批量离线任务，只用交互请求剩下的容量
+
+SAFETY_KEYWORDS = ["除霜", "除雾", "雾灯", "大灯", "近光", "远光"]
+SAFETY_MODULES = {"LIGHT"}
+MEDIA_MODULES = {"MEDIA"}
+
+def classify_priority(message: str) -> int:
+    """按关键词本地判断请求优先级，不调用 LLM"""
+    if any(kw in message for kw in SAFETY_KEYWORDS):
+        return PRIORITY_SAFETY
+    module = RouterAgent.guess_module(message)
+    if module in SAFETY_MODULES:
+        return PRIORITY_SAFETY
+    if module in MEDIA_MODULES:
+        return PRIORITY_MEDIA
+    return PRIORITY_CONTROL
+
+class AdmissionRejected(Exception):
+    """请求被限流或过载保护拒绝"""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+class AdmissionController:
+    """全局并发上限 + 按客户端令牌桶 + 优先级排队，预计排队超过目标延迟时直接 429"""
+
+    def __init__(self, max_in_flight: int = 8, queue_target_s: float = 2.0,
+                 client_rate: float = 2.0, client_burst: float = 5.0, max_clients: int = 10000):
+        self.max_in_flight = max_in_flight
+        self.queue_target_s = queue_target_s
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.max_clients = max_clients
+        self.in_flight = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        # 单个请求占用时长的指数滑动平均，用于估算排队时间
+        self._service_time = 1.0
+        self.stats = {"admitted": 0, "queued": 0, "rate_limited": 0, "shed": 0, "background": 0, "busy": 0}
+
+    def _take_token(self, client: str) -> Tuple[bool, float]:
+        # 令牌桶放在共享存储里，多 worker 时同一客户端共用一份限额
+        return store.take("bucket", client, self.client_rate, self.client_burst, self.max_clients)
+
+    def waiting(self, max_priority: Optional[int] = None) -> int:
+        return sum(1 for p, _, fut in self._waiters
+                   if not fut.done() and (max_priority is None or p <= max_priority))
+
+    def _estimate_wait(self, priority: int) -> float:
+        ahead = self.waiting(priority)
+        return (ahead + 1) * self._service_time / self.max_in_flight
+
+    def check_rate(self, client: str):
+        ok, retry_after = self._take_token(client)
+        if not ok:
+            self.stats["rate_limited"] += 1
+            raise AdmissionRejected("rate limited", retry_after)
+
+    async def acquire(self, client: str, priority: int = PRIORITY_CONTROL, rate_limit: bool = True):
+        if rate_limit:
+            self.check_rate(client)
+
+        if self.in_flight < self.max_in_flight and not self.waiting():
+            self.in_flight += 1
+            self.stats["admitted"] += 1
+            return
+
+        wait = self._estimate_wait(priority)
+        if wait > self.queue_target_s:
+            self.stats["shed"] += 1
+            raise AdmissionRejected("overloaded", wait)
+
+        fut = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._seq), fut)
+        heapq.heappush(self._waiters, entry)
+        self.stats["queued"] += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), timeout=self.queue_target_s)
+        except asyncio.TimeoutError:
+            if fut.done() and not fut.cancelled():
+                # 超时的同时拿到了名额
+                self.stats["admitted"] += 1
+                return
+            fut.cancel()
+            self.stats["shed"] += 1
+            raise AdmissionRejected("queue timeout", self._service_time)
+        except asyncio.CancelledError:
+            # 客户端断开：已分到的名额要还回去
+            if fut.done() and not fut.cancelled():
+                self.release()
+            else:
+                fut.cancel()
+            raise
+        self.stats["admitted"] += 1
+
+    def saturated(self) -> bool:
+        """名额已满或有请求在排队；后台工作据此让路（只读，可在其他线程调用）"""
+        return self.in_flight >= self.max_in_flight or self.waiting() > 0
+
+    def try_acquire(self) -> bool:
+        """后台工作（如预执行）占一个名额：不排队，已满或有人在排队时返回 False，由调用方放弃这项工作"""
+        if self.in_flight < self.max_in_flight and not self.waiting():
+            self.in_flight += 1
+            self.stats["background"] += 1
+            return True
+        self.stats["busy"] += 1
+        return False
+
+    def release(self, service_time: Optional[float] = None):
+        if service_time is not None:
+            self._service_time = 0.8 * self._service_time + 0.2 * service_time
+        # 名额直接交给优先级最高的等待者
+        while self._waiters:
+            _, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self.in_flight -= 1
+
+    @asynccontextmanager
+    async def admit(self, client: str, priority: int = PRIORITY_CONTROL, rate_limit: bool = True):
+        await self.acquire(client, priority, rate_limit)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - started)
+
+    def get_stats(self) -> Dict[str, object]:
+        return {
+            **self.stats,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting(),
+            "max_in_flight": self.max_in_flight,
+            "service_time_ms": int(self._service_time * 1000)
+        }
+
+admission = AdmissionController(
+    max_in_flight=int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "8")),
+    queue_target_s=float(os.getenv("ADMISSION_QUEUE_TARGET_S", "2.0")),
+    client_rate=float(os.getenv("CLIENT_RATE_PER_S", "2.0")),
+    client_burst=float(os.getenv("CLIENT_BURST", "5"))
+)
+
+def client_key(headers, host: Optional[str]) -> str:
+    """按车辆 ID / API Key / 客户端地址区分限流对象"""
+    return headers.get("x-vehicle-id") or headers.get("x-api-key") or host or "anonymous"
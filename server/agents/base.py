@@ -1,50 +1,558 @@
+import os
 import json
+import time
 from abc import ABC, abstractmethod
-from dashscope import Generation
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from .singleflight import SingleFlight
+from .resilience import LLMError, LLMTimeoutError, CircuitOpenError, CircuitBreaker, ResilientCaller, RETRYABLE_STATUS
+from .jsonparse import extract_json, JSONArrayStream
+from . import llmcache as llm_cache
+from metrics import LLM_SECONDS, LLM_ERRORS, count_tokens, STAGE_SECONDS, FALLBACKS, CACHE_EVENTS, JSON_REPAIRS
+from tracing import span, annotate, current_span
+from startup import lazy_import
+
+# 进程内相同 LLM 调用合并
+SINGLE_FLIGHT = os.getenv("SINGLE_FLIGHT", "1") == "1"
+llm_flight = SingleFlight()
+
+# 本地意图分类器: 置信度达到阈值且无需参数的意图直接返回，不调用 LLM
+LOCAL_CLASSIFIER = os.getenv("LOCAL_CLASSIFIER", "1") == "1"
+LOCAL_INTENT_THRESHOLD = float(os.getenv("LOCAL_INTENT_THRESHOLD", "0.9"))
+
+# 超时、重试与对冲
+llm_caller = ResilientCaller(
+    max_retries=int(os.getenv("LLM_MAX_RETRIES", "2")),
+    hedging=os.getenv("LLM_HEDGING", "0") == "1",
+    max_abandoned=int(os.getenv("LLM_MAX_ABANDONED", "8"))
+)
+
+# 熔断: 按 (模型, 接口) 统计最近调用的错误率和慢调用率
+llm_breaker = CircuitBreaker(
+    window=int(os.getenv("BREAKER_WINDOW", "20")),
+    min_calls=int(os.getenv("BREAKER_MIN_CALLS", "10")),
+    error_rate=float(os.getenv("BREAKER_ERROR_RATE", "0.5")),
+    slow_s=float(os.getenv("BREAKER_SLOW_S", "3")),
+    slow_rate=float(os.getenv("BREAKER_SLOW_RATE", "0.5")),
+    open_s=float(os.getenv("BREAKER_OPEN_S", "10"))
+)
+
+# 降级模式: auto 熔断时用本地组件兜底（默认）；off 熔断时直接报错；force 不调用模型，始终走本地组件
+DEGRADED_MODE = os.getenv("DEGRADED_MODE", "auto")
+
+# 多条输入合并成一次调用时追加在系统提示词后面
+BATCH_PROMPT = """
+
+批量模式: 用户输入是一个JSON数组，每个元素是一条独立的输入。
+对每个元素分别按上面的要求处理，按相同顺序输出一个JSON数组，数组长度与输入一致，每个元素是对应的JSON结果。
+只输出JSON数组，不要其他内容。"""
+
+def _new_request_state() -> Dict[str, Any]:
+    return {
+        "tokens": {"input_tokens": 0, "output_tokens": 0},  # 累计 token 使用量
+        "escalations": [],  # 本次请求中的模型升级记录
+        "deadline": None,  # 本次请求的截止时间 (time.monotonic)，None 表示不限
+        "degraded": []  # 熔断后改用本地组件兜底的 Agent
+    }
+
+# 按请求隔离的统计状态；线程池任务通过 copy_context 共享同一个 dict
+_request_state: ContextVar[Optional[Dict[str, Any]]] = ContextVar("llm_request_state", default=None)
+_default_state = _new_request_state()
+
+def _intent_key(name: str) -> str:
+    return "".join(ch for ch in name if not ch.isspace() and ch not in "\"'“”‘’「」《》。，、！？,.!?:：")
+
+def request_state() -> Dict[str, Any]:
+    return _request_state.get() or _default_state
+
+# 按上下文覆盖的流程配置（影子流量的候选配置），不随 reset_tokens 清空；键见 BaseAgent.setting 的调用处
+_overrides: ContextVar[Dict[str, Any]] = ContextVar("pipeline_overrides", default={})
+
+def _generation():
+    """dashscope 导入较慢，首次调用模型时才加载"""
+    return lazy_import("dashscope").Generation
 
 class BaseAgent(ABC):
-    def __init__(self, model: str = "qwen-max"):
-        self.model = model
-    
+    # 模型分级: 先用快速模型，解析失败或结果不可信时升级到大模型
+    # 可通过环境变量覆盖，如 MODEL_TIERS_ROUTER="qwen-turbo,qwen-max"
+    MODEL_TIERS: Tuple[str, ...] = ("qwen-turbo", "qwen-max")
+    # 单次调用超时（秒），实际取值不超过整体请求的剩余预算
+    TIMEOUT_S = 5.0
+
+    def __init__(self, model: str = None, strong_model: str = None):
+        tiers = self.get_model_tiers()
+        self.model = model or tiers[0]
+        self.strong_model = strong_model or (tiers[1] if len(tiers) > 1 else None)
+
     @abstractmethod
     def get_system_prompt(self) -> str:
         pass
-    
-    # 累计 token 使用量
-    total_tokens = {"input_tokens": 0, "output_tokens": 0}
-    
+
+    def system_prompt(self) -> str:
+        """get_system_prompt 的缓存版本，提示词在进程内不变，预热时提前构建"""
+        prompt = self.__dict__.get("_system_prompt")
+        if prompt is None:
+            prompt = self._system_prompt = self.get_system_prompt()
+        return prompt
+
+    @classmethod
+    def agent_key(cls) -> str:
+        """ACAgent -> AC, RouterAgent -> ROUTER"""
+        name = cls.__name__
+        if name.endswith("Agent"):
+            name = name[:-5]
+        return name.upper()
+
+    @classmethod
+    def get_model_tiers(cls) -> Tuple[str, ...]:
+        env = os.getenv(f"MODEL_TIERS_{cls.agent_key()}")
+        if env:
+            return tuple(m.strip() for m in env.split(",") if m.strip())
+        return cls.MODEL_TIERS
+
+    @classmethod
+    def get_timeout(cls) -> float:
+        return float(os.getenv(f"LLM_TIMEOUT_{cls.agent_key()}", cls.TIMEOUT_S))
+
     @classmethod
     def reset_tokens(cls):
-        cls.total_tokens = {"input_tokens": 0, "output_tokens": 0}
-    
+        """开始新的请求上下文（token、升级记录、截止时间）"""
+        _request_state.set(_new_request_state())
+
     @classmethod
     def get_tokens(cls):
-        return {**cls.total_tokens, "total_tokens": cls.total_tokens["input_tokens"] + cls.total_tokens["output_tokens"]}
-    
-    def call_llm(self, user_input: str, system_prompt: str = None) -> str:
+        tokens = request_state()["tokens"]
+        return {**tokens, "total_tokens": tokens["input_tokens"] + tokens["output_tokens"]}
+
+    @classmethod
+    def add_tokens(cls, usage: Dict[str, int]):
+        """把别的上下文里花掉的 token（如识别时的预执行）计入本次请求"""
+        tokens = request_state()["tokens"]
+        tokens["input_tokens"] += usage.get("input_tokens", 0)
+        tokens["output_tokens"] += usage.get("output_tokens", 0)
+
+    @staticmethod
+    def set_overrides(overrides: Dict[str, Any]):
+        """在当前上下文中覆盖流程配置（如 {"model": "qwen-plus", "local_classifier": False}）"""
+        _overrides.set(dict(overrides))
+
+    @staticmethod
+    def setting(name: str, default: Any) -> Any:
+        return _overrides.get().get(name, default)
+
+    def primary_model(self) -> str:
+        """本次调用的快速模型: 按 Agent 覆盖（model_router 等）> 全局覆盖（model）> 分级配置"""
+        return self.setting(f"model_{self.agent_key().lower()}", None) or self.setting("model", self.model)
+
+    @classmethod
+    def get_escalations(cls):
+        return list(request_state()["escalations"])
+
+    @classmethod
+    def get_degraded(cls):
+        return list(request_state()["degraded"])
+
+    @classmethod
+    def set_request_budget(cls, seconds: Optional[float]):
+        """设置端到端请求预算，各 Agent 的调用截止时间由剩余预算推出"""
+        request_state()["deadline"] = time.monotonic() + seconds if seconds else None
+
+    @classmethod
+    def remaining_budget(cls) -> Optional[float]:
+        """本次请求还剩的预算（秒），没有设置预算时为 None"""
+        deadline = request_state()["deadline"]
+        return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+    def call_llm(self, user_input: str, system_prompt: str = None, model: str = None) -> str:
         if system_prompt is None:
-            system_prompt = self.get_system_prompt()
-        
-        response = Generation.call(
-            model=self.model,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_input}
-            ],
-            result_format="message"
-        )
+            system_prompt = self.system_prompt()
+        model = model or self.primary_model()
+
+        with span("llm", agent=self.__class__.__name__, model=model) as s:
+            if not SINGLE_FLIGHT:
+                return self._call_resilient(user_input, system_prompt, model)
+
+            def leader():
+                annotate(single_flight="leader")
+                return self._call_resilient(user_input, system_prompt, model)
+
+            key = (self.__class__.__name__, model, system_prompt, user_input)
+            result = llm_flight.do(key, leader)
+            if s is not None and "single_flight" not in s.attrs:
+                s.set(single_flight="shared")
+            return result
+
+    @staticmethod
+    def _admit(model: str, endpoint: str):
+        """熔断器打开（或强制降级）时不发出调用"""
+        if DEGRADED_MODE == "force":
+            raise CircuitOpenError("degraded mode forced")
+        if not llm_breaker.allow((model, endpoint)):
+            raise CircuitOpenError(f"circuit open for {model}/{endpoint}")
+
+    def _call_resilient(self, user_input: str, system_prompt: str, model: str) -> str:
+        """一次 allow 对应一次 record: 熔断器只看整次调用（含重试、对冲）的结果
+
+        超时放弃的尝试仍在后台运行，返回时不再记录，否则一次挂住的调用会记两次；
+        半开时的一个探测名额也只对应一个结果。上游明确拒绝的请求（不可重试的 4xx）不算故障。
+        """
+        self._admit(model, "generation")
+        deadline = time.monotonic() + self.get_timeout()
+        request_deadline = request_state()["deadline"]
+        if request_deadline is not None:
+            deadline = min(deadline, request_deadline)
+        started = time.monotonic()
+        try:
+            content = llm_caller.call(
+                (self.__class__.__name__, model),
+                lambda: self._request_once(user_input, system_prompt, model),
+                deadline
+            )
+        except LLMTimeoutError:
+            # 挂住的调用要等很久才返回，按截止时间记一次失败，熔断器不必等它
+            llm_breaker.record((model, "generation"), False, time.monotonic() - started)
+            raise
+        except LLMError as e:
+            llm_breaker.record((model, "generation"), not e.retryable, time.monotonic() - started)
+            raise
+        except Exception:
+            llm_breaker.record((model, "generation"), False, time.monotonic() - started)
+            raise
+        llm_breaker.record((model, "generation"), True, time.monotonic() - started)
+        return content
+
+    def _request_once(self, user_input: str, system_prompt: str, model: str) -> str:
+        agent = self.__class__.__name__
+        try:
+            with LLM_SECONDS.time(agent=agent, model=model):
+                response = _generation().call(
+                    model=model,
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": user_input}
+                    ],
+                    result_format="message"
+                )
+        except Exception:
+            LLM_ERRORS.inc(agent=agent, model=model)
+            raise
+        status_code = getattr(response, "status_code", 200)
+        if status_code != 200:
+            LLM_ERRORS.inc(agent=agent, model=model)
+            raise LLMError(
+                f"{model} returned {status_code}: {getattr(response, 'code', '')} {getattr(response, 'message', '')}".strip(),
+                status_code=status_code,
+                retryable=status_code in RETRYABLE_STATUS
+            )
         # 累计 token
         if response.usage:
-            BaseAgent.total_tokens["input_tokens"] += getattr(response.usage, "input_tokens", 0)
-            BaseAgent.total_tokens["output_tokens"] += getattr(response.usage, "output_tokens", 0)
+            input_tokens = getattr(response.usage, "input_tokens", 0)
+            output_tokens = getattr(response.usage, "output_tokens", 0)
+            tokens = request_state()["tokens"]
+            tokens["input_tokens"] += input_tokens
+            tokens["output_tokens"] += output_tokens
+            count_tokens(input_tokens, output_tokens, agent=agent, model=model)
+            s = current_span()
+            if s is not None:
+                s.set(input_tokens=s.attrs.get("input_tokens", 0) + input_tokens,
+                      output_tokens=s.attrs.get("output_tokens", 0) + output_tokens)
+        if not response.output or not response.output.choices:
+            LLM_ERRORS.inc(agent=agent, model=model)
+            raise LLMError(f"{model} returned empty output")
         return response.output.choices[0].message.content
-    
-    def parse_json(self, text: str) -> dict:
-        text = text.strip()
-        if text.startswith("```json"):
-            text = text[7:]
-        if text.startswith("```"):
-            text = text[3:]
-        if text.endswith("```"):
-            text = text[:-3]
-        return json.loads(text.strip())
+
+    def _cached(self, user_input: str) -> Optional[Any]:
+        if not self.setting("cache", True):
+            return None
+        data = llm_cache.get(self.agent_key(), self.system_prompt(), user_input)
+        if data is not None:
+            annotate(cached=True)
+        return data
+
+    def _remember(self, user_input: str, data: Any):
+        # 只缓存校验通过的结果，升级后仍不合格的不缓存
+        if self.setting("cache", True) and self.check_result(data) is None:
+            llm_cache.put(self.agent_key(), self.system_prompt(), user_input, data)
+
+    def call_json(self, user_input: str, system_prompt: str = None,
+                  check: Optional[Callable[[Any], Optional[str]]] = None,
+                  coerce: Optional[Callable[[Any], Any]] = None) -> Any:
+        """同 _call_json；使用默认提示词和校验时先查结果缓存"""
+        if system_prompt is not None or check is not None or coerce is not None:
+            return self._call_json(user_input, system_prompt, check, coerce)
+        data = self._cached(user_input)
+        if data is None:
+            try:
+                data = self._call_json(user_input)
+            except CircuitOpenError as e:
+                return self.degrade(e, self.fallback(user_input))
+            self._remember(user_input, data)
+        return data
+
+    def fallback(self, user_input: str) -> Optional[Any]:
+        """熔断时的本地兜底结果，None 表示没有；默认按 INTENTS 表匹配意图"""
+        intents = getattr(self, "INTENTS", None)
+        if intents is None:
+            return None
+        from .degraded import match_intent
+        return match_intent(self.agent_key(), intents, user_input)
+
+    def degrade(self, error: CircuitOpenError, data: Optional[Any]) -> Any:
+        """采用本地兜底结果并标记本次请求为降级；没有兜底或关闭了降级时抛出原错误"""
+        if data is None or DEGRADED_MODE == "off":
+            raise error
+        FALLBACKS.inc(agent=self.__class__.__name__, reason="circuit_open")
+        annotate(degraded=True)
+        degraded = request_state()["degraded"]
+        if self.agent_key() not in degraded:
+            degraded.append(self.agent_key())
+        return data
+
+    def _call_json(self, user_input: str, system_prompt: str = None,
+                   check: Optional[Callable[[Any], Optional[str]]] = None,
+                   coerce: Optional[Callable[[Any], Any]] = None) -> Any:
+        """先调用快速模型，JSON 提取失败或 check_result（或传入的 check）不通过时升级到大模型
+
+        模型输出先经容错提取和 coerce_result 本地修正，能修好的不再重新请求。
+        """
+        check = check or self.check_result
+        coerce = coerce or self.coerce_result
+
+        def accept(candidate: Any) -> bool:
+            try:
+                return check(coerce(candidate)) is None
+            except Exception:
+                return False
+
+        reason = None
+        try:
+            data = coerce(self.parse_json(self.call_llm(user_input, system_prompt), accept))
+            reason = check(data)
+            if reason is None:
+                return data
+        except ValueError:
+            reason = "invalid_json"
+            data = None
+
+        model = self.primary_model()
+        if not self.strong_model or self.strong_model == model:
+            if data is None:
+                raise ValueError(f"{self.__class__.__name__}: invalid JSON from {model}")
+            return data
+
+        FALLBACKS.inc(agent=self.__class__.__name__, reason=reason)
+        annotate(escalated=reason)
+        request_state()["escalations"].append({
+            "agent": self.__class__.__name__,
+            "from": model,
+            "to": self.strong_model,
+            "reason": reason,
+            "input": user_input
+        })
+        return coerce(self.parse_json(self.call_llm(user_input, system_prompt, model=self.strong_model), accept))
+
+    def call_json_many(self, inputs: List[str]) -> List[Any]:
+        """多条输入合并成一次调用，按输入顺序返回各自的结果；命中结果缓存的条目不再请求"""
+        results = [self._cached(text) for text in inputs]
+        misses = [i for i, data in enumerate(results) if data is None]
+        if misses:
+            try:
+                fresh = self._call_json_batch([inputs[i] for i in misses])
+            except CircuitOpenError as e:
+                for i in misses:
+                    results[i] = self.degrade(e, self.fallback(inputs[i]))
+                return results
+            for i, data in zip(misses, fresh):
+                results[i] = data
+                self._remember(inputs[i], data)
+        return results
+
+    def _call_json_batch(self, inputs: List[str]) -> List[Any]:
+        """批量调用；批量结果中不合格的条目再单独调用"""
+        if len(inputs) == 1:
+            return [self._call_json(inputs[0])]
+        annotate(batched=len(inputs))
+        try:
+            data = self._call_json(json.dumps(inputs, ensure_ascii=False),
+                                  self.system_prompt() + BATCH_PROMPT,
+                                  check=lambda d: self.check_many(d, len(inputs)),
+                                  coerce=lambda d: [self.coerce_result(item) for item in d] if isinstance(d, list) else d)
+        except ValueError:
+            data = None
+        if not isinstance(data, list) or len(data) != len(inputs):
+            FALLBACKS.inc(agent=self.__class__.__name__, reason="batch_mismatch")
+            data = [None] * len(inputs)
+        return [item if item is not None and self.check_result(item) is None else self._call_json(text)
+                for item, text in zip(data, inputs)]
+
+    def check_many(self, data: Any, size: int) -> Optional[str]:
+        if not isinstance(data, list) or len(data) != size:
+            return "batch_mismatch"
+        for item in data:
+            reason = self.check_result(item)
+            if reason is not None:
+                return reason
+        return None
+
+    def parse_many(self, texts: List[str]) -> List[Dict]:
+        """同一模块的多条指令: 本地分类器解析不了的合并成一次 LLM 调用"""
+        results = [self.local_parse(text) for text in texts]
+        pending = [i for i, result in enumerate(results) if result is None]
+        if pending:
+            for i, result in zip(pending, self.call_json_many([texts[i] for i in pending])):
+                results[i] = result
+        return results
+
+    def local_parse(self, text: str) -> Optional[Dict[str, Any]]:
+        """用本地分类器做第一级意图预测，不可信或需要提取参数时返回 None"""
+        intents = getattr(self, "INTENTS", None)
+        if not intents or not self.setting("local_classifier", LOCAL_CLASSIFIER):
+            return None
+        from classifier import get_classifier, unsupported_reason
+        clf = get_classifier()
+        if clf is None:
+            return None
+        reason = unsupported_reason(text)
+        if reason:
+            annotate(local_skip=reason)
+            CACHE_EVENTS.inc(cache="local_classifier", result="skip")
+            return None
+        label, confidence = clf.predict(text)
+        module, _, intent = (label or "").partition(":")
+        annotate(local_intent=label or "", local_confidence=round(confidence, 4))
+        if module != self.agent_key() or intent not in intents or intents[intent]["params"] \
+                or confidence < self.setting("local_intent_threshold", LOCAL_INTENT_THRESHOLD):
+            CACHE_EVENTS.inc(cache="local_classifier", result="miss")
+            return None
+        CACHE_EVENTS.inc(cache="local_classifier", result="hit")
+        return {"intent": intent, "params": {}, "local": True}
+
+    def check_result(self, data: Any) -> Optional[str]:
+        """校验快速模型的结果，返回升级原因；None 表示结果可用"""
+        intents = getattr(self, "INTENTS", None)
+        if intents is not None:
+            if not isinstance(data, dict):
+                return "invalid_schema"
+            if data.get("intent") not in intents:
+                return "unknown_intent"
+        return None
+
+    def coerce_result(self, data: Any) -> Any:
+        """按本 Agent 的输出格式做本地修正，合法结果原样返回
+
+        默认按 INTENTS 校正: 单元素数组取出元素、意图名去空白标点后精确匹配或按 INTENT_ALIASES 改名、
+        参数名只有一个对不上时改名、丢弃意图未声明的参数。
+        """
+        intents = getattr(self, "INTENTS", None)
+        if intents is None:
+            return data
+        if isinstance(data, list) and len(data) == 1:
+            data = data[0]
+        if not isinstance(data, dict):
+            return data
+        intent = data.get("intent")
+        params = data.get("params") if isinstance(data.get("params"), dict) else {}
+        if isinstance(intent, str) and intent not in intents:
+            intent = self._closest_intent(intent.strip(), intents) or intent
+        if intent in intents:
+            allowed = intents[intent]["params"]
+            unknown = [k for k in params if k not in allowed]
+            missing = [k for k in allowed if k not in params]
+            if len(unknown) == 1 and len(missing) == 1:
+                params[missing[0]] = params.pop(unknown[0])
+            params = {k: v for k, v in params.items() if k in allowed}
+        fixed = {"intent": intent, "params": params}
+        if fixed != data:
+            JSON_REPAIRS.inc(agent=self.__class__.__name__, repair="schema")
+        return fixed
+
+    def _closest_intent(self, intent: str, intents: Dict[str, Any]) -> Optional[str]:
+        """模型给出的意图名只做无歧义的修正: 去掉空白、引号和标点后完全相同，或在 INTENT_ALIASES 别名表里；
+        不做包含匹配（"关闭空调制冷" 不能改成 "关闭空调"）"""
+        if intent in intents:
+            return intent
+        key = _intent_key(intent)
+        alias = getattr(self, "INTENT_ALIASES", {}).get(key)
+        if alias in intents:
+            return alias
+        matches = [name for name in intents if _intent_key(name) == key]
+        return matches[0] if len(matches) == 1 else None
+
+    def parse_json(self, text: str, accept: Optional[Callable[[Any], bool]] = None) -> Any:
+        """容错提取模型输出中的第一个（通过 accept 校验的）JSON 对象/数组，修复项计入指标"""
+        with STAGE_SECONDS.time(stage="json_parse"):
+            data, repairs = extract_json(text, accept)
+        for repair in repairs:
+            JSON_REPAIRS.inc(agent=self.__class__.__name__, repair=repair)
+        if repairs:
+            annotate(json_repairs=",".join(repairs))
+        return data
+
+    # ---------- 流式输出 ----------
+
+    def stream_llm(self, user_input: str, system_prompt: str = None, model: str = None) -> Iterator[str]:
+        """流式调用（增量输出），逐段产出文本；受请求截止时间约束，不做重试"""
+        if system_prompt is None:
+            system_prompt = self.system_prompt()
+        model = model or self.primary_model()
+        agent = self.__class__.__name__
+        self._admit(model, "generation_stream")
+        deadline = time.monotonic() + self.get_timeout()
+        request_deadline = request_state()["deadline"]
+        if request_deadline is not None:
+            deadline = min(deadline, request_deadline)
+
+        with span("llm", agent=agent, model=model, stream=True), LLM_SECONDS.time(agent=agent, model=model):
+            usage = None
+            started = time.monotonic()
+            failed = False
+            try:
+                responses = _generation().call(
+                    model=model,
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": user_input}
+                    ],
+                    result_format="message",
+                    stream=True,
+                    incremental_output=True
+                )
+                for response in responses:
+                    if time.monotonic() > deadline:
+                        raise LLMTimeoutError(f"{model} stream exceeded deadline")
+                    status_code = getattr(response, "status_code", 200)
+                    if status_code != 200:
+                        raise LLMError(f"{model} returned {status_code}: {getattr(response, 'message', '')}".strip(),
+                                       status_code=status_code, retryable=status_code in RETRYABLE_STATUS)
+                    usage = response.usage or usage
+                    if response.output and response.output.choices:
+                        chunk = response.output.choices[0].message.content
+                        if chunk:
+                            yield chunk
+            except Exception as e:
+                failed = not isinstance(e, LLMError) or e.retryable or isinstance(e, LLMTimeoutError)
+                LLM_ERRORS.inc(agent=agent, model=model)
+                raise
+            finally:
+                # 调用方提前停止读取不算故障
+                llm_breaker.record((model, "generation_stream"), not failed, time.monotonic() - started)
+                if usage:
+                    # 流式响应的 usage 是累计值，以最后一次为准
+                    input_tokens = getattr(usage, "input_tokens", 0)
+                    output_tokens = getattr(usage, "output_tokens", 0)
+                    tokens = request_state()["tokens"]
+                    tokens["input_tokens"] += input_tokens
+                    tokens["output_tokens"] += output_tokens
+                    count_tokens(input_tokens, output_tokens, agent=agent, model=model)
+                    annotate(input_tokens=input_tokens, output_tokens=output_tokens)
+
+    def stream_json_items(self, user_input: str, system_prompt: str = None) -> Iterator[Any]:
+        """流式调用并增量解析 JSON 数组，每完成一个元素就产出"""
+        parser = JSONArrayStream()
+        for chunk in self.stream_llm(user_input, system_prompt):
+            for item in parser.feed(chunk):
+                yield item
+        for item in parser.close():
+            yield item
+        for repair in parser.repairs:
+            JSON_REPAIRS.inc(agent=self.__class__.__name__, repair=repair)
@@ -0,0 +1,168 @@
+# 本地合并多条执行结果的语音回复：按模块话术模板生成短句，同一动词的合并成一句，控制总长度
+import os
+from typing import Any, Dict, Iterable, List, Tuple, Union
+
+REPLY_MAX_CHARS = int(os.getenv("REPLY_MAX_CHARS", "30"))
+NOOP_ACTION = "NOOP"  # 与 vehicle_state.NOOP_ACTION 一致
+UNKNOWN_ACTION = "UNKNOWN"  # 与 degraded.UNKNOWN_ACTION 一致
+# 执行器没做成时的回复（"抱歉，暂不支持打开后备箱"），不能按意图名改写成 "已打开…"
+FAILURE_MARKERS = ("抱歉", "无法", "不支持", "失败", "未能", "不能")
+
+# 动词 -> 前缀，"打开空调" 说成 "已打开空调"；同前缀同动词的指令合并: "已打开空调和座椅加热"
+VERBS = {
+    "打开": "已", "关闭": "已", "调高": "已", "调低": "已", "锁定": "已", "解锁": "已",
+    "切换": "已", "停止": "已", "暂停": "已", "播放": "正在", "查看": "正在", "搜索": "正在"
+}
+
+# 不适合按动词拆分的意图: (模块, 意图) -> 整句模板，参数缺失时退回执行器给的回复
+TEMPLATES = {
+    "AC": {
+        "设置温度": "温度已调到{temperature}度",
+        "升温": "温度已调高",
+        "降温": "温度已调低",
+        "降到最低": "温度已调到最低",
+        "升到最高": "温度已调到最高",
+        "设置风量": "风量已调到{level}档",
+        "自动空调": "已开启自动空调",
+        "吹面": "已切换为吹面",
+        "吹足": "已切换为吹足",
+        "吹面吹足": "已切换为吹面吹足",
+    },
+    "NAV": {
+        "导航到目的地": "正在导航到{destination}",
+        "导航回家": "正在导航回家",
+        "导航去公司": "正在导航去公司",
+        "搜索地点": "正在搜索{keyword}",
+    },
+    "MEDIA": {
+        "下一首": "已切到下一首",
+        "上一首": "已切到上一首",
+        "设置音量": "音量已调到{volume}",
+        "播放歌曲": "正在播放{song_name}",
+        "播放歌手": "正在播放{artist_name}的歌",
+    },
+    "SEAT": {
+        "座椅加热档位": "{position}座椅加热已调到{level}档",
+        "座椅通风档位": "{position}座椅通风已调到{level}档",
+        "座椅通风增大": "{position}座椅通风已调大",
+        "座椅通风减小": "{position}座椅通风已调小",
+        "座椅通风最大": "{position}座椅通风已调到最大",
+        "座椅通风最小": "{position}座椅通风已调到最小",
+        "调节座椅": "{position}座椅已向{direction}调节",
+    },
+    "WINDOW": {
+        "车窗开一半": "{position}车窗已开一半",
+        "车窗开大一点": "{position}车窗已开大",
+        "车窗关小一点": "{position}车窗已关小",
+        "车窗升起": "{position}车窗已升起",
+        "车窗降下": "{position}车窗已降下",
+        "天窗开一半": "天窗已开一半",
+        "天窗开大一点": "天窗已开大",
+        "天窗关小一点": "天窗已关小",
+    },
+    "LIGHT": {
+        "氛围灯调亮": "氛围灯已调亮",
+        "氛围灯调暗": "氛围灯已调暗",
+        "调节氛围灯": "氛围灯已调好",
+    },
+}
+
+# 名称前要加位置的模块（"主驾座椅加热"），"全部" 不加
+POSITIONED = {"SEAT", "WINDOW"}
+ALL_POSITIONS = "全部"
+
+# 短语: (前缀, 动词, 对象) 可与同前缀同动词的合并；或者一整句
+Phrase = Union[Tuple[str, str, str], str]
+
+def _position(module: str, params: Dict[str, Any]) -> str:
+    position = params.get("position")
+    if module not in POSITIONED or not position or position == ALL_POSITIONS:
+        return ""
+    return str(position)
+
+def _clean(reply: str) -> str:
+    """执行器给的回复去掉客套开头和句末标点，便于拼接"""
+    reply = reply.strip().rstrip("。！!.")
+    for lead in ("好的，", "好的,", "好的"):
+        if reply.startswith(lead) and len(reply) > len(lead):
+            return reply[len(lead):]
+    return reply
+
+def phrase(result: Dict[str, Any]) -> Phrase:
+    """单条结果对应的短语，模板和动词都对不上时用执行器的回复"""
+    module, intent = result.get("module", ""), result.get("intent", "")
+    params = {k: v for k, v in (result.get("params") or {}).items() if v not in (None, "")}
+    position = _position(module, params)
+
+    template = TEMPLATES.get(module, {}).get(intent)
+    if template is not None:
+        try:
+            return template.format(**dict(params, position=position))
+        except (KeyError, IndexError):
+            return _clean(result.get("reply") or "操作完成")
+
+    for verb, lead in VERBS.items():
+        if intent.startswith(verb) and len(intent) > len(verb):
+            obj = intent[len(verb):]
+            if module == "LIGHT" and params.get("color"):
+                obj = f"{params['color']}{obj}"
+            return (lead, verb, position + obj)
+    return _clean(result.get("reply") or "操作完成")
+
+def _join(objects: List[str]) -> str:
+    if len(objects) == 1:
+        return objects[0]
+    return "、".join(objects[:-1]) + "和" + objects[-1]
+
+def fold(phrases: List[Phrase]) -> List[str]:
+    """同前缀同动词的短语合并（保持首次出现的位置），其余原样"""
+    clauses: List[Any] = []
+    groups: Dict[Tuple[str, str], List[str]] = {}
+    for p in phrases:
+        if isinstance(p, str):
+            clauses.append(p)
+            continue
+        lead, verb, obj = p
+        objects = groups.get((lead, verb))
+        if objects is None:
+            objects = groups[(lead, verb)] = []
+            clauses.append((lead, verb, objects))
+        if obj not in objects:
+            objects.append(obj)
+    return [c if isinstance(c, str) else f"{c[0]}{c[1]}{_join(c[2])}" for c in clauses]
+
+def fit(clauses: List[str], budget: int = REPLY_MAX_CHARS, polite: bool = True) -> str:
+    """超出预算时保留前面放得下的分句，其余概括为 "另有N项已完成"；开头的 "好的，" 有空间且 polite 时才加"""
+    reply = "，".join(clauses)
+    if len(reply) > budget:
+        kept: List[str] = []
+        for i, clause in enumerate(clauses):
+            skipped = len(clauses) - i - 1
+            if len("，".join(kept + [clause, f"另有{skipped}项已完成"])) > budget:
+                break
+            kept.append(clause)
+        skipped = len(clauses) - len(kept)
+        reply = "，".join(kept + [f"另有{skipped}项已完成"]) if kept else f"已完成{len(clauses)}项操作"
+    if polite and len(reply) + 3 <= budget:
+        reply = "好的，" + reply
+    return reply
+
+def failed(result: Dict[str, Any]) -> bool:
+    """未识别的指令，或执行器的回复表明没有执行成功"""
+    reply = result.get("reply") or ""
+    return result.get("action") == UNKNOWN_ACTION or any(m in reply for m in FAILURE_MARKERS)
+
+def compose(results: List[Dict[str, Any]], verbatim: Iterable[int] = (),
+            budget: int = REPLY_MAX_CHARS) -> str:
+    """合并多条结果的回复；verbatim 中的序号（车辆状态直接给出的固定话术）和 NOOP 结果的回复原样使用
+
+    未执行成功的结果也原样使用，并放在最前面（超出预算时不会被概括成 "已完成"），整句不加 "好的，"。
+    """
+    verbatim = set(verbatim)
+    failures = [_clean(r.get("reply") or "操作失败") for r in results if failed(r)]
+    phrases: List[Phrase] = [
+        _clean(r.get("reply") or "操作完成") if r.get("index") in verbatim or r.get("action") == NOOP_ACTION
+        else phrase(r)
+        for r in results if not failed(r)
+    ]
+    return fit(failures + fold(phrases), budget, polite=not failures)
@@ -0,0 +1,109 @@
+# 降级模式的本地组件：模型熔断时用关键词拆分指令、按意图表匹配意图、按模板生成动作码和回复
+import os
+import re
+from typing import Any, Dict, List
+
+import numpy as np
+
+from .composer import phrase
+
+UNKNOWN_ACTION = "UNKNOWN"
+UNKNOWN_REPLY = "抱歉，网络不佳，暂时无法处理这条指令"
+# 本模块候选意图里校准后的最高概率低于这个值时不猜，回复 UNKNOWN_REPLY
+DEGRADED_MIN_CONFIDENCE = float(os.getenv("DEGRADED_MIN_CONFIDENCE", "0.5"))
+
+# 分句: 标点和常见连接词
+_SPLIT = re.compile(r"[，,。；;！!？?]|然后|接着|并且|同时|顺便|再把")
+
+# 参数提取: 数值参数取第一个数字；位置、方向、颜色按词表；目的地/歌曲等取触发词之后的文本
+NUMERIC_PARAMS = ("temperature", "level", "volume", "brightness")
+POSITIONS = [("主驾", "主驾"), ("驾驶", "主驾"), ("副驾", "副驾"), ("左后", "左后"), ("右后", "右后"),
+             ("后排", "后排"), ("全部", "全部"), ("所有", "全部")]
+DIRECTIONS = ["前", "后", "上", "下"]
+COLORS = ["红", "橙", "黄", "绿", "青", "蓝", "紫", "白", "粉"]
+TEXT_PARAMS = {
+    "destination": r"(?:导航到|导航去|去|到)(.+)",
+    "keyword": r"(?:搜索|搜一下|找)(.+)",
+    "song_name": r"(?:播放|放一首|来一首|听)(.+)",
+    "artist_name": r"(?:播放|听)(.+?)的歌",
+}
+
+def split(message: str, modules: Dict[str, List[str]]) -> List[Dict[str, Any]]:
+    """按标点和连接词分句，每句按关键词猜模块；猜不出模块的分句丢弃"""
+    commands = []
+    for text in (part.strip() for part in _SPLIT.split(message)):
+        if not text:
+            continue
+        hits = {module: sum(1 for kw in keywords if kw in text) for module, keywords in modules.items()}
+        best = max(hits.values())
+        candidates = [module for module, count in hits.items() if count == best]
+        if best == 0 or len(candidates) != 1:
+            continue
+        commands.append({"index": len(commands) + 1, "module": candidates[0], "text": text, "confidence": 0.5})
+    return commands
+
+def extract_params(text: str, names: List[str]) -> Dict[str, Any]:
+    params: Dict[str, Any] = {}
+    for name in names:
+        if name in NUMERIC_PARAMS:
+            m = re.search(r"\d+", text)
+            if m:
+                params[name] = int(m.group())
+        elif name == "position":
+            params[name] = next((value for word, value in POSITIONS if word in text), "")
+        elif name == "direction":
+            params[name] = next((d for d in DIRECTIONS if d in text), "")
+        elif name == "color":
+            params[name] = next((c + "色" for c in COLORS if c in text), "")
+        elif name in TEXT_PARAMS:
+            m = re.search(TEXT_PARAMS[name], text)
+            if m:
+                params[name] = m.group(1).strip("吧呢啊。")
+    return {k: v for k, v in params.items() if v not in ("", None)}
+
+def match_intent(module: str, intents: Dict[str, Any], text: str) -> Dict[str, Any]:
+    """本地分类器在本模块意图中取概率最高的（按分类器校准的温度在本模块候选内做 softmax），
+    低于 DEGRADED_MIN_CONFIDENCE 时不猜；没有分类器时不做子串猜测，一律返回未知
+
+    输入里有数字时只在带数值参数的意图里选（"温度调到26度" 是设置温度而不是打开空调）。
+    否定和疑问句（"车窗别开"、"空调温度是多少"）直接返回未知，不执行任何动作。
+    """
+    from classifier import get_classifier, unsupported_reason
+    if unsupported_reason(text) in ("negation", "question"):
+        return {"intent": "未知", "params": {}, "local": True}
+    intent = None
+    clf = get_classifier()
+    if clf is not None:
+        numeric = re.search(r"\d", text) is not None and any(
+            p in NUMERIC_PARAMS for spec in intents.values() for p in spec["params"])
+        names, scores = [], []
+        for label, score in zip(clf.labels, clf.scores(text)):
+            prefix, _, name = label.partition(":")
+            if prefix != module or name not in intents:
+                continue
+            if numeric and not any(p in NUMERIC_PARAMS for p in intents[name]["params"]):
+                continue
+            names.append(name)
+            scores.append(float(score))
+        if scores and max(scores) > 0:
+            logits = np.exp((np.array(scores) - max(scores)) / clf.temperature)
+            best = int(np.argmax(logits))
+            if logits[best] / logits.sum() >= DEGRADED_MIN_CONFIDENCE:
+                intent = names[best]
+    if intent is None:
+        return {"intent": "未知", "params": {}, "local": True}
+    return {"intent": intent, "params": extract_params(text, intents[intent]["params"]), "local": True}
+
+def execute(module: str, intent: str, params: Dict[str, Any],
+            intents: Dict[str, Any]) -> Dict[str, str]:
+    """意图表给出动作码（数值/目的地参数按执行器约定接在后面，如 TEMP_SET_26），回复用合并回复的模板"""
+    spec = intents.get(intent)
+    if spec is None:
+        return {"action": UNKNOWN_ACTION, "reply": UNKNOWN_REPLY}
+    action = spec["action"]
+    suffix = next((params[p] for p in spec["params"]
+                   if p in NUMERIC_PARAMS + ("destination", "keyword") and params.get(p) not in (None, "")), None)
+    if suffix is not None:
+        action = f"{action}_{suffix}"
+    p = phrase({"module": module, "intent": intent, "params": params, "reply": intent})
+    return {"action": action, "reply": p if isinstance(p, str) else "".join(p)}
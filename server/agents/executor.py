@@ -1,6 +1,8 @@
 import json
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Tuple
 from .base import BaseAgent
+from .degraded import execute as local_execute
+from .resilience import CircuitOpenError
 
 class ExecutorAgent(BaseAgent):
     def get_system_prompt(self) -> str:
@@ -22,11 +24,33 @@ class ExecutorAgent(BaseAgent):
 
 只输出JSON，不要其他内容。"""
 
-    def execute(self, module: str, intent: str, params: Dict[str, Any]) -> Dict:
-        prompt = f"""模块: {module}
+    def _prompt(self, module: str, intent: str, params: Dict[str, Any]) -> str:
+        return f"""模块: {module}
 意图: {intent}
 参数: {json.dumps(params, ensure_ascii=False) if params else "无"}
 
 请生成执行命令和回复。"""
-        result = self.call_llm(prompt)
-        return self.parse_json(result)
+
+    def execute(self, module: str, intent: str, params: Dict[str, Any]) -> Dict:
+        return self.execute_many([(module, intent, params)])[0]
+
+    def execute_many(self, items: List[Tuple[str, str, Dict[str, Any]]]) -> List[Dict]:
+        """多条 (模块, 意图, 参数) 合并成一次调用，按输入顺序返回；熔断时按意图表和回复模板本地生成"""
+        try:
+            return self.call_json_many([self._prompt(*item) for item in items])
+        except CircuitOpenError as e:
+            from .modules import MODULE_INTENTS
+            return self.degrade(e, [local_execute(module, intent, params, MODULE_INTENTS.get(module, {}))
+                                    for module, intent, params in items])
+
+    def coerce_result(self, data: Any) -> Any:
+        if isinstance(data, list) and len(data) == 1:
+            data = data[0]
+        if isinstance(data, dict) and isinstance(data.get("action"), str):
+            data = dict(data, action=data["action"].strip().upper())
+        return data
+
+    def check_result(self, data: Any) -> Optional[str]:
+        if not isinstance(data, dict) or not data.get("action"):
+            return "invalid_schema"
+        return None
@@ -0,0 +1,189 @@
+# 容错 JSON 提取：从模型输出里找第一个配对完整的对象/数组，本地修复常见缺陷，支持流式逐项解析
+import json
+import re
+from typing import Any, Callable, List, Optional, Set, Tuple
+
+_CLOSERS = {"{": "}", "[": "]"}
+# 字符串定界符 -> 可以结束它的字符（中文引号开闭不一定配对）
+_QUOTES = {'"': '"', "'": "'", "“": "”“", "”": "”“", "‘": "’‘", "’": "’‘"}
+_FULLWIDTH = {"：": ":", "，": ","}
+_LITERALS = {"True": "true", "False": "false", "None": "null", "true": "true", "false": "false", "null": "null"}
+_WORD = re.compile(r"[^\W\d]\w*")
+# 最多尝试几个候选起点（前面的括号可能只是闲聊里的标点）
+MAX_CANDIDATES = 5
+
+def _repair(text: str, start: int) -> Tuple[str, Set[str]]:
+    """从 start 处的 { 或 [ 扫描到与之配对的括号，边扫边修：单引号/中文引号、
+    Python 字面量、未加引号的键或值、全角标点、多余的尾逗号、被截断时补齐括号"""
+    out: List[str] = []
+    stack: List[str] = []
+    repairs: Set[str] = set()
+    quote: Optional[str] = None
+    i, n = start, len(text)
+    while i < n:
+        ch = text[i]
+        if quote is not None:
+            if ch == "\\" and i + 1 < n:
+                nxt = text[i + 1]
+                out.append(nxt if nxt == "'" else ch + nxt)
+                i += 2
+                continue
+            if ch in _QUOTES[quote]:
+                out.append('"')
+                quote = None
+            elif ch == '"':
+                out.append('\\"')
+            else:
+                out.append(ch)
+            i += 1
+            continue
+
+        if ch in _QUOTES:
+            if ch != '"':
+                repairs.add("quotes")
+            quote = ch
+            out.append('"')
+        elif ch in _CLOSERS:
+            stack.append(_CLOSERS[ch])
+            out.append(ch)
+        elif ch in "}]":
+            if _strip_trailing_comma(out):
+                repairs.add("trailing_comma")
+            closer = stack.pop() if stack else ch
+            if closer != ch:
+                repairs.add("brackets")
+            out.append(closer)
+            if not stack:
+                return "".join(out), repairs
+        elif ch in _FULLWIDTH:
+            repairs.add("fullwidth")
+            out.append(_FULLWIDTH[ch])
+        else:
+            m = _WORD.match(text, i) if not (text[i - 1].isdigit() or text[i - 1] == ".") else None
+            if m:
+                word = m.group()
+                if word in _LITERALS:
+                    if word != _LITERALS[word]:
+                        repairs.add("python_literal")
+                    out.append(_LITERALS[word])
+                else:
+                    repairs.add("bare_word")
+                    out.append(json.dumps(word, ensure_ascii=False))
+                i = m.end()
+                continue
+            out.append(ch)
+        i += 1
+
+    # 输出被截断：补上未闭合的字符串和括号
+    repairs.add("truncated")
+    if quote is not None:
+        out.append('"')
+    while out and out[-1].strip() in ("", ",", ":"):
+        out.pop()
+    out.extend(reversed(stack))
+    return "".join(out), repairs
+
+def _strip_trailing_comma(out: List[str]) -> bool:
+    j = len(out) - 1
+    while j >= 0 and not out[j].strip():
+        j -= 1
+    if j >= 0 and out[j] == ",":
+        del out[j]
+        return True
+    return False
+
+def extract_json(text: str, accept: Optional[Callable[[Any], bool]] = None) -> Tuple[Any, List[str]]:
+    """返回 (第一个 JSON 对象或数组, 用到的修复项)；找不到可用 JSON 时抛 ValueError
+
+    accept 为调用方的结构校验: 只返回通过校验的候选（闲聊里的 "[1]" 之类不会抢先被当成结果）；
+    都不通过时返回第一个能解析的，由调用方按校验失败处理。
+    """
+    decoder = json.JSONDecoder(strict=False)
+    starts = [i for i, ch in enumerate(text) if ch in _CLOSERS][:MAX_CANDIDATES]
+    if not starts:
+        raise ValueError("no JSON object or array in model output")
+    first: Optional[Tuple[Any, List[str]]] = None
+    # 先找无需修复的，再逐个尝试修复
+    for start in starts:
+        try:
+            data, _ = decoder.raw_decode(text, start)
+        except ValueError:
+            continue
+        if accept is None or accept(data):
+            return data, []
+        first = first or (data, [])
+    error: Optional[Exception] = None
+    for start in starts:
+        fixed, repairs = _repair(text, start)
+        try:
+            data = decoder.decode(fixed)
+        except ValueError as e:
+            error = e
+            continue
+        if accept is None or accept(data):
+            return data, sorted(repairs)
+        first = first or (data, sorted(repairs))
+    if first is not None:
+        return first
+    raise ValueError(f"unrecoverable JSON in model output: {error}")
+
+class JSONArrayStream:
+    """增量解析模型流式输出的 JSON 数组：每喂入一段文本，返回其中新完成的顶层元素
+
+    根节点是对象时把整个对象当作唯一元素；元素本身用 extract_json 解析，同样容错。
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.pos = 0
+        self.depth = 0
+        self.item_depth: Optional[int] = None  # 元素所在的括号深度: 根为数组时 1，根为对象时 0
+        self.item_start: Optional[int] = None
+        self.quote: Optional[str] = None
+        self.done = False
+        self.repairs: Set[str] = set()
+
+    def feed(self, chunk: str) -> List[Any]:
+        self.buffer += chunk
+        items = []
+        while self.pos < len(self.buffer) and not self.done:
+            ch = self.buffer[self.pos]
+            if self.quote is not None:
+                if ch == "\\":
+                    self.pos += 1
+                elif ch in _QUOTES[self.quote]:
+                    self.quote = None
+            elif ch in ('"', "'") and self.item_depth is not None:
+                self.quote = ch
+            elif ch in _CLOSERS:
+                if self.item_depth is None:
+                    self.item_depth = 1 if ch == "[" else 0
+                if self.depth == self.item_depth:
+                    self.item_start = self.pos
+                self.depth += 1
+            elif ch in "}]" and self.item_depth is not None:
+                self.depth -= 1
+                if self.depth == self.item_depth and self.item_start is not None:
+                    items.append(self._item(self.buffer[self.item_start:self.pos + 1]))
+                    self.item_start = None
+                if self.depth <= 0:
+                    self.done = True
+            self.pos += 1
+        return [item for item in items if item is not None]
+
+    def close(self) -> List[Any]:
+        """输出结束: 被截断的最后一个元素尽量修复后返回"""
+        if self.done or self.item_start is None:
+            return []
+        item = self._item(self.buffer[self.item_start:])
+        self.item_start = None
+        return [item] if item is not None else []
+
+    def _item(self, text: str) -> Any:
+        try:
+            data, repairs = extract_json(text)
+        except ValueError:
+            self.repairs.add("dropped_item")
+            return None
+        self.repairs.update(repairs)
+        return data
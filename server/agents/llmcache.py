@@ -0,0 +1,43 @@
+# 模型结果缓存：按 (知识库版本, Agent, 系统提示词, 归一化的输入) 缓存校验通过的 JSON 结果，放在共享存储里各 worker 共用
+import hashlib
+import json
+import os
+from typing import Any, Optional
+
+from metrics import CACHE_EVENTS
+from shared_store import store
+
+LLM_CACHE = os.getenv("LLM_CACHE", "1") == "1"
+LLM_CACHE_TTL_S = float(os.getenv("LLM_CACHE_TTL_S", "86400"))
+LLM_CACHE_MAX = int(os.getenv("LLM_CACHE_MAX", "50000"))
+
+# 当前激活知识库的版本，切换知识库后旧结果自然失效
+_kb_version = ""
+
+def set_kb_version(version: str):
+    global _kb_version
+    _kb_version = version
+
+def kb_version() -> str:
+    return _kb_version
+
+def normalize(text: str) -> str:
+    """合并空白、去掉句末标点；缓存键和预热覆盖率都按它算，"打开空调。" 与 "打开空调" 共用一条"""
+    return " ".join(text.split()).rstrip("。！？!?.~～")
+
+def cache_key(agent: str, system_prompt: str, user_input: str) -> str:
+    raw = "\x00".join((_kb_version, agent, system_prompt, normalize(user_input)))
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+def get(agent: str, system_prompt: str, user_input: str) -> Optional[Any]:
+    """命中时返回一份新的副本（以 JSON 文本存放，调用方随意修改不影响缓存）"""
+    if not LLM_CACHE:
+        return None
+    raw = store.get("llm", cache_key(agent, system_prompt, user_input))
+    CACHE_EVENTS.inc(cache="llm_result", result="miss" if raw is None else "hit")
+    return None if raw is None else json.loads(raw)
+
+def put(agent: str, system_prompt: str, user_input: str, value: Any):
+    if LLM_CACHE:
+        store.set("llm", cache_key(agent, system_prompt, user_input), json.dumps(value, ensure_ascii=False),
+                  LLM_CACHE_TTL_S, LLM_CACHE_MAX)
@@ -5,4 +5,8 @@ from .seat import SeatAgent
 from .window import WindowAgent
 from .light import LightAgent
 
-__all__ = ["ACAgent", "NavAgent", "MediaAgent", "SeatAgent", "WindowAgent", "LightAgent"]
+# 模块 key -> 意图表（意图名 -> 动作码与参数）
+MODULE_INTENTS = {cls.agent_key(): cls.INTENTS
+                  for cls in (ACAgent, NavAgent, MediaAgent, SeatAgent, WindowAgent, LightAgent)}
+
+__all__ = ["ACAgent", "NavAgent", "MediaAgent", "SeatAgent", "WindowAgent", "LightAgent", "MODULE_INTENTS"]
@@ -76,5 +76,4 @@ class ACAgent(BaseAgent):
 只输出JSON，不要其他内容。"""
 
     def parse(self, text: str) -> Dict:
-        result = self.call_llm(text)
-        return self.parse_json(result)
+        return self.local_parse(text) or self.call_json(text)
@@ -0,0 +1,321 @@
+import contextvars
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Deque, Dict, Hashable, Optional
+
+class LLMError(Exception):
+    """LLM 调用失败（非 200 响应、空输出或网络异常）"""
+    http_status = 502
+
+    def __init__(self, message: str, status_code: Optional[int] = None, retryable: bool = True):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retryable = retryable
+
+class LLMTimeoutError(LLMError):
+    """超过单次调用或整体请求的截止时间"""
+    http_status = 504
+
+    def __init__(self, message: str):
+        super().__init__(message, retryable=False)
+
+class CircuitOpenError(LLMError):
+    """熔断器打开，调用未发出"""
+    http_status = 503
+
+    def __init__(self, message: str):
+        super().__init__(message, retryable=False)
+
+# 可重试的上游状态码
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+class RetryBudget:
+    """全局重试预算：每个请求存入 ratio 个令牌，每次重试/对冲消耗 1 个，避免故障时重试风暴"""
+
+    def __init__(self, ratio: float = 0.1, min_tokens: float = 10.0, max_tokens: float = 100.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = min_tokens
+        self._lock = threading.Lock()
+        self.stats = {"deposits": 0, "withdrawn": 0, "rejected": 0}
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+            self.stats["deposits"] += 1
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.stats["withdrawn"] += 1
+                return True
+            self.stats["rejected"] += 1
+            return False
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self.stats, "tokens": round(self.tokens, 2)}
+
+class LatencyTracker:
+    """按 key 记录最近的调用延迟，用于计算对冲触发点"""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.window = window
+        self.min_samples = min_samples
+        self._samples: Dict[Hashable, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, key: Hashable, seconds: float):
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def percentile(self, key: Hashable, q: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples.get(key, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            keys = list(self._samples)
+        stats = {}
+        for key in keys:
+            p95 = self.percentile(key, 0.95)
+            stats["/".join(key) if isinstance(key, tuple) else str(key)] = {
+                "samples": len(self._samples[key]),
+                "p95_ms": int(p95 * 1000) if p95 is not None else None
+            }
+        return stats
+
+class ResilientCaller:
+    """带截止时间、抖动重试和对冲请求的调用器
+
+    阻塞的上游调用无法中断：超时或对冲落败后已经在跑的尝试会一直占着线程直到返回（被放弃的尝试）。
+    同一 key 被放弃但仍在运行的尝试达到 max_abandoned 时不再对冲，新的尝试直接按超时失败，避免挂住的上游占满线程池。
+    """
+
+    def __init__(self, max_workers: int = 32, max_retries: int = 2, backoff_base: float = 0.1,
+                 backoff_cap: float = 1.0, hedging: bool = False, hedge_default_delay: float = 2.0,
+                 max_abandoned: int = 8):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm")
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.hedging = hedging
+        self.hedge_default_delay = hedge_default_delay
+        self.max_abandoned = max_abandoned
+        self._abandoned: Dict[Hashable, int] = {}
+        self.budget = RetryBudget()
+        self.latency = LatencyTracker()
+        self._lock = threading.Lock()
+        self.stats = {"calls": 0, "retries": 0, "hedges": 0, "hedge_wins": 0, "timeouts": 0, "errors": 0,
+                      "abandoned": 0, "saturated": 0}
+
+    def _count(self, key: str):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _saturated(self, key: Hashable) -> bool:
+        with self._lock:
+            return self._abandoned.get(key, 0) >= self.max_abandoned
+
+    def _abandon(self, key: Hashable, futures):
+        """放弃未完成的尝试：还没开始的取消掉，已在运行的记账，返回时归还"""
+        for future in futures:
+            if future.cancel():
+                continue
+            with self._lock:
+                self._abandoned[key] = self._abandoned.get(key, 0) + 1
+                self.stats["abandoned"] += 1
+            future.add_done_callback(lambda _, key=key: self._release(key))
+
+    def _release(self, key: Hashable):
+        with self._lock:
+            left = self._abandoned.get(key, 0) - 1
+            if left > 0:
+                self._abandoned[key] = left
+            else:
+                self._abandoned.pop(key, None)
+
+    def call(self, key: Hashable, fn: Callable[[], Any], deadline: float) -> Any:
+        """在 deadline(time.monotonic) 之前完成 fn，失败时在预算内重试"""
+        self._count("calls")
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            try:
+                return self._attempt(key, fn, deadline)
+            except LLMError as e:
+                if isinstance(e, LLMTimeoutError):
+                    self._count("timeouts")
+                else:
+                    self._count("errors")
+                if not e.retryable or attempt >= self.max_retries:
+                    raise
+                # full jitter 指数退避
+                delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+                if time.monotonic() + delay >= deadline or not self.budget.withdraw():
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                self._count("retries")
+
+    def _attempt(self, key: Hashable, fn: Callable[[], Any], deadline: float) -> Any:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise LLMTimeoutError("request deadline exceeded")
+        if self._saturated(key):
+            self._count("saturated")
+            raise LLMTimeoutError(f"{self.max_abandoned} abandoned calls still running, upstream looks hung")
+
+        started = time.monotonic()
+        primary = self.pool.submit(contextvars.copy_context().run, fn)
+        futures = {primary}
+
+        if self.hedging:
+            hedge_delay = self.latency.percentile(key, 0.95) or self.hedge_default_delay
+            done, _ = wait(futures, timeout=min(hedge_delay, remaining))
+            if not done and time.monotonic() < deadline and not self._saturated(key) and self.budget.withdraw():
+                futures.add(self.pool.submit(contextvars.copy_context().run, fn))
+                self._count("hedges")
+
+        error = None
+        while futures:
+            done, futures = wait(futures, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                try:
+                    result = future.result()
+                except LLMError as e:
+                    error = e
+                    continue
+                except Exception as e:
+                    error = LLMError(str(e))
+                    continue
+                if future is not primary:
+                    self._count("hedge_wins")
+                self._abandon(key, futures)
+                self.latency.record(key, time.monotonic() - started)
+                return result
+
+        if error is not None and not futures:
+            raise error
+        self._abandon(key, futures)
+        raise LLMTimeoutError(f"LLM call timed out after {time.monotonic() - started:.2f}s")
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+            stats["running_abandoned"] = sum(self._abandoned.values())
+        stats["retry_budget"] = self.budget.get_stats()
+        stats["latency"] = self.latency.get_stats()
+        return stats
+
+
+class CircuitBreaker:
+    """按 (模型, 接口) 熔断: 最近窗口内错误率或慢调用率超过阈值时打开，
+    open_s 秒后进入半开，放少量探测调用，连续成功 probe_successes 次后关闭，探测失败重新打开"""
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, window: int = 20, window_s: float = 30.0, min_calls: int = 10,
+                 error_rate: float = 0.5, slow_s: float = 3.0, slow_rate: float = 0.5,
+                 open_s: float = 10.0, probes: int = 1, probe_successes: int = 2):
+        self.window = window
+        self.window_s = window_s
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_s = slow_s
+        self.slow_rate = slow_rate
+        self.open_s = open_s
+        self.probes = probes
+        self.probe_successes = probe_successes
+        self._circuits: Dict[Hashable, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def _circuit(self, key: Hashable) -> Dict[str, Any]:
+        circuit = self._circuits.get(key)
+        if circuit is None:
+            circuit = self._circuits[key] = {
+                "state": self.CLOSED, "outcomes": deque(maxlen=self.window), "opened_at": 0.0,
+                "probing": 0, "probe_ok": 0, "trips": 0, "rejected": 0, "reason": None
+            }
+        return circuit
+
+    def _open(self, circuit: Dict[str, Any], reason: str):
+        circuit.update(state=self.OPEN, opened_at=time.monotonic(), probing=0, probe_ok=0, reason=reason)
+        circuit["outcomes"].clear()
+        circuit["trips"] += 1
+
+    def allow(self, key: Hashable) -> bool:
+        """是否放行一次调用；半开时占用一个探测名额，结果须通过 record 归还"""
+        with self._lock:
+            circuit = self._circuit(key)
+            if circuit["state"] == self.OPEN and time.monotonic() - circuit["opened_at"] >= self.open_s:
+                circuit.update(state=self.HALF_OPEN, probing=0, probe_ok=0)
+            if circuit["state"] == self.CLOSED:
+                return True
+            if circuit["state"] == self.HALF_OPEN and circuit["probing"] < self.probes:
+                circuit["probing"] += 1
+                return True
+            circuit["rejected"] += 1
+            return False
+
+    def record(self, key: Hashable, ok: bool, seconds: float):
+        slow = seconds >= self.slow_s
+        with self._lock:
+            circuit = self._circuit(key)
+            if circuit["state"] == self.HALF_OPEN:
+                circuit["probing"] = max(0, circuit["probing"] - 1)
+                if not ok or slow:
+                    self._open(circuit, "probe_failed" if not ok else "probe_slow")
+                    return
+                circuit["probe_ok"] += 1
+                if circuit["probe_ok"] >= self.probe_successes:
+                    circuit.update(state=self.CLOSED, reason=None)
+                    circuit["outcomes"].clear()
+                return
+            if circuit["state"] == self.OPEN:
+                return  # 打开前发出的调用晚到的结果
+            now = time.monotonic()
+            outcomes = circuit["outcomes"]
+            outcomes.append((now, ok, slow))
+            while outcomes and now - outcomes[0][0] > self.window_s:
+                outcomes.popleft()
+            if len(outcomes) < self.min_calls:
+                return
+            errors = sum(1 for _, good, _ in outcomes if not good)
+            slows = sum(1 for _, _, was_slow in outcomes if was_slow)
+            if errors >= self.error_rate * len(outcomes):
+                self._open(circuit, "error_rate")
+            elif slows >= self.slow_rate * len(outcomes):
+                self._open(circuit, "slow_rate")
+
+    def state(self, key: Hashable) -> str:
+        with self._lock:
+            circuit = self._circuits.get(key)
+            return circuit["state"] if circuit else self.CLOSED
+
+    def any_open(self) -> bool:
+        with self._lock:
+            return any(c["state"] != self.CLOSED for c in self._circuits.values())
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "/".join(key) if isinstance(key, tuple) else str(key): {
+                    "state": c["state"], "reason": c["reason"], "trips": c["trips"], "rejected": c["rejected"],
+                    "window": len(c["outcomes"]),
+                    "open_for_s": round(time.monotonic() - c["opened_at"], 1) if c["state"] != self.CLOSED else 0
+                }
+                for key, c in self._circuits.items()
+            }
@@ -1,8 +1,13 @@
+import os
 import json
-from typing import List, Dict
+from typing import List, Dict, Any, Iterator, Optional
 from .base import BaseAgent
+from metrics import JSON_REPAIRS
 
 class RouterAgent(BaseAgent):
+    # 低于该置信度时升级到大模型重新拆分
+    CONFIDENCE_THRESHOLD = float(os.getenv("ROUTER_CONFIDENCE_THRESHOLD", "0.7"))
+
     MODULES = {
         "AC": ["空调", "温度", "制冷", "制热", "风量", "除霜", "除雾", "暖风", "冷风"],
         "NAV": ["导航", "路线", "目的地", "去", "怎么走", "地图", "位置"],
@@ -39,6 +44,94 @@ class RouterAgent(BaseAgent):
 
 只输出JSON数组，不要其他内容。"""
 
+    def check_result(self, data: Any) -> Optional[str]:
+        if not isinstance(data, list) or not data:
+            return "invalid_schema"
+        for cmd in data:
+            if not isinstance(cmd, dict) or cmd.get("module") not in self.MODULES:
+                return "unknown_module"
+            try:
+                confidence = float(cmd.get("confidence", 0))
+            except (TypeError, ValueError):
+                return "invalid_schema"
+            if confidence < self.CONFIDENCE_THRESHOLD:
+                return "low_confidence"
+        return None
+
+    def coerce_result(self, data: Any) -> Any:
+        """{"commands": [...]} 取出数组、单个对象包成数组，逐条修正"""
+        if isinstance(data, dict):
+            data = data["commands"] if isinstance(data.get("commands"), list) else [data]
+        if not isinstance(data, list):
+            return data
+        return [self.coerce_command(cmd, i) for i, cmd in enumerate(data)]
+
+    def coerce_command(self, cmd: Any, position: int) -> Any:
+        """模块名转大写、不在列表里时按指令原文的关键词唯一猜测、补齐 index"""
+        if not isinstance(cmd, dict):
+            return cmd
+        fixed = dict(cmd)
+        module = fixed.get("module")
+        if isinstance(module, str):
+            fixed["module"] = module.strip().upper()
+        if fixed.get("module") not in self.MODULES and isinstance(fixed.get("text"), str):
+            fixed["module"] = self.guess_module(fixed["text"]) or fixed.get("module")
+        if not isinstance(fixed.get("index"), int):
+            fixed["index"] = position + 1
+        if fixed != cmd:
+            JSON_REPAIRS.inc(agent=self.__class__.__name__, repair="schema")
+        return fixed
+
+    @classmethod
+    def guess_module(cls, text: str) -> Optional[str]:
+        """按关键词命中数本地猜测模块，无法唯一确定时返回 None"""
+        hits = {module: sum(1 for kw in keywords if kw in text) for module, keywords in cls.MODULES.items()}
+        best = max(hits.values())
+        if best == 0:
+            return None
+        candidates = [module for module, count in hits.items() if count == best]
+        return candidates[0] if len(candidates) == 1 else None
+
+    def fallback(self, user_input: str) -> Optional[List[Dict]]:
+        """熔断时按标点和连接词本地分句，每句按关键词猜模块"""
+        from .degraded import split
+        return split(user_input, self.MODULES) or None
+
     def recognize(self, message: str) -> List[Dict]:
-        result = self.call_llm(message)
-        return self.parse_json(result)
+        return self.call_json(message)
+
+    def recognize_stream(self, message: str) -> Iterator[Dict]:
+        """流式拆分: 每识别完一条指令就产出，index 按产出顺序编号
+
+        先查结果缓存（与 recognize 共用），命中时不调用模型；流式完整成功的结果写回缓存。
+        流式调用失败或出现不合格的指令时，退回 recognize()（含模型升级）补齐尚未产出的指令。
+        """
+        cached = self._cached(message)
+        if cached is not None:
+            for i, cmd in enumerate(cached):
+                yield dict(cmd, index=i + 1)
+            return
+
+        emitted = []
+        commands = []
+        try:
+            for item in self.stream_json_items(message):
+                cmd = self.coerce_command(item, len(emitted))
+                if self.check_result([cmd]) is not None or not isinstance(cmd.get("text"), str):
+                    raise ValueError("invalid streamed command")
+                cmd["index"] = len(emitted) + 1
+                emitted.append(cmd["text"])
+                commands.append(dict(cmd))
+                yield cmd
+            if emitted:
+                self._remember(message, commands)
+                return
+        except Exception:
+            pass
+
+        for cmd in self.recognize(message):
+            if cmd.get("text") in emitted:
+                continue
+            cmd = dict(cmd, index=len(emitted) + 1)
+            emitted.append(cmd.get("text"))
+            yield cmd
@@ -0,0 +1,66 @@
+import asyncio
+import threading
+from typing import Any, Callable, Dict, Hashable
+from metrics import CACHE_EVENTS
+
+class _Call:
+    __slots__ = ("done", "result", "error", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight:
+    """合并同一进程内并发的相同调用：只有第一个调用者真正执行，其余等待并共享结果"""
+
+    def __init__(self, name: str = "single_flight"):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+        self.stats = {"calls": 0, "executed": 0, "collapsed": 0}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            self.stats["calls"] += 1
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.stats["collapsed"] += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self.stats["executed"] += 1
+                leader = True
+
+        CACHE_EVENTS.inc(cache=self.name, result="miss" if leader else "hit")
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+        return call.result
+
+    async def do_async(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """供 asyncio 任务使用：在线程池中执行，与线程调用者共享同一份结果"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.do, key, fn)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+            stats["in_flight"] = len(self._calls)
+        stats["collapse_ratio"] = round(stats["collapsed"] / stats["calls"], 4) if stats["calls"] else 0.0
+        return stats
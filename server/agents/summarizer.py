@@ -1,7 +1,18 @@
-from typing import List, Dict
+import os
+from typing import Dict, Iterable, List
 from .base import BaseAgent
+from .composer import compose
+from .resilience import LLMError
+from metrics import FALLBACKS, CACHE_EVENTS
+
+# local: 本地模板合并（默认）；llm: 多条回复都交给模型润色。单个请求也可以用 quality 参数要求模型润色
+SUMMARY_MODE = os.getenv("SUMMARY_MODE", "local")
 
 class SummarizerAgent(BaseAgent):
+    # 合并回复足够简单，只用快速模型
+    MODEL_TIERS = ("qwen-turbo",)
+    TIMEOUT_S = 3.0
+
     def get_system_prompt(self) -> str:
         return """将多条执行结果合并成一句自然流畅的语音回复。
 
@@ -17,13 +28,25 @@ class SummarizerAgent(BaseAgent):
 
 只输出合并后的回复文本，不要其他内容。"""
 
-    def summarize(self, results: List[Dict]) -> str:
+    def summarize(self, results: List[Dict], planned: Iterable[int] = (), quality: bool = False) -> str:
+        """合并回复；planned 为车辆状态直接给出的结果序号，其回复是固定话术，原样使用"""
         if not results:
             return "操作完成"
         
         if len(results) == 1:
             return results[0].get("reply", "操作完成")
         
+        planned = set(planned)
+        if not (quality or self.setting("summary_mode", SUMMARY_MODE) == "llm") or all(r.get("index") in planned for r in results):
+            CACHE_EVENTS.inc(cache="reply_composer", result="local")
+            return compose(results, planned)
+
+        CACHE_EVENTS.inc(cache="reply_composer", result="llm")
         replies = [r.get("reply", "") for r in results]
         prompt = f"请合并以下回复: {replies}"
-        return self.call_llm(prompt).strip('"').strip("'")
+        try:
+            return self.call_llm(prompt).strip('"').strip("'")
+        except LLMError:
+            # 合并超时或失败时退回本地合并，不阻塞整条指令
+            FALLBACKS.inc(agent=self.__class__.__name__, reason="llm_error")
+            return compose(results, planned)
@@ -0,0 +1,163 @@
+# 批量对话：输入解析、去重、按输入顺序输出，/chat/batch 与命令行共用
+#
+#   python batch.py inputs.ndjson -c 8 -o results.ndjson
+import argparse
+import contextvars
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from agents.resilience import LLMError
+from admission import AdmissionRejected
+
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "4"))
+
+def parse_body(body: str, content_type: str = "") -> Tuple[List[str], Optional[int]]:
+    """解析 {"messages": [...], "concurrency": n} 或 NDJSON（每行一个字符串或 {"message": ...}）"""
+    concurrency = None
+    data = None
+    if "ndjson" not in content_type:
+        try:
+            data = json.loads(body)
+        except json.JSONDecodeError:
+            data = None
+    if isinstance(data, dict) and "messages" in data:
+        items = data["messages"]
+        concurrency = data.get("concurrency")
+    elif isinstance(data, list):
+        items = data
+    else:
+        items = [json.loads(line) for line in body.splitlines() if line.strip()]
+
+    messages = []
+    for item in items:
+        message = item.get("message") if isinstance(item, dict) else item
+        if not isinstance(message, str) or not message.strip():
+            raise ValueError(f"第 {len(messages) + 1} 条缺少 message")
+        messages.append(message)
+    if not messages:
+        raise ValueError("messages 不能为空")
+    if len(messages) > BATCH_MAX_ITEMS:
+        raise ValueError(f"单批最多 {BATCH_MAX_ITEMS} 条")
+    return messages, concurrency
+
+def clamp_concurrency(concurrency: Optional[int]) -> int:
+    if not concurrency:
+        return BATCH_MAX_CONCURRENCY
+    return max(1, min(int(concurrency), BATCH_MAX_CONCURRENCY))
+
+def dedupe(messages: List[str]) -> Tuple[List[str], List[int]]:
+    """返回 (去重后的消息, 每条输入对应的去重下标)，按去掉首尾空白后的文本判重"""
+    unique: List[str] = []
+    seen: Dict[str, int] = {}
+    positions = []
+    for message in messages:
+        key = message.strip()
+        if key not in seen:
+            seen[key] = len(unique)
+            unique.append(key)
+        positions.append(seen[key])
+    return unique, positions
+
+def ok_line(index: int, message: str, output: Dict[str, Any], deduplicated: bool) -> Dict[str, Any]:
+    return {
+        "index": index,
+        "message": message,
+        "status": "ok",
+        "commands": output["commands"],
+        "results": output["results"],
+        "summary": output["summary"],
+        "latency_ms": output["latency_ms"],
+        "token_usage": output["token_usage"],
+        "escalations": output["escalations"],
+        "degraded": output["degraded"],
+        "deduplicated": deduplicated
+    }
+
+def error_line(index: int, message: str, error: BaseException, deduplicated: bool) -> Dict[str, Any]:
+    if isinstance(error, AdmissionRejected):
+        code = 429
+    elif isinstance(error, LLMError):
+        code = error.http_status
+    else:
+        code = 500
+    return {
+        "index": index,
+        "message": message,
+        "status": "error",
+        "code": code,
+        "error": str(error),
+        "deduplicated": deduplicated
+    }
+
+def summary_line(lines: List[Dict[str, Any]], unique: int, log_ids: List[Optional[int]]) -> Dict[str, Any]:
+    return {
+        "summary": {
+            "total": len(lines),
+            "unique": unique,
+            "ok": sum(1 for line in lines if line["status"] == "ok"),
+            "error": sum(1 for line in lines if line["status"] == "error"),
+            "log_ids": log_ids
+        }
+    }
+
+def run_batch(messages: List[str], concurrency: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+    """离线批量执行：线程池并发跑去重后的消息，按输入顺序产出结果，最后一次性写日志"""
+    import pipeline
+
+    unique, positions = dedupe(messages)
+    pool = ThreadPoolExecutor(max_workers=clamp_concurrency(concurrency), thread_name_prefix="batch")
+    try:
+        futures = [pool.submit(contextvars.copy_context().run, pipeline.run_chat, m) for m in unique]
+        lines, first_seen = [], set()
+        for index, (message, pos) in enumerate(zip(messages, positions)):
+            deduplicated = pos in first_seen
+            first_seen.add(pos)
+            try:
+                line = ok_line(index, message, futures[pos].result(), deduplicated)
+            except Exception as e:
+                line = error_line(index, message, e, deduplicated)
+            lines.append(line)
+            yield line
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+    outputs = [f.result() if f.exception() is None else None for f in futures]
+    yield summary_line(lines, len(unique), save_results(unique, outputs, positions))
+
+def save_results(unique: List[str], outputs: List[Optional[Dict[str, Any]]],
+                 positions: List[int]) -> List[Optional[int]]:
+    """成功的去重结果一次批量入库，返回与输入一一对应的 log_id（失败为 None）"""
+    import pipeline
+
+    done = [(i, output) for i, output in enumerate(outputs) if output is not None]
+    ids = pipeline.save_chat_logs([(unique[i], output) for i, output in done])
+    by_pos = {i: log_id for (i, _), log_id in zip(done, ids)}
+    return [by_pos.get(pos) for pos in positions]
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="批量运行对话流程")
+    parser.add_argument("input", help="NDJSON 或 {\"messages\": [...]} 文件，- 表示标准输入")
+    parser.add_argument("-c", "--concurrency", type=int, default=None)
+    parser.add_argument("-o", "--output", default="-", help="结果 NDJSON，默认标准输出")
+    args = parser.parse_args(argv)
+
+    from database import init_db
+    init_db()
+
+    body = sys.stdin.read() if args.input == "-" else open(args.input, "r", encoding="utf-8").read()
+    messages, concurrency = parse_body(body, "ndjson" if args.input.endswith(".ndjson") else "")
+    out = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    try:
+        for line in run_batch(messages, args.concurrency or concurrency):
+            out.write(json.dumps(line, ensure_ascii=False) + "\n")
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == "__main__":
+    main()
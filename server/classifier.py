@@ -0,0 +1,225 @@
+# 本地意图分类器：字符 n-gram 哈希特征 + TF-IDF + 类中心线性打分，纯 CPU
+import hashlib
+import json
+import os
+import threading
+import zlib
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+N_FEATURES = 1 << 12
+NGRAM_RANGE = (1, 3)
+TEMPERATURES = (0.02, 0.03, 0.05, 0.08, 0.1, 0.15, 0.2, 0.3, 0.5)
+CALIBRATION_FOLDS = 5
+CALIBRATION_MIN_HELD_OUT = 20  # 可留出的样本少于这个数时不校准，用最大温度
+
+# 字符特征看不出否定、疑问和多条指令，带这些标记的输入不由本地分类器回答
+NEGATION_MARKERS = ("不要", "不用", "不想", "不必", "先不", "别", "勿")
+QUESTION_MARKERS = ("吗", "么", "多少", "几", "是否", "如何", "?", "？")
+CONJUNCTION_MARKERS = ("和", "跟", "以及", "还有", "然后", "接着", "并且", "同时", "顺便", "再")
+
+def unsupported_reason(text: str) -> Optional[str]:
+    """输入含否定/疑问/并列标记时返回 "negation"/"question"/"conjunction"，否则 None"""
+    for reason, markers in (("negation", NEGATION_MARKERS), ("question", QUESTION_MARKERS),
+                            ("conjunction", CONJUNCTION_MARKERS)):
+        if any(m in text for m in markers):
+            return reason
+    return None
+
+def _normalize(text: str) -> str:
+    return "".join(ch for ch in text.lower() if not ch.isspace() and ch not in "，。！？、,.!?")
+
+def _features(text: str) -> Tuple[np.ndarray, np.ndarray]:
+    """返回 (特征下标, 词频)，下标用 crc32 哈希，跨进程稳定"""
+    text = _normalize(text)
+    counts: Dict[int, float] = {}
+    lo, hi = NGRAM_RANGE
+    for n in range(lo, hi + 1):
+        for i in range(len(text) - n + 1):
+            idx = zlib.crc32(text[i:i + n].encode("utf-8")) & (N_FEATURES - 1)
+            counts[idx] = counts.get(idx, 0.0) + 1.0
+    if not counts:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    return np.fromiter(counts.keys(), dtype=np.int64), np.fromiter(counts.values(), dtype=np.float32)
+
+class IntentClassifier:
+    """weights 为 (特征数, 标签数)，每列是一个标签的归一化 TF-IDF 类中心；
+    打分只需取输入中出现的几十行做一次向量-矩阵乘"""
+
+    def __init__(self, labels: List[str], weights: np.ndarray, idf: np.ndarray, temperature: float):
+        self.labels = labels
+        self.weights = weights
+        self.idf = idf
+        self.temperature = temperature
+
+    def _vector(self, text: str) -> Tuple[np.ndarray, np.ndarray]:
+        idx, tf = _features(text)
+        values = tf * self.idf[idx]
+        norm = float(np.sqrt(values @ values))
+        return idx, (values / norm if norm else values)
+
+    def scores(self, text: str) -> np.ndarray:
+        idx, values = self._vector(text)
+        if idx.size == 0:
+            return np.zeros(len(self.labels), dtype=np.float32)
+        return values @ self.weights[idx]
+
+    def predict(self, text: str) -> Tuple[Optional[str], float]:
+        """返回 (标签, 置信度)，置信度为带温度 softmax 后的最大概率"""
+        if not self.labels:
+            return None, 0.0
+        scores = self.scores(text)
+        logits = (scores - scores.max()) / self.temperature
+        probs = np.exp(logits)
+        probs /= probs.sum()
+        best = int(np.argmax(probs))
+        return self.labels[best], float(probs[best])
+
+    # ---------- 训练与持久化 ----------
+
+    @classmethod
+    def fit(cls, samples: List[Tuple[str, str]], temperature: float = 1.0) -> "IntentClassifier":
+        """按给定样本求类中心，不做温度校准"""
+        labels = sorted({label for _, label in samples})
+        label_index = {label: i for i, label in enumerate(labels)}
+
+        feats = [_features(text) for text, _ in samples]
+        df = np.zeros(N_FEATURES, dtype=np.float32)
+        for idx, _ in feats:
+            df[idx] += 1
+        idf = (np.log((1 + len(samples)) / (1 + df)) + 1).astype(np.float32)
+
+        weights = np.zeros((N_FEATURES, len(labels)), dtype=np.float32)
+        for (idx, tf), (_, label) in zip(feats, samples):
+            values = tf * idf[idx]
+            norm = float(np.sqrt(values @ values))
+            if norm:
+                weights[idx, label_index[label]] += values / norm
+        norms = np.linalg.norm(weights, axis=0, keepdims=True)
+        weights /= np.where(norms == 0, 1, norms)
+        return cls(labels, weights, idf, temperature)
+
+    @classmethod
+    def train(cls, samples: Iterable[Tuple[str, str]]) -> "IntentClassifier":
+        samples = [(text, label) for text, label in samples if _normalize(text)]
+        return cls.fit(samples, fit_temperature(samples))
+
+    def save(self, prefix: str, digest: str):
+        """保存为 <prefix>.clf.npy(权重) / .clf.idf.npy / .clf.json，权重可直接内存映射
+
+        多 worker 可能同时训练并保存同一个 prefix: 各文件先写临时文件再 os.replace，元数据最后替换，
+        读到的总是完整的文件；load 还会核对各文件形状，替换到一半时按未保存处理。
+        """
+        tmp = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        for path, array in ((f"{prefix}.clf.npy", self.weights), (f"{prefix}.clf.idf.npy", self.idf)):
+            with open(path + tmp, "wb") as f:
+                np.save(f, array)
+            os.replace(path + tmp, path)
+        with open(f"{prefix}.clf.json{tmp}", "w", encoding="utf-8") as f:
+            json.dump({
+                "labels": self.labels,
+                "temperature": self.temperature,
+                "n_features": N_FEATURES,
+                "ngram_range": list(NGRAM_RANGE),
+                "digest": digest
+            }, f, ensure_ascii=False)
+        os.replace(f"{prefix}.clf.json{tmp}", f"{prefix}.clf.json")
+
+    @classmethod
+    def load(cls, prefix: str, digest: str) -> Optional["IntentClassifier"]:
+        """训练样本摘要不一致（知识库或模块意图变了）时返回 None"""
+        meta_path = f"{prefix}.clf.json"
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("digest") != digest or meta.get("n_features") != N_FEATURES \
+                or meta.get("ngram_range") != list(NGRAM_RANGE):
+            return None
+        try:
+            weights = np.load(f"{prefix}.clf.npy", mmap_mode="r")
+            idf = np.load(f"{prefix}.clf.idf.npy")
+        except (OSError, ValueError):
+            return None
+        if weights.shape != (N_FEATURES, len(meta["labels"])) or idf.shape != (N_FEATURES,):
+            return None
+        return cls(meta["labels"], weights, idf, meta["temperature"])
+
+def fit_temperature(samples: List[Tuple[str, str]], folds: int = CALIBRATION_FOLDS) -> float:
+    """k 折留出校准温度: 每折用其余样本训练，在本折上算负对数似然，取总和最小的温度
+
+    只留出还有其他样本的标签（每个标签至少一条留在训练集里）；可留出的样本太少时用最保守的温度。
+    """
+    by_label: Dict[str, List[int]] = {}
+    for i, (_, label) in enumerate(samples):
+        by_label.setdefault(label, []).append(i)
+    fold_of: Dict[int, int] = {}
+    for indices in by_label.values():
+        for position, i in enumerate(indices[1:]):
+            fold_of[i] = (zlib.crc32(samples[i][0].encode("utf-8")) + position) % folds
+    if len(fold_of) < CALIBRATION_MIN_HELD_OUT:
+        return TEMPERATURES[-1]
+
+    nll = np.zeros(len(TEMPERATURES))
+    for fold in range(folds):
+        held_out = [i for i, f in fold_of.items() if f == fold]
+        if not held_out:
+            continue
+        held = set(held_out)
+        clf = IntentClassifier.fit([sample for i, sample in enumerate(samples) if i not in held])
+        label_index = {label: j for j, label in enumerate(clf.labels)}
+        matrix = np.stack([clf.scores(samples[i][0]) for i in held_out])
+        targets = np.array([label_index[samples[i][1]] for i in held_out])
+        for k, t in enumerate(TEMPERATURES):
+            logits = (matrix - matrix.max(axis=1, keepdims=True)) / t
+            log_probs = logits - np.log(np.exp(logits).sum(axis=1, keepdims=True))
+            nll[k] -= float(log_probs[np.arange(len(targets)), targets].sum())
+    return TEMPERATURES[int(np.argmin(nll))]
+
+def build_samples(kb: Dict) -> List[Tuple[str, str]]:
+    """训练样本: 各模块 INTENTS 名称本身 + 知识库 query
+
+    标签形如 "AC:打开空调"；知识库中对不上模块意图的条目标为 "KB:<intent>"，
+    这样命中不支持的意图时不会被误判成某个模块意图。
+    """
+    from agents.modules import ACAgent, NavAgent, MediaAgent, SeatAgent, WindowAgent, LightAgent
+
+    samples = []
+    intent_labels: Dict[str, str] = {}
+    for agent_cls in (ACAgent, NavAgent, MediaAgent, SeatAgent, WindowAgent, LightAgent):
+        module = agent_cls.agent_key()
+        for intent in agent_cls.INTENTS:
+            label = f"{module}:{intent}"
+            intent_labels.setdefault(intent, label)
+            samples.append((intent, label))
+
+    for item in kb.get("intents", []):
+        query = item.get("query", "")
+        intent = item.get("intent", "")
+        label = intent_labels.get(intent) or intent_labels.get(item.get("feature", "")) or f"KB:{intent}"
+        if query:
+            samples.append((query, label))
+    return samples
+
+def _digest(samples: List[Tuple[str, str]]) -> str:
+    return hashlib.sha1(json.dumps(samples, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+_lock = threading.Lock()
+_active: Optional[IntentClassifier] = None
+
+def get_classifier() -> Optional[IntentClassifier]:
+    return _active
+
+def activate(kb: Dict, prefix: str) -> IntentClassifier:
+    """加载 prefix 处持久化的分类器（内存映射，通常放在知识库版本对象旁边），不存在或已过期时重新训练并保存"""
+    global _active
+    samples = build_samples(kb)
+    digest = _digest(samples)
+    with _lock:
+        clf = IntentClassifier.load(prefix, digest)
+        if clf is None:
+            clf = IntentClassifier.train(samples)
+            clf.save(prefix, digest)
+        _active = clf
+        return clf
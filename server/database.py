@@ -1,11 +1,20 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, JSON
+from sqlalchemy import create_engine, event, Column, Integer, String, Text, DateTime, JSON, Boolean
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime
 
 DATABASE_URL = "sqlite:///./car_bot.db"
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False, "timeout": 15})
+
+@event.listens_for(engine, "connect")
+def _sqlite_pragmas(dbapi_conn, _):
+    # WAL: 多个 worker 同时写日志时读不阻塞写，拿不到写锁时最多等 timeout 秒
+    cursor = dbapi_conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
@@ -32,5 +41,36 @@ class ChatLog(Base):
     latency_ms = Column(Integer)
     token_usage = Column(JSON) # {input_tokens: x, output_tokens: y}
 
+class ChatTrace(Base):
+    __tablename__ = "chat_traces"
+
+    # 与 ChatLog 一一对应，单独建表以免改动已有 chat_logs 表结构
+    log_id = Column(Integer, primary_key=True)
+    trace_id = Column(String(32), index=True)
+    spans = Column(Text)  # 紧凑 JSON: [[name, parent, start_ms, duration_ms, attrs, status], ...]
+
+class ShadowResult(Base):
+    __tablename__ = "shadow_results"
+
+    # 影子流量: 一条抽样请求在候选配置下重跑的结果及与主流程的差异
+    id = Column(Integer, primary_key=True, index=True)
+    timestamp = Column(DateTime, default=datetime.utcnow)
+    log_id = Column(Integer, index=True)  # 主流程的 chat_logs.id
+    candidate = Column(String(64), index=True)  # 候选配置名
+    user_input = Column(Text, nullable=False)
+
+    intent_match = Column(Boolean)  # 指令条数、各条模块和意图都一致
+    params_match = Column(Boolean)
+    action_match = Column(Boolean)
+    reply_match = Column(Boolean)
+    diff = Column(Text)  # JSON: 不一致的字段 [{"index", "field", "primary", "shadow"}]
+    error = Column(Text)  # 候选流程报错时的错误信息
+
+    primary_cached = Column(Boolean)  # 主流程没有消耗 token（结果缓存或本地分类器），延迟不可比
+    primary_latency_ms = Column(Integer)
+    shadow_latency_ms = Column(Integer)
+    primary_tokens = Column(Integer)
+    shadow_tokens = Column(Integer)
+
 def init_db():
     Base.metadata.create_all(bind=engine)
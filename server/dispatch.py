@@ -0,0 +1,318 @@
+# 动作下发：每辆车一条有序队列，结果一产生就入队，未发出的过时动作合并掉，交给可替换的下发端（默认本地模拟总线）
+#
+#   DISPATCH_SINK=sim              本地模拟 CAN 总线（默认）
+#   DISPATCH_SINK=off              不下发
+#   DISPATCH_SINK=package.mod:Cls  自定义下发端，继承 ActionSink 并实现 send(vehicle_id, item) -> dict
+import importlib
+import itertools
+import os
+import random
+import struct
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Deque, Dict, Optional
+
+from metrics import Counter, Histogram
+from vehicle_state import EFFECTS, BOUNDS, ABSOLUTE, ALL_POSITIONS, NOOP_ACTION, effect, vehicle_states
+
+DISPATCH_SINK = os.getenv("DISPATCH_SINK", "sim")
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", "4"))
+DISPATCH_RETRIES = int(os.getenv("DISPATCH_RETRIES", "2"))
+DISPATCH_HISTORY = int(os.getenv("DISPATCH_HISTORY", "50"))  # 每辆车保留最近多少条下发记录
+DISPATCH_MAX_VEHICLES = int(os.getenv("DISPATCH_MAX_VEHICLES", "10000"))
+BUS_LATENCY_MS = float(os.getenv("BUS_LATENCY_MS", "2"))
+BUS_DROP_RATE = float(os.getenv("BUS_DROP_RATE", "0"))
+
+DISPATCH_SECONDS = Histogram("car_bot_dispatch_duration_seconds",
+                             "Action dispatch latency (queue: enqueue→send, bus: send→ack, actuation: request→ack)",
+                             ["stage"])
+DISPATCH_EVENTS = Counter("car_bot_dispatch_events_total", "Dispatched, coalesced and failed actions", ["event"])
+
+# 相对调节的动作码: (状态键, 是否调高) -> (动作码, 单步幅度)
+DELTA_ACTIONS = {(key, value > 0): (action, abs(value))
+                 for action, (key, kind, value) in EFFECTS.items() if kind == "delta"}
+
+class DispatchItem:
+    __slots__ = ("seq", "vehicle_id", "trace_id", "index", "module", "action", "params", "repeat",
+                 "status", "enqueued_at", "received_ns", "enqueued_ns", "sent_ns", "acked_ns", "attempts", "ack")
+
+    def __init__(self, seq: int, vehicle_id: str, result: Dict[str, Any],
+                 received_ns: Optional[int] = None, trace_id: Optional[str] = None):
+        self.seq = seq
+        self.vehicle_id = vehicle_id
+        self.trace_id = trace_id
+        self.index = result.get("index")
+        self.module = result.get("module", "")
+        self.action = result.get("action", "")
+        self.params = dict(result.get("params") or {})
+        self.repeat = 1  # 合并后的连续相对调节，如两次 TEMP_UP 发一条 repeat=2
+        self.status = "queued"
+        self.enqueued_at = time.time()
+        self.enqueued_ns = time.perf_counter_ns()
+        self.received_ns = received_ns if received_ns is not None else self.enqueued_ns
+        self.sent_ns: Optional[int] = None
+        self.acked_ns: Optional[int] = None
+        self.attempts = 0
+        self.ack: Optional[Dict[str, Any]] = None
+
+    def effect(self):
+        return effect(self.action, self.params)
+
+    def key(self) -> Optional[str]:
+        eff = self.effect()
+        return eff[0] if eff is not None else None
+
+    def to_dict(self) -> Dict[str, Any]:
+        ms = lambda a, b: round((b - a) / 1e6, 2) if a is not None and b is not None else None
+        return {
+            "seq": self.seq,
+            "trace_id": self.trace_id,
+            "index": self.index,
+            "module": self.module,
+            "action": self.action,
+            "params": self.params,
+            "repeat": self.repeat,
+            "status": self.status,
+            "enqueued_at": self.enqueued_at,
+            "attempts": self.attempts,
+            "queue_ms": ms(self.enqueued_ns, self.sent_ns),
+            "bus_ms": ms(self.sent_ns, self.acked_ns),
+            "actuation_ms": ms(self.received_ns, self.acked_ns),
+            "ack": self.ack
+        }
+
+# ---------- 下发端 ----------
+
+class ActionSink(ABC):
+    """下发端接口：send 成功返回确认信息，失败抛异常（由队列按 DISPATCH_RETRIES 重试）"""
+
+    @abstractmethod
+    def send(self, vehicle_id: str, item: DispatchItem) -> Dict[str, Any]:
+        ...
+
+class SimulatedBus(ActionSink):
+    """本地模拟的车身 CAN 总线：模块映射到报文 ID，8 字节负载，模拟传输延迟和丢帧"""
+    MODULE_IDS = {"AC": 0x3A0, "SEAT": 0x3B0, "WINDOW": 0x3C0, "LIGHT": 0x3D0, "NAV": 0x4C0, "MEDIA": 0x4D0}
+    DEFAULT_ID = 0x4F0
+
+    def __init__(self, latency_ms: float = BUS_LATENCY_MS, drop_rate: float = BUS_DROP_RATE):
+        self.latency_ms = latency_ms
+        self.drop_rate = drop_rate
+        self._seq = itertools.count()
+
+    def encode(self, item: DispatchItem) -> str:
+        """报文: 动作码 CRC16 | 取值(有符号 16 位) | 重复次数 | 位置 | 序号 | 保留"""
+        eff = item.effect()
+        value = eff[2] if eff is not None and isinstance(eff[2], int) else 0
+        position = zlib.crc32(str(item.params.get("position", "")).encode("utf-8")) & 0xFF
+        payload = struct.pack(">HhBBBB", zlib.crc32(item.action.encode("utf-8")) & 0xFFFF,
+                              max(-32768, min(32767, value)), min(item.repeat, 255), position,
+                              next(self._seq) & 0xFF, 0)
+        return f"{self.MODULE_IDS.get(item.module, self.DEFAULT_ID):03X}#{payload.hex().upper()}"
+
+    def send(self, vehicle_id: str, item: DispatchItem) -> Dict[str, Any]:
+        frame = self.encode(item)
+        time.sleep(max(0.0, random.gauss(self.latency_ms, self.latency_ms / 4)) / 1000)
+        if self.drop_rate and random.random() < self.drop_rate:
+            raise TimeoutError(f"no ack for frame {frame}")
+        return {"frame": frame}
+
+def load_sink(spec: str = DISPATCH_SINK) -> Optional[ActionSink]:
+    if spec in ("", "off", "none"):
+        return None
+    if spec == "sim":
+        return SimulatedBus()
+    module, _, name = spec.partition(":")
+    return getattr(importlib.import_module(module), name)()
+
+# ---------- 队列 ----------
+
+def _supersedes(new_key: str, old_key: str) -> bool:
+    """new_key 的绝对设置会让 old_key 上尚未发出的动作失效，"全部" 位置覆盖单个位置"""
+    if new_key == old_key:
+        return True
+    prefix, _, position = new_key.partition(":")
+    return position == ALL_POSITIONS and old_key.startswith(prefix + ":")
+
+class _Lane:
+    __slots__ = ("pending", "history", "draining", "lock")
+
+    def __init__(self):
+        self.pending: Deque[DispatchItem] = deque()
+        self.history: Deque[DispatchItem] = deque(maxlen=DISPATCH_HISTORY)
+        self.draining = False
+        self.lock = threading.Lock()
+
+class Dispatcher:
+    """每辆车一条队列，同一辆车的动作按入队顺序串行下发，不同车辆并行"""
+
+    def __init__(self, sink: Optional[ActionSink] = None, workers: int = DISPATCH_WORKERS):
+        self.sink = sink
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dispatch")
+        self._lanes: "OrderedDict[str, _Lane]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._seq = itertools.count(1)
+        self._stats_lock = threading.Lock()  # 各车道的 worker 线程并发计数
+        self.stats = {"enqueued": 0, "coalesced": 0, "superseded": 0, "acked": 0, "failed": 0, "skipped": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.sink is not None
+
+    def _lane(self, vehicle_id: str) -> _Lane:
+        with self._lock:
+            lane = self._lanes.get(vehicle_id)
+            if lane is None:
+                lane = self._lanes[vehicle_id] = _Lane()
+                # 淘汰最久没用且已经空闲的队列
+                for other in list(self._lanes):
+                    if len(self._lanes) <= DISPATCH_MAX_VEHICLES:
+                        break
+                    idle = self._lanes[other]
+                    if other != vehicle_id and not idle.pending and not idle.draining:
+                        del self._lanes[other]
+            self._lanes.move_to_end(vehicle_id)
+            return lane
+
+    def _count(self, event: str, amount: int = 1):
+        with self._stats_lock:
+            self.stats[event] += amount
+        DISPATCH_EVENTS.inc(amount, event=event)
+
+    def submit(self, vehicle_id: Optional[str], result: Dict[str, Any], received_ns: Optional[int] = None,
+               trace_id: Optional[str] = None) -> Optional[DispatchItem]:
+        """一条执行结果入队；无车辆、NOOP 或无动作时不下发"""
+        action = result.get("action") or ""
+        if not self.enabled or not vehicle_id:
+            return None
+        if action in ("", NOOP_ACTION, "UNKNOWN"):
+            self._count("skipped")
+            return None
+        item = DispatchItem(next(self._seq), vehicle_id, result, received_ns, trace_id)
+        lane = self._lane(vehicle_id)
+        with lane.lock:
+            item = self._coalesce(lane, item)
+            if item is not None and not lane.draining:
+                lane.draining = True
+                self._pool.submit(self._drain, lane)
+        return item
+
+    def _coalesce(self, lane: _Lane, item: DispatchItem) -> Optional[DispatchItem]:
+        """与队列里还没发出的同一状态的动作合并；返回实际入队的条目（被合并进已有条目时返回那一条）"""
+        eff = item.effect()
+        if eff is not None:
+            key, kind, value, _ = eff
+            if kind == "set":
+                # 绝对设置: 之前未发出的同一状态的动作都作废
+                for old in [o for o in lane.pending if o.key() and _supersedes(key, o.key())]:
+                    lane.pending.remove(old)
+                    old.status = "superseded"
+                    lane.history.append(old)
+                    self._count("superseded")
+            else:
+                last = next((o for o in reversed(lane.pending) if o.key() == key), None)
+                if last is not None and self._merge_delta(lane, last, key, value):
+                    item.status = "coalesced"
+                    lane.history.append(item)
+                    self._count("coalesced")
+                    return last if last.status == "queued" else None
+        lane.pending.append(item)
+        self._count("enqueued")
+        return item
+
+    def _merge_delta(self, lane: _Lane, last: DispatchItem, key: str, delta: int) -> bool:
+        """相对调节并入同一状态上一条未发出的动作: 绝对设置直接改目标值，相对调节累加步数"""
+        _, kind, value, _ = last.effect()
+        if kind == "set":
+            if key not in BOUNDS or not isinstance(value, int):
+                return False
+            low, high = BOUNDS[key]
+            last.action = f"{ABSOLUTE[key]}_{min(high, max(low, value + delta))}"
+            return True
+        total = value * last.repeat + delta
+        if total == 0:
+            # 一升一降相互抵消
+            lane.pending.remove(last)
+            last.status = "cancelled"
+            lane.history.append(last)
+            return True
+        action, step = DELTA_ACTIONS[(key, total > 0)]
+        if abs(total) % step:
+            return False
+        last.action, last.repeat = action, abs(total) // step
+        return True
+
+    def _drain(self, lane: _Lane):
+        while True:
+            with lane.lock:
+                if not lane.pending:
+                    lane.draining = False
+                    return
+                item = lane.pending.popleft()
+                item.status = "sending"
+            item.sent_ns = time.perf_counter_ns()
+            for attempt in range(DISPATCH_RETRIES + 1):
+                item.attempts = attempt + 1
+                try:
+                    item.ack = self.sink.send(item.vehicle_id, item)
+                    item.status = "acked"
+                    break
+                except Exception as e:
+                    item.ack = {"error": str(e)}
+                    item.status = "failed"
+            item.acked_ns = time.perf_counter_ns()
+            with lane.lock:
+                lane.history.append(item)
+            if item.status == "acked":
+                self._count("acked")
+                DISPATCH_SECONDS.observe((item.sent_ns - item.enqueued_ns) / 1e9, stage="queue")
+                DISPATCH_SECONDS.observe((item.acked_ns - item.sent_ns) / 1e9, stage="bus")
+                DISPATCH_SECONDS.observe((item.acked_ns - item.received_ns) / 1e9, stage="actuation")
+            else:
+                self._count("failed")
+                # 车辆状态在执行时已按下发成功更新，重试用尽后作废这个键，避免之后据此误判 NOOP
+                key = item.key()
+                if key is not None:
+                    vehicle_states.invalidate(item.vehicle_id, [key])
+
+    def recent(self, vehicle_id: str) -> Dict[str, Any]:
+        """最近的下发记录（含合并掉的）和仍在排队的动作"""
+        with self._lock:
+            lane = self._lanes.get(vehicle_id)
+        if lane is None:
+            return {"vehicle_id": vehicle_id, "pending": [], "history": []}
+        with lane.lock:
+            return {
+                "vehicle_id": vehicle_id,
+                "pending": [item.to_dict() for item in lane.pending],
+                "history": [item.to_dict() for item in reversed(lane.history)]
+            }
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """等待所有队列清空（命令行批量跑完后、测试用）"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                lanes = list(self._lanes.values())
+            if all(not lane.pending and not lane.draining for lane in lanes):
+                return True
+            time.sleep(0.005)
+        return False
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lanes = list(self._lanes.values())
+        with self._stats_lock:
+            stats = dict(self.stats)
+        return {
+            **stats,
+            "sink": type(self.sink).__name__ if self.sink else None,
+            "vehicles": len(lanes),
+            "pending": sum(len(lane.pending) for lane in lanes)
+        }
+
+dispatcher = Dispatcher(load_sink())
@@ -1,4 +1,10 @@
 from .state import AgentState, Command, Result
-from .workflow import workflow
+from .workflow import get_workflow
 
-__all__ = ["AgentState", "Command", "Result", "workflow"]
+__all__ = ["AgentState", "Command", "Result", "get_workflow"]
+
+def __getattr__(name):
+    # workflow 按需编译，见 workflow.get_workflow
+    if name == "workflow":
+        return get_workflow()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
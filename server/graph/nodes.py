@@ -1,7 +1,15 @@
-from typing import Dict, Any
+import os
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
 from .state import AgentState
+from metrics import timed_node, CACHE_EVENTS
+from tracing import traced, span, annotate
 from agents import RouterAgent, ExecutorAgent, SummarizerAgent
+from agents.base import BaseAgent
 from agents.modules import ACAgent, NavAgent, MediaAgent, SeatAgent, WindowAgent, LightAgent
+from vehicle_state import VehicleState, vehicle_states, merge_commands, intent_effect, NOOP_ACTION
 
 # 初始化 Agents
 router_agent = RouterAgent()
@@ -17,45 +25,203 @@ module_agents = {
     "LIGHT": LightAgent()
 }
 
+def warm_prompts():
+    """预先构建所有 Agent 的系统提示词（启动预热时调用）"""
+    for agent in [router_agent, executor_agent, summarizer_agent, *module_agents.values()]:
+        agent.system_prompt()
+
+# 推测解析: 路由识别进行中，按关键词猜测模块并提前解析整句
+SPECULATIVE_PARSE = os.getenv("SPECULATIVE_PARSE", "1") == "1"
+_speculative_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="speculative")
+_speculative_lock = threading.Lock()
+# cancelled: 还在排队就被放弃，没有调用模型；wasted: 已经在跑（线程无法中断，会跑完并消耗 token）或出错，结果没用上
+speculative_stats = {"launched": 0, "hits": 0, "cancelled": 0, "wasted": 0}
+
+# 流式拆分: 路由每输出完一条指令就开始解析它（逐条解析，不再同模块合批，换取与路由输出重叠）
+ROUTER_STREAM = os.getenv("ROUTER_STREAM", "0") == "1"
+
+def _count_speculation(key: str):
+    with _speculative_lock:
+        speculative_stats[key] += 1
+    if key == "hits":
+        CACHE_EVENTS.inc(cache="speculative", result="hit")
+    elif key in ("cancelled", "wasted"):
+        CACHE_EVENTS.inc(cache="speculative", result=key)
+
+def _discard(future) -> str:
+    """放弃推测解析: 只有还没开始的能真正取消，已在运行的任其跑完，记为浪费"""
+    outcome = "cancelled" if future.cancel() else "wasted"
+    _count_speculation(outcome)
+    return outcome
+
+def get_speculative_stats() -> Dict[str, Any]:
+    with _speculative_lock:
+        stats = dict(speculative_stats)
+    stats["hit_ratio"] = round(stats["hits"] / stats["launched"], 4) if stats["launched"] else 0.0
+    return stats
+
+@timed_node("split_node")
+@traced("split")
 def split_node(state: AgentState) -> AgentState:
     """拆分多指令"""
-    commands = router_agent.recognize(state["message"])
-    state["commands"] = commands
     state["results"] = []
     state["current_index"] = 0
+    state["planned"] = []
+    if state["commands"]:
+        # 会话追问已在本地解析成指令，跳过路由
+        annotate(preset=True, commands=len(state["commands"]))
+        return state
+
+    message = state["message"]
+    guess = RouterAgent.guess_module(message) if BaseAgent.setting("speculative_parse", SPECULATIVE_PARSE) else None
+    future = None
+    if guess in module_agents:
+        future = _speculative_pool.submit(contextvars.copy_context().run, module_agents[guess].parse, message)
+        _count_speculation("launched")
+
+    early = {}
+    try:
+        if BaseAgent.setting("router_stream", ROUTER_STREAM):
+            commands, early = _recognize_streaming(message, guess)
+        else:
+            commands = router_agent.recognize(message)
+    except Exception:
+        if future is not None:
+            _discard(future)
+        raise
+
+    state["speculative"] = {}
+    state["speculative_index"] = None
+    if future is not None:
+        # 仅当路由确认为同模块的单条指令时采用推测结果
+        if len(commands) == 1 and commands[0].get("module") == guess:
+            try:
+                state["speculative"][commands[0]["index"]] = future.result()
+                state["speculative_index"] = commands[0]["index"]  # 真正用上时（process 阶段）才算命中
+                annotate(speculative="hit")
+            except Exception:
+                _count_speculation("wasted")
+                annotate(speculative="error")
+        else:
+            annotate(speculative=_discard(future))
+    for index, early_future in early.items():
+        try:
+            state["speculative"][index] = early_future.result()
+        except Exception:
+            pass  # process 阶段会重新解析
+    annotate(guess=guess or "", commands=len(commands), streamed=len(early))
+
+    state["commands"] = _merge(commands, state["speculative"]) if len(commands) > 1 else commands
     return state
 
+def _recognize_streaming(message: str, guess: Optional[str]):
+    """边接收路由的流式输出边提交各条指令的模块解析，返回 (commands, index -> Future)"""
+    commands, early = [], {}
+    for cmd in router_agent.recognize_stream(message):
+        commands.append(cmd)
+        agent = module_agents.get(cmd["module"])
+        # 整句推测解析已覆盖的那条不再重复提交
+        if agent is not None and not (cmd["module"] == guess and cmd["text"] == message):
+            early[cmd["index"]] = _speculative_pool.submit(contextvars.copy_context().run, agent.parse, cmd["text"])
+    return commands, early
+
+def _merge(commands, speculative: Dict[int, Dict[str, Any]]):
+    """执行前合并同句内重复/冲突的指令，不额外调用 LLM
+
+    只用模型解析出的意图判断冲突（本地分类器和降级匹配的结果带 local 标记，不参与），
+    其余指令只按文本判重，宁可多执行一条也不丢掉用户要的指令。
+    """
+    parsed = {index: result for index, result in speculative.items()
+              if isinstance(result, dict) and not result.get("local")}
+    kept, dropped = merge_commands(commands, parsed)
+    if dropped:
+        CACHE_EVENTS.inc(len(dropped), cache="vehicle_state", result="merged")
+        annotate(merged=[cmd["text"] for cmd in dropped])
+    return kept
+
+@timed_node("process_node")
+@traced("process")
 def process_node(state: AgentState) -> AgentState:
-    """处理单条指令"""
-    idx = state["current_index"]
-    cmd = state["commands"][idx]
-    
-    module = cmd["module"]
-    text = cmd["text"]
-    
-    # 调用对应模块Agent解析意图
+    """处理下一组同模块指令（一次模块解析调用 + 一次执行器调用）"""
+    done = {r["index"] for r in state["results"]}
+    pending = [cmd for cmd in state["commands"] if cmd["index"] not in done]
+    module = pending[0]["module"]
+    group = [cmd for cmd in pending if cmd["module"] == module]
+
+    if state.get("speculative_index") in {cmd["index"] for cmd in group}:
+        state["speculative_used"] = True
+        _count_speculation("hits")
+
+    vehicle = vehicle_states.get(state.get("vehicle_id"))
+    for result, planned in run_commands(module, group, state.get("speculative", {}), vehicle):
+        state["results"].append(result)
+        if planned:
+            state["planned"].append(result["index"])
+    state["results"].sort(key=lambda r: r["index"])
+    state["current_index"] += len(group)
+    return state
+
+def run_commands(module: str, commands: List[Dict[str, Any]],
+                 speculative: Optional[Dict[int, Dict[str, Any]]] = None,
+                 vehicle: Optional[VehicleState] = None,
+                 executed: Optional[Dict[int, Dict[str, Any]]] = None) -> List[Tuple[Dict[str, Any], bool]]:
+    """解析并执行同一模块的一组指令，按输入顺序返回 [(结果, 是否直接由车辆状态给出)]
+
+    executed 为已预先生成的执行结果（index -> action/reply），车辆状态没有直接给出结果时使用，不再调用执行器。
+    """
+    speculative = speculative or {}
+    executed = executed or {}
+    annotate(module=module, index=[cmd["index"] for cmd in commands], text=[cmd["text"] for cmd in commands])
+
+    # 调用对应模块Agent解析意图，推测解析已给出的跳过
     agent = module_agents.get(module)
-    if agent:
-        parsed = agent.parse(text)
-        intent = parsed.get("intent", "未知")
-        params = parsed.get("params", {})
-    else:
-        intent = "未知"
-        params = {}
-    
+    parsed = [speculative.get(cmd["index"]) for cmd in commands]
+    pending = [i for i, p in enumerate(parsed) if p is None]
+    with span("parse", module=module, commands=len(commands), speculative=len(commands) - len(pending)):
+        if agent and pending:
+            for i, p in zip(pending, agent.parse_many([commands[i]["text"] for i in pending])):
+                parsed[i] = p
+    intents = [(p.get("intent", "未知"), p.get("params", {})) if agent and p else ("未知", {}) for p in parsed]
+
+    # 车辆状态已知时，已满足的指令和相对调节不需要执行器；
+    # 同组里前面还要交给执行器的状态键，后面的指令不能再按旧状态短路
+    outputs: List[Optional[Dict[str, Any]]] = [None] * len(commands)
+    blocked = set()
+    for i, (intent, params) in enumerate(intents):
+        _, eff = intent_effect(module, intent, params)
+        key = eff[0] if eff is not None else None
+        planned = vehicle.plan(module, intent, params) if vehicle is not None and key not in blocked else None
+        if planned is None:
+            if key is not None:
+                blocked.add(key)
+            continue
+        outcome = "noop" if planned["action"] == NOOP_ACTION else "resolved"
+        CACHE_EVENTS.inc(cache="vehicle_state", result=outcome)
+        annotate(vehicle_state=outcome)
+        outputs[i] = planned  # plan 已把相对调节记入状态，NOOP 不改变状态
+
     # 调用执行器生成动作和回复
-    result = executor_agent.execute(module, intent, params)
-    
-    state["results"].append({
+    to_execute = [i for i, output in enumerate(outputs) if output is None]
+    for i in to_execute:
+        outputs[i] = executed.get(commands[i]["index"])
+    fresh = [i for i in to_execute if outputs[i] is None]
+    if fresh:
+        with span("execute", module=module, intents=[intents[i][0] for i in fresh]):
+            results = executor_agent.execute_many([(module,) + intents[i] for i in fresh])
+        for i, result in zip(fresh, results):
+            outputs[i] = result
+    if vehicle is not None:
+        for i in to_execute:
+            vehicle.apply(outputs[i].get("action", "UNKNOWN"), intents[i][1])
+
+    return [({
         "index": cmd["index"],
         "module": module,
         "intent": intent,
         "params": params,
-        "action": result.get("action", "UNKNOWN"),
-        "reply": result.get("reply", "操作完成")
-    })
-    state["current_index"] += 1
-    return state
+        "action": output.get("action", "UNKNOWN"),
+        "reply": output.get("reply", "操作完成")
+    }, i not in to_execute) for i, (cmd, (intent, params), output) in enumerate(zip(commands, intents, outputs))]
 
 def should_continue(state: AgentState) -> str:
     """判断是否继续处理"""
@@ -63,7 +229,10 @@ def should_continue(state: AgentState) -> str:
         return "process"
     return "summarize"
 
+@timed_node("summarize_node")
+@traced("summarize")
 def summarize_node(state: AgentState) -> AgentState:
     """合并回复"""
-    state["summary"] = summarizer_agent.summarize(state["results"])
+    state["summary"] = summarizer_agent.summarize(state["results"], state.get("planned", []),
+                                                  state.get("quality", False))
     return state
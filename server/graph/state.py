@@ -20,3 +20,9 @@ class AgentState(TypedDict):
     results: List[Result]
     summary: str
     current_index: int
+    speculative: Dict[int, Dict[str, Any]]  # index -> 预先解析的模块结果
+    speculative_index: Optional[int]  # 整句推测解析命中的指令 index
+    speculative_used: bool  # process 阶段实际用上了整句推测解析的结果
+    vehicle_id: Optional[str]  # 有车辆 ID 时按车辆状态短路已满足/相对调节的指令
+    planned: List[int]  # 直接由车辆状态给出结果的指令 index
+    quality: bool  # 多条回复交给模型润色，默认本地合并
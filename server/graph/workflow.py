@@ -1,9 +1,12 @@
-from langgraph.graph import StateGraph, END
+import threading
+
 from .state import AgentState
 from .nodes import split_node, process_node, should_continue, summarize_node
 
 def create_workflow():
     """创建 LangGraph 工作流"""
+    from langgraph.graph import StateGraph, END  # langgraph 导入较慢，用到时才加载
+
     graph = StateGraph(AgentState)
     
     # 添加节点
@@ -31,5 +34,20 @@ def create_workflow():
     
     return graph.compile()
 
-# 编译工作流
-workflow = create_workflow()
+# 编译好的工作流在首次使用（或启动预热）时创建，导入本模块不再触发编译
+_workflow = None
+_lock = threading.Lock()
+
+def get_workflow():
+    global _workflow
+    if _workflow is None:
+        with _lock:
+            if _workflow is None:
+                _workflow = create_workflow()
+    return _workflow
+
+def __getattr__(name):
+    # 兼容旧的 `from graph.workflow import workflow`
+    if name == "workflow":
+        return get_workflow()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,163 @@
+# 两段式识别/执行的交接：/chat/recognize 返回句柄并在后台预先解析、生成执行结果，/chat/execute 凭句柄直接取用
+import contextvars
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from metrics import CACHE_EVENTS
+
+HANDOFF = os.getenv("HANDOFF", "1") == "1"
+HANDOFF_TTL_S = float(os.getenv("HANDOFF_TTL_S", "60"))  # 识别后这么久没有确认执行就丢弃
+HANDOFF_MAX = int(os.getenv("HANDOFF_MAX", "1000"))
+HANDOFF_WORKERS = int(os.getenv("HANDOFF_WORKERS", "8"))
+
+_pool = ThreadPoolExecutor(max_workers=HANDOFF_WORKERS, thread_name_prefix="handoff")
+
+def _precompute(module: str, group: List[Dict[str, Any]], budget_s: float
+                ) -> Tuple[List[Dict[str, Any]], Dict[str, int]]:
+    """不带车辆状态地解析并执行一组同模块指令，返回 (结果, token 用量)；车辆状态和下发留到确认执行时再做"""
+    from agents.base import BaseAgent
+    from graph.nodes import run_commands
+
+    BaseAgent.reset_tokens()
+    BaseAgent.set_request_budget(budget_s)
+    results = [result for result, _ in run_commands(module, group)]
+    if BaseAgent.get_degraded():
+        # 熔断时的本地降级结果不留给确认执行用，到时候模型可能已经恢复
+        raise RuntimeError("precomputed in degraded mode")
+    return results, BaseAgent.get_tokens()
+
+class Handoff:
+    """一次识别的预执行结果，按 (模块, 指令原文) 查找，确认时改过的指令查不到，照常重新计算"""
+    __slots__ = ("handle", "created", "_entries")
+
+    def __init__(self, handle: str):
+        self.handle = handle
+        self.created = time.monotonic()
+        self._entries: Dict[Tuple[str, str], Tuple[Future, int]] = {}  # (模块, 原文) -> (所在组的 Future, 组内位置)
+
+    def start(self, commands: List[Dict[str, Any]], budget_s: float, on_done: Optional[Callable[[], None]] = None):
+        """on_done 在所有组都结束（含被取消）后调用一次，用来归还准入名额"""
+        modules = list(dict.fromkeys(cmd["module"] for cmd in commands))
+        remaining = [len(modules)]
+        lock = threading.Lock()
+
+        def finished(_):
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last and on_done is not None:
+                on_done()
+
+        for module in modules:
+            group = [cmd for cmd in commands if cmd["module"] == module]
+            future = _pool.submit(contextvars.copy_context().run, _precompute, module, group, budget_s)
+            future.add_done_callback(finished)
+            for position, cmd in enumerate(group):
+                self._entries.setdefault((module, cmd["text"]), (future, position))
+
+    def cancel(self) -> int:
+        """丢弃句柄时取消还没开始的组，返回取消的组数；已在运行的无法中断，会跑完"""
+        futures = {future for future, _ in self._entries.values()}
+        return sum(1 for future in futures if future.cancel())
+
+    def expired(self, now: float) -> bool:
+        return now - self.created > HANDOFF_TTL_S
+
+    def lookup(self, commands: List[Dict[str, Any]], timeout: Optional[float] = None
+               ) -> Tuple[Dict[int, Dict[str, Any]], Dict[int, Dict[str, Any]]]:
+        """确认执行的一组指令 -> (index -> 解析结果, index -> 执行结果)；还在算的等它，失败的不给（重新计算）
+
+        用上的组的 token 用量计入当前请求（每组一次）。
+        """
+        from agents.base import BaseAgent
+
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        parsed: Dict[int, Dict[str, Any]] = {}
+        executed: Dict[int, Dict[str, Any]] = {}
+        charged = set()
+        for cmd in commands:
+            entry = self._entries.get((cmd["module"], cmd["text"]))
+            if entry is None:
+                CACHE_EVENTS.inc(cache="handoff", result="changed")
+                continue
+            future, position = entry
+            ready = future.done()
+            try:
+                remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+                results, usage = future.result(timeout=remaining)
+            except Exception:
+                CACHE_EVENTS.inc(cache="handoff", result="failed")
+                continue
+            if future not in charged:
+                charged.add(future)
+                BaseAgent.add_tokens(usage)
+            result = results[position]
+            CACHE_EVENTS.inc(cache="handoff", result="hit" if ready else "awaited")
+            parsed[cmd["index"]] = {"intent": result["intent"], "params": result["params"]}
+            executed[cmd["index"]] = {"action": result["action"], "reply": result["reply"]}
+        return parsed, executed
+
+class HandoffStore:
+    """进程内的句柄表；多 worker 时确认请求落到别的 worker 只是取不到，照常计算"""
+
+    def __init__(self):
+        self._handoffs: Dict[str, Handoff] = {}
+        self._lock = threading.Lock()
+        self.stats = {"created": 0, "used": 0, "expired": 0, "missing": 0, "skipped": 0, "cancelled": 0}
+
+    def _discard(self, handoff: Handoff):
+        self.stats["expired"] += 1
+        self.stats["cancelled"] += handoff.cancel()
+
+    def _sweep(self, now: float):
+        expired = [h for h, handoff in self._handoffs.items() if handoff.expired(now)]
+        for handle in expired:
+            self._discard(self._handoffs.pop(handle))
+        while len(self._handoffs) >= HANDOFF_MAX:
+            self._discard(self._handoffs.pop(next(iter(self._handoffs))))
+
+    def enabled(self, commands: List[Dict[str, Any]]) -> bool:
+        return HANDOFF and bool(commands)
+
+    def skip(self):
+        """准入已满，这次识别不预执行"""
+        with self._lock:
+            self.stats["skipped"] += 1
+
+    def create(self, commands: List[Dict[str, Any]], budget_s: float,
+               on_done: Optional[Callable[[], None]] = None) -> Optional[str]:
+        """开始预执行并返回句柄；on_done 在预执行全部结束后调用（未开始预执行时不调用）"""
+        if not self.enabled(commands):
+            return None
+        handoff = Handoff(secrets.token_urlsafe(12))
+        with self._lock:
+            self._sweep(time.monotonic())
+            self._handoffs[handoff.handle] = handoff
+            self.stats["created"] += 1
+        handoff.start(commands, budget_s, on_done)
+        return handoff.handle
+
+    def take(self, handle: Optional[str]) -> Optional[Handoff]:
+        """取出句柄（只能用一次）；不存在或已过期时返回 None"""
+        if not handle:
+            return None
+        with self._lock:
+            handoff = self._handoffs.pop(handle, None)
+            if handoff is None:
+                self.stats["missing"] += 1
+                return None
+            if handoff.expired(time.monotonic()):
+                self._discard(handoff)
+                return None
+            self.stats["used"] += 1
+            return handoff
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self.stats, "pending": len(self._handoffs)}
+
+handoffs = HandoffStore()
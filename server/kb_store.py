@@ -0,0 +1,289 @@
+# 内容寻址的知识库存储：每个版本按内容哈希只存一份紧凑二进制，名称索引和激活指针是小的元数据文件
+import fcntl
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+KB_STORE_DIR = os.getenv("KB_STORE_DIR", "data/kb")
+KB_LOAD_CACHE = int(os.getenv("KB_LOAD_CACHE", "4"))  # 进程内保留的已解码版本数
+
+# 文件头: 魔数, 格式版本, 规则数, 意图数, 字符串表大小, 内容 sha1；其后是 zlib 压缩的正文
+MAGIC = b"CKB1"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sHIII20s")
+FIELDS = ("domain", "ability", "feature", "intent", "query")
+DEFAULT_NAME = "default"
+
+def content_hash(kb: Dict[str, Any]) -> str:
+    """知识库内容的规范化哈希，同样的规则和意图不管来自哪个文件都得到同一个版本"""
+    canonical = json.dumps({"rules": kb.get("rules", []), "intents": kb.get("intents", [])},
+                           ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+def encode(kb: Dict[str, Any]) -> Tuple[bytes, str]:
+    """编码为二进制: 去重字符串表 + 每条意图 6 个下标（5 个字段和其余字段的 JSON）+ 规则下标"""
+    strings: Dict[str, int] = {}
+
+    def ref(value: Any) -> int:
+        text = "" if value is None else str(value)
+        index = strings.get(text)
+        if index is None:
+            index = strings[text] = len(strings)
+        return index
+
+    rules = [ref(rule) for rule in kb.get("rules", [])]
+    rows: List[int] = []
+    for item in kb.get("intents", []):
+        rows.extend(ref(item.get(field, "")) for field in FIELDS)
+        extra = {k: v for k, v in item.items() if k not in FIELDS}
+        rows.append(ref(json.dumps(extra, ensure_ascii=False, sort_keys=True) if extra else ""))
+
+    blobs = [s.encode("utf-8") for s in strings]
+    body = b"".join((
+        struct.pack(f"<{len(blobs)}I", *map(len, blobs)),
+        b"".join(blobs),
+        struct.pack(f"<{len(rules)}I", *rules),
+        struct.pack(f"<{len(rows)}I", *rows)
+    ))
+    version = content_hash(kb)
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, len(rules), len(rows) // 6, len(blobs), bytes.fromhex(version))
+    return header + zlib.compress(body, 6), version
+
+def read_header(data: bytes) -> Dict[str, Any]:
+    magic, fmt, n_rules, n_intents, n_strings, digest = HEADER.unpack_from(data)
+    if magic != MAGIC or fmt != FORMAT_VERSION:
+        raise ValueError("not a knowledge base object")
+    return {"rules": n_rules, "intents": n_intents, "strings": n_strings, "version": digest.hex()}
+
+def decode(data: bytes) -> Dict[str, Any]:
+    header = read_header(data)
+    body = zlib.decompress(data[HEADER.size:])
+    n_strings, n_rules, n_intents = header["strings"], header["rules"], header["intents"]
+    lengths = struct.unpack_from(f"<{n_strings}I", body)
+    offset = 4 * n_strings
+    strings = []
+    for length in lengths:
+        strings.append(body[offset:offset + length].decode("utf-8"))
+        offset += length
+    rules = struct.unpack_from(f"<{n_rules}I", body, offset)
+    rows = struct.unpack_from(f"<{n_intents * 6}I", body, offset + 4 * n_rules)
+    intents = []
+    for i in range(0, len(rows), 6):
+        item = {field: strings[rows[i + j]] for j, field in enumerate(FIELDS)}
+        extra = strings[rows[i + 5]]
+        if extra:
+            item.update(json.loads(extra))
+        intents.append(item)
+    return {"rules": [strings[i] for i in rules], "intents": intents}
+
+class KBStore:
+    """目录结构: objects/<hash>.kb（不可变版本）、index.json（名称 -> 版本、上传文件哈希 -> 版本）、ACTIVE（激活指针）
+
+    写操作在文件锁内完成并用 os.replace 原子替换，多 worker 共用一个目录；读索引按 mtime 缓存，
+    列表、激活只读写元数据，加载按版本缓存解码结果。
+    """
+
+    def __init__(self, root: str = KB_STORE_DIR):
+        self.root = root
+        self.objects_dir = os.path.join(root, "objects")
+        self._index_path = os.path.join(root, "index.json")
+        self._active_path = os.path.join(root, "ACTIVE")
+        self._lock = threading.Lock()
+        self._index: Optional[Dict[str, Any]] = None
+        self._index_mtime = 0
+        self._loaded: Dict[str, Dict[str, Any]] = {}
+
+    # ---- 元数据 ----
+
+    @contextmanager
+    def _locked(self):
+        os.makedirs(self.objects_dir, exist_ok=True)
+        with self._lock, open(os.path.join(self.root, ".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _write_atomic(path: str, data: bytes):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def index(self) -> Dict[str, Any]:
+        """名称索引；文件没变（mtime 相同）时直接用内存里的"""
+        try:
+            mtime = os.stat(self._index_path).st_mtime_ns
+        except FileNotFoundError:
+            return {"names": {}, "sources": {}}
+        if self._index is None or mtime != self._index_mtime:
+            with open(self._index_path, "r", encoding="utf-8") as f:
+                self._index = json.load(f)
+            self._index_mtime = mtime
+        return self._index
+
+    def _save_index(self, index: Dict[str, Any]):
+        self._write_atomic(self._index_path, json.dumps(index, ensure_ascii=False).encode("utf-8"))
+
+    def object_path(self, version: str) -> str:
+        return os.path.join(self.objects_dir, f"{version}.kb")
+
+    def object_prefix(self, version: str) -> str:
+        """版本相关的衍生文件（如本地分类器）放在对象旁边"""
+        return os.path.join(self.objects_dir, version)
+
+    def find_source(self, source_hash: str) -> Optional[str]:
+        """上传文件的原始字节哈希 -> 已存在的名称，重复上传不必再解析"""
+        version = self.index()["sources"].get(source_hash)
+        return self.name_of(version) if version else None
+
+    def name_of(self, version: str) -> Optional[str]:
+        for name, meta in self.index()["names"].items():
+            if meta["version"] == version:
+                return name
+        return None
+
+    def get(self, name: str) -> Optional[Dict[str, Any]]:
+        return self.index()["names"].get(name)
+
+    def list(self) -> List[Tuple[str, Dict[str, Any]]]:
+        return list(self.index()["names"].items())
+
+    # ---- 写入 ----
+
+    def put(self, kb: Dict[str, Any], name: str, source: str = "Import", source_hash: str = "",
+            **extra: Any) -> Tuple[str, bool]:
+        """保存一个版本，返回 (名称, 是否重复)；内容已存在时不写对象，返回已有名称"""
+        data, version = encode(kb)
+        with self._locked():
+            index = dict(self.index())
+            names, sources = dict(index["names"]), dict(index["sources"])
+            existing = next((n for n, meta in names.items() if meta["version"] == version), None)
+            if source_hash:
+                sources[source_hash] = version
+            if existing is None:
+                if not os.path.exists(self.object_path(version)):
+                    self._write_atomic(self.object_path(version), data)
+                unique, counter = name, 1
+                while unique in names:
+                    unique = f"{name}_{counter}"
+                    counter += 1
+                names[unique] = dict(extra, version=version, source=source, size=len(data),
+                                     rules=len(kb.get("rules", [])), intents=len(kb.get("intents", [])),
+                                     created=int(time.time()))
+            self._save_index({"names": names, "sources": sources})
+        return (existing, True) if existing is not None else (unique, False)
+
+    def alias(self, name: str, target: str, **meta: Any):
+        """让名称指向 target 名称的版本（例如系统默认知识库更新了）"""
+        with self._locked():
+            names = dict(self.index()["names"])
+            names[name] = dict(names[target], **meta)
+            self._save_index(dict(self.index(), names=names))
+
+    def delete(self, name: str) -> Optional[str]:
+        """删除名称；没有其他名称引用的版本连同衍生文件一起删除，返回被删的版本"""
+        with self._locked():
+            index = self.index()
+            names = dict(index["names"])
+            meta = names.pop(name, None)
+            if meta is None:
+                return None
+            version = meta["version"]
+            sources = index["sources"]
+            if not any(m["version"] == version for m in names.values()):
+                sources = {k: v for k, v in sources.items() if v != version}
+                prefix = self.object_prefix(version)
+                for path in [self.object_path(version)] + [prefix + s for s in (".clf.npy", ".clf.idf.npy", ".clf.json")]:
+                    if os.path.exists(path):
+                        os.remove(path)
+                self._loaded.pop(version, None)
+            self._save_index({"names": names, "sources": sources})
+            return version
+
+    # ---- 激活与加载 ----
+
+    def activate(self, name: str) -> str:
+        """原子地切换激活指针，返回激活的版本"""
+        meta = self.get(name)
+        if meta is None:
+            raise KeyError(name)
+        with self._locked():
+            self._write_atomic(self._active_path, json.dumps({"name": name, "version": meta["version"]}).encode("utf-8"))
+        return meta["version"]
+
+    def active(self) -> Optional[Dict[str, str]]:
+        """{"name", "version"}；指针缺失或指向已删除的名称时返回默认知识库"""
+        try:
+            with open(self._active_path, "r", encoding="utf-8") as f:
+                pointer = json.load(f)
+        except (FileNotFoundError, ValueError):
+            pointer = None
+        if pointer and pointer.get("name") in self.index()["names"]:
+            return pointer
+        meta = self.get(DEFAULT_NAME)
+        return {"name": DEFAULT_NAME, "version": meta["version"]} if meta else None
+
+    def revision(self) -> Tuple[int, int]:
+        """激活指针和索引的 mtime，任一变化说明（可能是别的 worker）切换或删除过知识库"""
+        def mtime(path: str) -> int:
+            try:
+                return os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                return 0
+        return mtime(self._active_path), mtime(self._index_path)
+
+    def load(self, version: str) -> Dict[str, Any]:
+        """按版本解码；版本不可变，进程内缓存最近用过的几个"""
+        kb = self._loaded.get(version)
+        if kb is None:
+            with open(self.object_path(version), "rb") as f:
+                kb = decode(f.read())
+            if len(self._loaded) >= KB_LOAD_CACHE:
+                self._loaded.pop(next(iter(self._loaded)))
+            self._loaded[version] = kb
+        return kb
+
+    # ---- 初始化 ----
+
+    def import_file(self, path: str, name: str, source: str) -> str:
+        """导入一个 JSON 知识库文件（按文件字节哈希跳过已导入的），返回名称"""
+        with open(path, "rb") as f:
+            raw = f.read()
+        source_hash = hashlib.sha1(raw).hexdigest()
+        known = self.find_source(source_hash)
+        if known is not None:
+            return known
+        kb = json.loads(raw.decode("utf-8"))
+        stored, duplicate = self.put(kb, name, source=source, source_hash=source_hash)
+        if name == DEFAULT_NAME and stored != DEFAULT_NAME:
+            # 默认知识库文件变了：把 default 指向新内容
+            self.alias(DEFAULT_NAME, stored, source=source)
+            if not duplicate:
+                self.delete(stored)
+            return DEFAULT_NAME
+        return stored
+
+    def init(self, default_path: str, legacy_dir: Optional[str] = None):
+        """导入系统默认知识库，并把旧版 uploads 目录下的 JSON 和 active.txt 迁移过来"""
+        self.import_file(default_path, DEFAULT_NAME, "System")
+        if legacy_dir and os.path.isdir(legacy_dir):
+            for fname in sorted(os.listdir(legacy_dir)):
+                if fname.endswith(".json"):
+                    self.import_file(os.path.join(legacy_dir, fname), fname[:-len(".json")], "Import")
+            active_txt = os.path.join(legacy_dir, "active.txt")
+            if os.path.exists(active_txt) and not os.path.exists(self._active_path):
+                with open(active_txt, "r") as f:
+                    legacy = f.read().strip()[:-len(".json")]
+                if self.get(legacy):
+                    self.activate(legacy)
+
+kb_store = KBStore()
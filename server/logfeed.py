@@ -0,0 +1,176 @@
+# 对话日志变更推送：日志提交后由进程内的唯一发布者序列化一次摘要，扇出给所有 SSE 订阅者；按日志 id 断点续传
+import asyncio
+import json
+import os
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+LOG_FEED_BUFFER = int(os.getenv("LOG_FEED_BUFFER", "1000"))  # 内存里保留的最近事件数，续传缺口更大时回库查
+LOG_FEED_QUEUE = int(os.getenv("LOG_FEED_QUEUE", "256"))  # 每个订阅者最多积压的事件数
+LOG_FEED_PING_S = float(os.getenv("LOG_FEED_PING_S", "15"))
+LOG_FEED_BACKFILL = int(os.getenv("LOG_FEED_BACKFILL", "500"))  # 一次续传最多补发的条数
+
+def summarize(log_id: int, message: str, output: Dict[str, Any], timestamp: Any) -> Dict[str, Any]:
+    """日志摘要：调试台列表和详情要用的字段，不含 trace、逐阶段耗时等"""
+    return {
+        "id": log_id,
+        "user_input": message,
+        "timestamp": str(timestamp),
+        "latency_ms": output.get("latency_ms"),
+        "total_tokens": (output.get("token_usage") or {}).get("total_tokens", 0),
+        "degraded": output.get("degraded", False),
+        "commands": [{"module": c.get("module"), "text": c.get("text")} for c in output.get("commands", [])],
+        "results": [{k: r.get(k) for k in ("module", "intent", "params", "action", "reply")}
+                    for r in output.get("results", [])],
+        "summary": output.get("summary", "")
+    }
+
+def encode(event: Dict[str, Any]) -> str:
+    """SSE 帧，id 即日志 id，浏览器断线重连时通过 Last-Event-ID 带回来"""
+    return f"id: {event['id']}\nevent: log\ndata: {json.dumps(event, ensure_ascii=False, separators=(',', ':'))}\n\n"
+
+class Subscriber:
+    __slots__ = ("loop", "queue", "overflowed")
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=LOG_FEED_QUEUE)
+        self.overflowed = False
+
+    def offer(self, item: Tuple[int, str]):
+        """在订阅者的事件循环里调用；积压满了就断开，由客户端带 Last-Event-ID 重连补齐"""
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.overflowed = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+class LogFeed:
+    def __init__(self):
+        self._buffer: deque = deque(maxlen=LOG_FEED_BUFFER)  # [(id, 已编码的帧)]
+        self._subscribers: List[Subscriber] = []
+        self._lock = threading.Lock()
+        self._commit_lock = threading.Lock()
+        self.stats = {"published": 0, "delivered": 0, "backfilled": 0, "dropped": 0}
+
+    @contextmanager
+    def committing(self):
+        """日志事务的提交和 publish 放在同一段临界区里，进程内推送顺序与提交顺序（即 id 顺序）一致"""
+        with self._commit_lock:
+            yield
+
+    def publish(self, events: List[Dict[str, Any]]):
+        """日志事务提交后调用（任意线程，应在 committing() 内）；每条只编码一次"""
+        frames = sorted((event["id"], encode(event)) for event in events)
+        with self._lock:
+            if self._buffer and frames and frames[0][0] < self._buffer[-1][0]:
+                # 仍然乱序到达时（如绕过 committing 写入）按 id 重排，since() 依赖缓冲区有序
+                self._buffer = deque(sorted(list(self._buffer) + frames), maxlen=LOG_FEED_BUFFER)
+            else:
+                self._buffer.extend(frames)
+            subscribers = list(self._subscribers)
+            self.stats["published"] += len(frames)
+        for sub in subscribers:
+            for frame in frames:
+                try:
+                    sub.loop.call_soon_threadsafe(sub.offer, frame)
+                except RuntimeError:  # 订阅者的事件循环已关闭
+                    break
+
+    def subscribe(self, loop: asyncio.AbstractEventLoop) -> Subscriber:
+        sub = Subscriber(loop)
+        with self._lock:
+            self._subscribers.append(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscriber):
+        with self._lock:
+            if sub in self._subscribers:
+                self._subscribers.remove(sub)
+            if sub.overflowed:
+                self.stats["dropped"] += 1
+
+    def delivered(self):
+        with self._lock:
+            self.stats["delivered"] += 1
+
+    def since(self, last_id: int) -> Tuple[List[Tuple[int, str]], bool]:
+        """内存里 id > last_id 的事件；返回 (事件, 是否完整)，缓冲区已覆盖不到 last_id 时不完整"""
+        with self._lock:
+            buffered = list(self._buffer)
+        if buffered and buffered[0][0] <= last_id + 1:
+            return [frame for frame in buffered if frame[0] > last_id], True
+        return buffered, False
+
+    def backlog(self, last_id: int) -> List[Tuple[int, str]]:
+        """续传：优先用内存缓冲，缺口从数据库补（最多 LOG_FEED_BACKFILL 条）"""
+        frames, complete = self.since(last_id)
+        if complete:
+            return frames
+        from database import SessionLocal, ChatLog
+
+        first_buffered = frames[0][0] if frames else None
+        db = SessionLocal()
+        try:
+            query = db.query(ChatLog).filter(ChatLog.id > last_id)
+            if first_buffered is not None:
+                query = query.filter(ChatLog.id < first_buffered)
+            rows = query.order_by(ChatLog.id.desc()).limit(LOG_FEED_BACKFILL).all()
+        finally:
+            db.close()
+        missing = []
+        for row in reversed(rows):
+            try:
+                output = json.loads(row.raw_response or "{}")
+            except ValueError:
+                output = {}
+            output.setdefault("latency_ms", row.latency_ms)
+            missing.append((row.id, encode(summarize(row.id, row.user_input, output, row.timestamp))))
+        with self._lock:
+            self.stats["backfilled"] += len(missing)
+        return missing + frames
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self.stats, "subscribers": len(self._subscribers), "buffered": len(self._buffer)}
+
+log_feed = LogFeed()
+
+async def stream(last_id: Optional[int], is_disconnected):
+    """SSE 响应体：先补发 last_id 之后的事件，再推实时事件；空闲时发注释行保活
+
+    补发期间订阅队列里也会收到同一批事件，按补发过的 id 去重（不用最大 id 判断，晚提交的小 id 不会被丢掉）。
+    """
+    sub = log_feed.subscribe(asyncio.get_running_loop())
+    try:
+        yield "retry: 2000\n\n"
+        replayed = set()
+        if last_id is not None:
+            backlog = await asyncio.get_running_loop().run_in_executor(None, log_feed.backlog, last_id)
+            for log_id, frame in backlog:
+                replayed.add(log_id)
+                yield frame
+        while True:
+            try:
+                item = await asyncio.wait_for(sub.queue.get(), LOG_FEED_PING_S)
+            except asyncio.TimeoutError:
+                if await is_disconnected():
+                    return
+                yield ": ping\n\n"
+                continue
+            if item is None:  # 积压溢出：断开，客户端重连续传
+                return
+            log_id, frame = item
+            if log_id in replayed:  # 补发期间到达、已经补发过的
+                replayed.discard(log_id)
+                continue
+            log_feed.delivered()
+            yield frame
+    finally:
+        log_feed.unsubscribe(sub)
@@ -1,18 +1,48 @@
+import startup  # 最先导入，启动画像从这里开始计时
 import os
 import time
+import hashlib
+import secrets
 import json
-import shutil
-from fastapi import FastAPI, HTTPException, UploadFile, File
+import asyncio
+import contextvars
+import threading
+from fastapi import FastAPI, HTTPException, UploadFile, File, Request, WebSocket, WebSocketDisconnect, BackgroundTasks
+from fastapi.concurrency import run_in_threadpool
+from starlette.routing import Match
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import List, Optional
-import pandas as pd
+from typing import Any, Dict, List, Optional, Tuple
 import io
 
-from graph.workflow import workflow
-from graph.nodes import router_agent, module_agents, executor_agent, summarizer_agent
-from database import SessionLocal, ChatLog
+from graph.nodes import router_agent, summarizer_agent, get_speculative_stats, run_commands, warm_prompts
+from graph.workflow import get_workflow
+from database import SessionLocal, ChatLog, ChatTrace, init_db
+from agents.base import BaseAgent, llm_breaker
+from agents.resilience import LLMError
+from pipeline import REQUEST_BUDGET_S
+import pipeline
+import batch
+from session import sessions
+from handoff import handoffs
+from logfeed import log_feed
+import logfeed
+import shadow as shadow_traffic
+from shadow import shadow
+from shared_store import store
+from kb_store import kb_store, DEFAULT_NAME
+from dispatch import dispatcher
+from vehicle_state import VEHICLE_STATE, vehicle_states
+from admission import admission, client_key, classify_priority, AdmissionRejected, PRIORITY_BATCH
+import metrics
+import tracing
+import classifier
+import profiler
+import prewarm
+from agents import llmcache as llm_cache
+
+startup.end_imports()
 
 app = FastAPI(title="Car Agent API v2", version="2.0.0")
 
@@ -34,12 +64,20 @@ class CommandItem(BaseModel):
 
 class ExecuteRequest(BaseModel):
     commands: List[CommandItem]
+    handle: Optional[str] = None  # /chat/recognize 返回的句柄，带上后直接用预先算好的结果
+    quality: bool = False  # 多条回复交给模型润色（默认本地合并）
 
 class ChatRequest(BaseModel):
     message: str
     history: Optional[List[dict]] = []
+    trace: bool = False  # 是否在响应中返回 span 树
+    session_id: Optional[str] = None  # 带上后可用 "再高一点" 之类的追问
+    quality: bool = False  # 多条回复交给模型润色（默认本地合并）
 
 # Response Models
+class VehicleStateReport(BaseModel):
+    state: Dict[str, Any]  # 键同 GET /vehicles/{id}/state，如 {"ac": "on", "temperature": 24, "window:主驾": "open"}
+
 class CommandResponse(BaseModel):
     index: int
     module: str
@@ -54,140 +92,501 @@ class ResultResponse(BaseModel):
     action: str
     reply: str
 
+metrics.Gauge("car_bot_admission_in_flight", "Admitted requests currently running", lambda: admission.in_flight)
+metrics.Gauge("car_bot_admission_waiting", "Requests waiting for an admission slot", lambda: admission.waiting())
+metrics.Gauge("car_bot_llm_circuit_open", "1 while any model circuit is open or half-open (degraded mode)",
+              lambda: 1 if llm_breaker.any_open() else 0)
+metrics.Gauge("car_bot_shadow_pending", "Shadow re-runs queued or running", lambda: shadow.pending)
+metrics.Gauge("car_bot_log_feed_subscribers", "Connected /logs/stream clients", lambda: log_feed.get_stats()["subscribers"])
+
+def route_path(request: Request) -> str:
+    """用路由模板作为指标标签，避免路径参数导致标签爆炸"""
+    route = request.scope.get("route")
+    if route is None:
+        for candidate in request.app.routes:
+            if candidate.matches(request.scope)[0] == Match.FULL:
+                route = candidate
+                break
+    return getattr(route, "path", "unmatched")
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    endpoint = route_path(request)
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+    if response.status_code >= 400:
+        metrics.REQUEST_ERRORS.inc(endpoint=endpoint, error=str(response.status_code))
+    return response
+
+def run_sync(fn, *args):
+    """在线程池中执行同步的 Agent 流程，并带上当前请求上下文"""
+    return run_in_threadpool(contextvars.copy_context().run, fn, *args)
+
+async def iterate_sync(gen_fn, *args):
+    """在线程池中运行同步生成器，逐个产出其结果（带上当前请求上下文）"""
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    done = object()
+
+    def produce():
+        try:
+            for item in gen_fn(*args):
+                loop.call_soon_threadsafe(queue.put_nowait, (item, None))
+        except BaseException as e:
+            loop.call_soon_threadsafe(queue.put_nowait, (None, e))
+        else:
+            loop.call_soon_threadsafe(queue.put_nowait, (done, None))
+
+    worker = asyncio.ensure_future(run_sync(produce))
+    try:
+        while True:
+            item, error = await queue.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        await worker
+
+def admit(request: Request, text: str):
+    """准入控制: 全局并发上限、按车辆/API Key 限流、按模块优先级排队"""
+    host = request.client.host if request.client else None
+    return admission.admit(client_key(request.headers, host), classify_priority(text))
+
+def rejected(e: AdmissionRejected) -> HTTPException:
+    return HTTPException(status_code=429, detail=e.reason, headers={"Retry-After": str(e.retry_after)})
+
+@app.on_event("startup")
+def on_startup():
+    with startup.phase("init_db"):
+        init_db()
+    # 预热在后台进行，完成前 /ready 返回 503；此期间到达的请求照常处理，只是首个请求承担加载开销
+    # 提示词和结果缓存首次用到时也会构建/填充，失败不影响就绪；其余步骤失败时退避重试
+    startup.start_warm_up([
+        ("workflow", get_workflow),
+        ("llm_client", lambda: startup.lazy_import("dashscope")),
+        ("prompts", warm_prompts, True),
+        ("knowledge", init_kb),
+        ("cache", prewarm.wait_ready, True)
+    ])
+
 @app.get("/")
 async def root():
     return {"message": "Car Agent API v2", "version": "2.0.0"}
 
+@app.get("/ready")
+async def ready():
+    """就绪检查: 进程存活看 /，预热完成（可以正常服务）看这里"""
+    status = dict(startup.status(), prewarm=prewarm.status())
+    if not status["ready"]:
+        return JSONResponse(status_code=503, content=status)
+    return status
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus 指标"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/stats")
+async def get_stats():
+    """运行时统计"""
+    from agents.base import llm_flight, llm_caller
+    return {
+        "speculative": get_speculative_stats(),
+        "single_flight": llm_flight.get_stats(),
+        "llm": llm_caller.get_stats(),
+        "breaker": llm_breaker.get_stats(),
+        "admission": admission.get_stats(),
+        "store": store.stats(),
+        "dispatch": dispatcher.get_stats(),
+        "handoff": handoffs.get_stats(),
+        "log_feed": log_feed.get_stats(),
+        "shadow": shadow.get_stats(),
+        "trace_export": tracing.get_export_stats(),
+        "prewarm": prewarm.status()
+    }
+
+# 管理接口口令（请求头 X-Admin-Token），未配置时管理接口关闭
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+def require_admin(request: Request):
+    token = request.headers.get("x-admin-token", "")
+    if not ADMIN_TOKEN or not secrets.compare_digest(token, ADMIN_TOKEN):
+        raise HTTPException(403, "Admin token required")
+
+@app.get("/debug/profile")
+async def profile(request: Request, seconds: float = 10, interval_ms: float = 10,
+                  format: str = "collapsed", idle: bool = False):
+    """采样当前 worker seconds 秒: collapsed（折叠栈文本）/ speedscope（JSON）/ summary（按状态和节点汇总）"""
+    require_admin(request)
+    if format not in ("collapsed", "speedscope", "summary"):
+        raise HTTPException(400, "format must be collapsed, speedscope or summary")
+    try:
+        result = await run_in_threadpool(profiler.sample, seconds, interval_ms, idle)
+    except profiler.ProfilerBusy as e:
+        raise HTTPException(409, str(e))
+    if format == "speedscope":
+        return JSONResponse(result.speedscope(f"car-bot pid {os.getpid()}"),
+                            headers={"Content-Disposition": "attachment; filename=profile.speedscope.json"})
+    if format == "summary":
+        return result.summary()
+    return PlainTextResponse(result.collapsed())
+
 @app.post("/chat/recognize")
-async def recognize(req: RecognizeRequest):
+async def recognize(req: RecognizeRequest, request: Request):
     """阶段1: 模块识别（返回数组）"""
     try:
-        start_time = time.time()
-        commands = router_agent.recognize(req.message)
+        async with admit(request, req.message):
+            start_time = time.time()
+            BaseAgent.reset_tokens()
+            BaseAgent.set_request_budget(REQUEST_BUDGET_S)
+            commands = await run_sync(router_agent.recognize, req.message)
         latency = int((time.time() - start_time) * 1000)
+        # 用户确认期间在后台先把各条指令解析、执行好；预执行要占一个准入名额（不排队），满了就不做，确认时照常计算
+        handle = None
+        if handoffs.enabled(commands):
+            if admission.try_acquire():
+                loop = asyncio.get_running_loop()
+                handle = handoffs.create(commands, REQUEST_BUDGET_S,
+                                         lambda: loop.call_soon_threadsafe(admission.release))
+            else:
+                handoffs.skip()
         
         return {
             "commands": commands,
-            "latency_ms": latency
+            "handle": handle,
+            "latency_ms": latency,
+            "degraded": bool(BaseAgent.get_degraded())
         }
+    except AdmissionRejected as e:
+        raise rejected(e)
+    except LLMError as e:
+        raise HTTPException(status_code=e.http_status, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def execute_commands(commands: List[CommandItem], vehicle_id: Optional[str] = None,
+                     handoff=None) -> Tuple[List[dict], List[int], int]:
+    """返回 (按序号排好的结果, 车辆状态直接给出结果的序号, 用上预执行结果的条数)；结果按指令顺序交给该车的下发队列
+
+    handoff 为识别时的预执行结果，没改过的指令直接用（还在算的等它），改过的照常解析执行。
+    """
+    received_ns = time.perf_counter_ns()
+    vehicle = vehicle_states.get(vehicle_id)
+    items = [{"index": i + 1, "module": cmd.module, "text": cmd.text} for i, cmd in enumerate(commands)]
+    ready, planned, reused, emitted = {}, [], 0, 0
+    # 同模块的指令一起解析、一起执行；下发按指令顺序，只放出已连续的部分
+    for module in dict.fromkeys(item["module"] for item in items):
+        group = [item for item in items if item["module"] == module]
+        # 各组共用同一个请求预算，只等剩下的时间
+        parsed, executed = handoff.lookup(group, BaseAgent.remaining_budget()) if handoff is not None else ({}, {})
+        reused += len(executed)
+        for result, from_state in run_commands(module, group, parsed, vehicle, executed):
+            ready[result["index"]] = result
+            if from_state:
+                planned.append(result["index"])
+        while emitted < len(items) and items[emitted]["index"] in ready:
+            dispatcher.submit(vehicle_id, ready[items[emitted]["index"]], received_ns)
+            emitted += 1
+    return [ready[item["index"]] for item in items], planned, reused
+
 @app.post("/chat/execute")
-async def execute(req: ExecuteRequest):
+async def execute(req: ExecuteRequest, request: Request):
     """阶段2: 执行命令（返回数组）"""
     try:
-        start_time = time.time()
-        results = []
-        
-        for i, cmd in enumerate(req.commands):
-            agent = module_agents.get(cmd.module)
-            if agent:
-                parsed = agent.parse(cmd.text)
-                intent = parsed.get("intent", "未知")
-                params = parsed.get("params", {})
-            else:
-                intent = "未知"
-                params = {}
-            
-            result = executor_agent.execute(cmd.module, intent, params)
-            
-            results.append({
-                "index": i + 1,
-                "module": cmd.module,
-                "intent": intent,
-                "params": params,
-                "action": result.get("action", "UNKNOWN"),
-                "reply": result.get("reply", "操作完成")
-            })
-        
-        summary = summarizer_agent.summarize(results)
+        async with admit(request, " ".join(cmd.text for cmd in req.commands)):
+            start_time = time.time()
+            BaseAgent.reset_tokens()
+            BaseAgent.set_request_budget(REQUEST_BUDGET_S)
+            results, planned, reused = await run_sync(execute_commands, req.commands,
+                                                      request.headers.get("x-vehicle-id"), handoffs.take(req.handle))
+            summary = await run_sync(summarizer_agent.summarize, results, planned, req.quality)
         latency = int((time.time() - start_time) * 1000)
         
         return {
             "results": results,
             "summary": summary,
-            "latency_ms": latency
+            "precomputed": reused,
+            "latency_ms": latency,
+            "token_usage": BaseAgent.get_tokens(),
+            "degraded": bool(BaseAgent.get_degraded())
         }
+    except AdmissionRejected as e:
+        raise rejected(e)
+    except LLMError as e:
+        raise HTTPException(status_code=e.http_status, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/chat")
-async def chat(req: ChatRequest):
+async def chat(req: ChatRequest, request: Request, background_tasks: BackgroundTasks):
     """完整流程（兼容旧版 + 新功能）"""
-    from agents.base import BaseAgent
     try:
-        start_time = time.time()
-        BaseAgent.reset_tokens()  # 重置 token 计数
-        
-        # 使用 LangGraph 工作流
-        state = {
-            "message": req.message,
-            "commands": [],
-            "results": [],
-            "summary": "",
-            "current_index": 0
-        }
-        
-        result = workflow.invoke(state)
-        latency = int((time.time() - start_time) * 1000)
-        token_usage = BaseAgent.get_tokens()
+        # 会话和车辆状态在共享存储里（socket/redis 往返），不在事件循环里阻塞调用
+        session = await run_sync(sessions.get, req.session_id) if req.session_id else None
+        followup = session.resolve(req.message) if session else None
+        async with admit(request, req.message):
+            output = await run_sync(pipeline.run_chat, req.message, *(followup or (None, None)),
+                                    request.headers.get("x-vehicle-id"), req.quality)
+        if session:
+            session.record(req.message, output)
+            await run_sync(sessions.save, session)
         
         # 保存日志
-        db = SessionLocal()
-        try:
-            import json as json_lib
-            result_with_tokens = {**result, "token_usage": token_usage}
-            log = ChatLog(
-                user_input=req.message,
-                intent_detected=",".join([r["intent"] for r in result["results"]]),
-                full_prompt="Multi-agent workflow",
-                raw_response=json_lib.dumps(result_with_tokens, ensure_ascii=False),
-                parsed_action=json_lib.dumps([r["action"] for r in result["results"]], ensure_ascii=False),
-                latency_ms=latency,
-                token_usage=json_lib.dumps(token_usage)
-            )
-            db.add(log)
-            db.commit()
-            log_id = log.id
-        finally:
-            db.close()
+        log_id = (await run_sync(pipeline.save_chat_logs, [(req.message, output)]))[0]
         
-        return {
-            "commands": result["commands"],
-            "results": result["results"],
-            "summary": result["summary"],
-            "reply": result["summary"],  # 兼容旧版
-            "latency_ms": latency,
-            "token_usage": token_usage,
+        response = {
+            "commands": output["commands"],
+            "results": output["results"],
+            "summary": output["summary"],
+            "reply": output["summary"],  # 兼容旧版
+            "latency_ms": output["latency_ms"],
+            "token_usage": output["token_usage"],
+            "escalations": output["escalations"],
+            "degraded": output["degraded"],
+            "speculative_hit": output["speculative_hit"],
+            "state_hits": output["state_hits"],
             "log_id": log_id
         }
+        if session:
+            response["session_id"] = session.session_id
+            response["followup"] = followup is not None
+        # 影子流量: 响应发出后用候选配置重跑（会话追问依赖上下文，不抽）
+        if followup is None and shadow.sample(output):
+            background_tasks.add_task(shadow.submit, req.message, shadow_traffic.snapshot(output), log_id,
+                                      req.quality)
+        if req.trace:
+            response["trace"] = tracing.compact_to_tree(output["trace_compact"])
+        return response
+    except AdmissionRejected as e:
+        raise rejected(e)
+    except LLMError as e:
+        raise HTTPException(status_code=e.http_status, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# 批量条目被过载拒绝时的最多重试次数
+BATCH_ADMIT_ATTEMPTS = int(os.getenv("BATCH_ADMIT_ATTEMPTS", "5"))
+
+@app.post("/chat/batch")
+async def chat_batch(request: Request):
+    """批量对话: JSON {"messages": [...], "concurrency": n} 或 NDJSON，按输入顺序流式返回 NDJSON"""
+    try:
+        messages, concurrency = batch.parse_body((await request.body()).decode("utf-8"),
+                                                 request.headers.get("content-type", ""))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    host = request.client.host if request.client else None
+    client = client_key(request.headers, host)
+    try:
+        # 整批只占用一次客户端令牌，条目以最低优先级排队
+        admission.check_rate(client)
+    except AdmissionRejected as e:
+        raise rejected(e)
+
+    unique, positions = batch.dedupe(messages)
+    semaphore = asyncio.Semaphore(batch.clamp_concurrency(concurrency))
+
+    async def run_one(message: str):
+        async with semaphore:
+            for attempt in range(BATCH_ADMIT_ATTEMPTS):
+                try:
+                    async with admission.admit(client, PRIORITY_BATCH, rate_limit=False):
+                        return await run_sync(pipeline.run_chat, message)
+                except AdmissionRejected as e:
+                    if attempt == BATCH_ADMIT_ATTEMPTS - 1:
+                        raise
+                    await asyncio.sleep(e.retry_after)
+
+    async def stream():
+        tasks = [asyncio.ensure_future(run_one(m)) for m in unique]
+        try:
+            lines, first_seen = [], set()
+            for index, (message, pos) in enumerate(zip(messages, positions)):
+                deduplicated = pos in first_seen
+                first_seen.add(pos)
+                try:
+                    line = batch.ok_line(index, message, await tasks[pos], deduplicated)
+                except Exception as e:
+                    line = batch.error_line(index, message, e, deduplicated)
+                lines.append(line)
+                yield json.dumps(line, ensure_ascii=False) + "\n"
+
+            # 成功的结果一次批量入库
+            outputs = [t.result() if t.exception() is None else None for t in tasks]
+            log_ids = await run_sync(batch.save_results, unique, outputs, positions)
+            yield json.dumps(batch.summary_line(lines, len(unique), log_ids), ensure_ascii=False) + "\n"
+        finally:
+            # 客户端中途断开时取消尚未完成的条目
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@app.get("/vehicles/{vehicle_id}/state")
+async def get_vehicle_state(vehicle_id: str):
+    """服务端记录的车辆状态（由已下发的动作码推出）"""
+    vehicle = await run_sync(vehicle_states.get, vehicle_id)
+    if vehicle is None:
+        raise HTTPException(status_code=404, detail="Vehicle state disabled")
+    return {"vehicle_id": vehicle_id, "state": vehicle.snapshot()}
+
+@app.put("/vehicles/{vehicle_id}/state")
+async def report_vehicle_state(vehicle_id: str, req: VehicleStateReport):
+    """车辆上报实际状态（用户手动操作后），替换服务端推算的状态，之后按它判断已满足的指令"""
+    if not VEHICLE_STATE:
+        raise HTTPException(status_code=404, detail="Vehicle state disabled")
+    state = await run_sync(vehicle_states.report, vehicle_id, req.state)
+    return {"vehicle_id": vehicle_id, "state": state}
+
+@app.get("/vehicles/{vehicle_id}/actions")
+async def get_vehicle_actions(vehicle_id: str):
+    """该车最近的动作下发记录: 排队/合并/确认状态和各阶段耗时"""
+    if not dispatcher.enabled:
+        raise HTTPException(status_code=404, detail="Action dispatch disabled")
+    return dispatcher.recent(vehicle_id)
+
+@app.websocket("/ws/chat")
+async def chat_ws(websocket: WebSocket):
+    """车机长连接: 每条语音指令流式返回 commands / result / summary / done，会话状态保存在服务端
+
+    连接参数 ?vehicle_id= 或 X-Vehicle-Id 作为会话 ID，断线重连后沿用上下文。
+    客户端每次发送纯文本或 {"message": "...", "id": 任意回显值}。
+    """
+    await websocket.accept()
+    vehicle_id = websocket.query_params.get("vehicle_id") or websocket.headers.get("x-vehicle-id")
+    host = websocket.client.host if websocket.client else None
+    client = vehicle_id or client_key(websocket.headers, host)
+    session = await run_sync(sessions.get, vehicle_id)
+    await websocket.send_json({"type": "session", **session.to_dict()})
+    try:
+        while True:
+            raw = await websocket.receive_text()
+            try:
+                data = json.loads(raw)
+            except json.JSONDecodeError:
+                data = raw
+            message = data.get("message", "") if isinstance(data, dict) else str(data)
+            msg_id = data.get("id") if isinstance(data, dict) else None
+            if not message.strip():
+                await websocket.send_json({"type": "error", "id": msg_id, "code": 400, "error": "message 不能为空"})
+                continue
+            quality = bool(data.get("quality")) if isinstance(data, dict) else False
+            await ws_turn(websocket, session, client, vehicle_id, message, msg_id, quality)
+    except WebSocketDisconnect:
+        pass
+
+async def ws_turn(websocket: WebSocket, session, client: str, vehicle_id: Optional[str], message: str, msg_id,
+                  quality: bool = False):
+    """处理长连接上的一轮对话，出错时只回一条 error 事件，连接保持"""
+    followup = session.resolve(message)
+    output = None
+    try:
+        async with admission.admit(client, classify_priority(message)):
+            async for event, payload in iterate_sync(pipeline.stream_chat, message, *(followup or (None, None)),
+                                                     vehicle_id, quality):
+                if event == "done":
+                    output = payload
+                else:
+                    await websocket.send_json({"type": event, "id": msg_id, "data": payload})
+    except AdmissionRejected as e:
+        await websocket.send_json({"type": "error", "id": msg_id, "code": 429,
+                                   "error": e.reason, "retry_after": e.retry_after})
+        return
+    except LLMError as e:
+        await websocket.send_json({"type": "error", "id": msg_id, "code": e.http_status, "error": str(e)})
+        return
+    except WebSocketDisconnect:
+        raise
+    except Exception as e:
+        await websocket.send_json({"type": "error", "id": msg_id, "code": 500, "error": str(e)})
+        return
+
+    session.record(message, output)
+    await run_sync(sessions.save, session)
+    log_id = (await run_sync(pipeline.save_chat_logs, [(message, output)]))[0]
+    await websocket.send_json({
+        "type": "done",
+        "id": msg_id,
+        "data": {
+            "latency_ms": output["latency_ms"],
+            "token_usage": output["token_usage"],
+            "escalations": output["escalations"],
+            "degraded": output["degraded"],
+            "followup": followup is not None,
+            "state_hits": output["state_hits"],
+            "log_id": log_id
+        }
+    })
+
 @app.get("/knowledge")
 async def get_knowledge():
     """获取当前激活的知识库"""
-    kb_path = "data/knowledge_base.json"
-    if os.path.exists(kb_path):
-        with open(kb_path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {"rules": [], "intents": []}
+    active = kb_store.active()
+    if active is None:
+        return {"rules": [], "intents": []}
+    return kb_store.load(active["version"])
 
 # ========== Knowledge Base File Management ==========
 
 DATA_DIR = "data"
-UPLOADS_DIR = "data/uploads"
-KB_FILE = "data/knowledge_base.json"
+UPLOADS_DIR = "data/uploads"  # 旧版按文件名存放的上传目录，启动时迁移进 kb_store
 KB_DEFAULT = "data/knowledge_base.default.json"
 
+# 别的 worker 切换知识库后，本 worker 最多这么久之后跟上（检查激活指针和索引的 mtime），0 关闭
+KB_WATCH_S = float(os.getenv("KB_WATCH_S", "2"))
+
+_kb_lock = threading.RLock()
+_kb_version: Optional[str] = None  # 本 worker 已激活的版本
+
+def activate_kb(version: str):
+    """激活知识库版本: 加载本地分类器，结果缓存切到新版本，并在后台按新版本预热缓存"""
+    global _kb_version
+    with _kb_lock:
+        kb = kb_store.load(version)
+        classifier.activate(kb, kb_store.object_prefix(version))
+        llm_cache.set_kb_version(version[:16])
+        prewarm.start(kb)
+        _kb_version = version
+
+def sync_kb():
+    """激活指针指向的版本与本 worker 的不同时重新激活"""
+    active = kb_store.active()
+    with _kb_lock:
+        if active is not None and active["version"] != _kb_version:
+            activate_kb(active["version"])
+
+def watch_kb():
+    revision = kb_store.revision()
+    while True:
+        time.sleep(KB_WATCH_S)
+        current = kb_store.revision()
+        if current == revision:
+            continue
+        revision = current
+        try:
+            sync_kb()
+        except Exception:
+            revision = None  # 文件正在替换或已被删除，下一轮再试
+
+def init_kb():
+    kb_store.init(KB_DEFAULT, UPLOADS_DIR)
+    sync_kb()
+    if KB_WATCH_S > 0:
+        threading.Thread(target=watch_kb, name="kb-watch", daemon=True).start()
+
 def clean_text(text):
+    pd = startup.lazy_import("pandas")
     if pd.isna(text):
         return ""
     return str(text).strip()
 
 def extract_intents_from_excel(xls):
     """Extract intents from Vehicle Query sheet with deduplication."""
+    pd = startup.lazy_import("pandas")  # pandas 只有知识库导入导出用到，按需加载
     intents = []
     seen_intents = set()
     duplicates = 0
@@ -231,43 +630,16 @@ def extract_intents_from_excel(xls):
 @app.get("/knowledge/files")
 async def list_knowledge_files():
     """List all knowledge base files."""
-    files = []
-    
-    # System default
-    if os.path.exists(KB_DEFAULT):
-        with open(KB_DEFAULT, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        files.append({
-            "id": "default",
-            "name": "knowledge_base.default",
-            "source": "System",
-            "rules": len(data.get("rules", [])),
-            "intents": len(data.get("intents", [])),
-            "active": not os.path.exists(f"{UPLOADS_DIR}/active.txt")
-        })
-    
-    # User uploads
-    if os.path.exists(UPLOADS_DIR):
-        active_file = None
-        if os.path.exists(f"{UPLOADS_DIR}/active.txt"):
-            with open(f"{UPLOADS_DIR}/active.txt", "r") as f:
-                active_file = f.read().strip()
-        
-        for fname in os.listdir(UPLOADS_DIR):
-            if fname.endswith(".json") and fname != "active.txt":
-                fpath = os.path.join(UPLOADS_DIR, fname)
-                with open(fpath, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                files.append({
-                    "id": fname.replace(".json", ""),
-                    "name": fname.replace(".json", ""),
-                    "source": "Import",
-                    "rules": len(data.get("rules", [])),
-                    "intents": len(data.get("intents", [])),
-                    "active": fname == active_file
-                })
-    
-    return files
+    active = kb_store.active() or {}
+    return [{
+        "id": name,
+        "name": "knowledge_base.default" if name == DEFAULT_NAME else name,
+        "source": meta["source"],
+        "rules": meta["rules"],
+        "intents": meta["intents"],
+        "version": meta["version"],
+        "active": name == active.get("name")
+    } for name, meta in kb_store.list()]
 
 @app.post("/knowledge/upload")
 async def upload_knowledge(file: UploadFile = File(...)):
@@ -276,90 +648,74 @@ async def upload_knowledge(file: UploadFile = File(...)):
         raise HTTPException(400, "Only Excel files (.xlsx, .xls) are supported")
     
     content = await file.read()
-    xls = pd.ExcelFile(io.BytesIO(content))
-    
-    intents, duplicates = extract_intents_from_excel(xls)
-    
-    if not intents:
-        raise HTTPException(400, "No valid intents found. Check Excel format (need 'Vehicle Query' sheet with Ability, Feature, Intent, Query columns)")
+    source_hash = hashlib.sha1(content).hexdigest()
     
-    kb = {"rules": [], "intents": intents}
-    
-    # Save to uploads folder
-    os.makedirs(UPLOADS_DIR, exist_ok=True)
-    base_name = os.path.splitext(file.filename)[0]
-    save_path = os.path.join(UPLOADS_DIR, f"{base_name}.json")
-    
-    # Avoid overwrite
-    counter = 1
-    while os.path.exists(save_path):
-        save_path = os.path.join(UPLOADS_DIR, f"{base_name}_{counter}.json")
-        counter += 1
-    
-    with open(save_path, "w", encoding="utf-8") as f:
-        json.dump(kb, f, ensure_ascii=False, indent=2)
+    # Same workbook uploaded before: reuse the stored version without parsing
+    name = kb_store.find_source(source_hash)
+    duplicate = name is not None
+    if not duplicate:
+        pd = startup.lazy_import("pandas")
+        xls = pd.ExcelFile(io.BytesIO(content))
+        intents, duplicates = extract_intents_from_excel(xls)
+        
+        if not intents:
+            raise HTTPException(400, "No valid intents found. Check Excel format (need 'Vehicle Query' sheet with Ability, Feature, Intent, Query columns)")
+        
+        kb = {"rules": [], "intents": intents}
+        base_name = os.path.splitext(file.filename)[0]
+        name, duplicate = kb_store.put(kb, base_name, source_hash=source_hash, duplicates_removed=duplicates)
     
     # Auto activate
-    shutil.copy(save_path, KB_FILE)
-    with open(f"{UPLOADS_DIR}/active.txt", "w") as f:
-        f.write(os.path.basename(save_path))
+    version = kb_store.activate(name)
+    await run_in_threadpool(activate_kb, version)
     
+    meta = kb_store.get(name)
     return {
         "status": "ok",
-        "filename": os.path.basename(save_path).replace(".json", ""),
-        "intents": len(intents),
-        "duplicates_removed": duplicates
+        "filename": name,
+        "version": version,
+        "duplicate": duplicate,
+        "intents": meta["intents"],
+        "duplicates_removed": meta.get("duplicates_removed", 0)
     }
 
 @app.post("/knowledge/activate/{file_id}")
 async def activate_knowledge(file_id: str):
     """Activate a knowledge base file."""
-    if file_id == "default":
-        shutil.copy(KB_DEFAULT, KB_FILE)
-        if os.path.exists(f"{UPLOADS_DIR}/active.txt"):
-            os.remove(f"{UPLOADS_DIR}/active.txt")
-    else:
-        fpath = os.path.join(UPLOADS_DIR, f"{file_id}.json")
-        if not os.path.exists(fpath):
-            raise HTTPException(404, "File not found")
-        shutil.copy(fpath, KB_FILE)
-        with open(f"{UPLOADS_DIR}/active.txt", "w") as f:
-            f.write(f"{file_id}.json")
+    try:
+        version = kb_store.activate(file_id)
+    except KeyError:
+        raise HTTPException(404, "File not found")
     
-    return {"status": "ok", "active": file_id}
+    await run_in_threadpool(activate_kb, version)
+    return {"status": "ok", "active": file_id, "version": version}
 
 @app.delete("/knowledge/files/{file_id}")
 async def delete_knowledge_file(file_id: str):
     """Delete an uploaded knowledge base file."""
-    if file_id == "default":
+    if file_id == DEFAULT_NAME:
         raise HTTPException(400, "Cannot delete system default")
     
-    fpath = os.path.join(UPLOADS_DIR, f"{file_id}.json")
-    if not os.path.exists(fpath):
+    if kb_store.get(file_id) is None:
         raise HTTPException(404, "File not found")
     
-    # Check if active
-    active_file = None
-    if os.path.exists(f"{UPLOADS_DIR}/active.txt"):
-        with open(f"{UPLOADS_DIR}/active.txt", "r") as f:
-            active_file = f.read().strip()
-    
-    if active_file == f"{file_id}.json":
+    was_active = (kb_store.active() or {}).get("name") == file_id
+    kb_store.delete(file_id)
+    if was_active:
         # Switch to default
-        shutil.copy(KB_DEFAULT, KB_FILE)
-        os.remove(f"{UPLOADS_DIR}/active.txt")
-    
-    os.remove(fpath)
+        version = kb_store.activate(DEFAULT_NAME)
+        await run_in_threadpool(activate_kb, version)
     return {"status": "ok"}
 
 @app.get("/knowledge/export")
 async def export_knowledge():
     """Export current knowledge base as Excel."""
-    if not os.path.exists(KB_FILE):
+    pd = startup.lazy_import("pandas")
+    active = kb_store.active()
+    if active is None:
         raise HTTPException(404, "No knowledge base found")
     
-    with open(KB_FILE, "r", encoding="utf-8") as f:
-        kb = json.load(f)
+    kb = kb_store.load(active["version"])
     
     # Deduplicate intents
     seen = set()
@@ -391,6 +747,7 @@ async def export_knowledge():
 @app.get("/knowledge/template")
 async def download_template():
     """Download Excel template."""
+    pd = startup.lazy_import("pandas")
     template_path = "data/template.xlsx"
     if not os.path.exists(template_path):
         # Create template
@@ -412,6 +769,38 @@ async def download_template():
     
     return FileResponse(template_path, filename="knowledge_template.xlsx", media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
 
+@app.get("/logs/{log_id}/trace")
+async def get_log_trace(log_id: int):
+    """获取单条日志的 span 树（瀑布图）"""
+    db = SessionLocal()
+    try:
+        row = db.query(ChatTrace).filter(ChatTrace.log_id == log_id).first()
+        if row is None:
+            raise HTTPException(404, "Trace not found")
+        return tracing.compact_to_tree({"trace_id": row.trace_id, "spans": json.loads(row.spans)})
+    finally:
+        db.close()
+
+@app.get("/shadow/report")
+async def shadow_report(candidate: Optional[str] = None, window: int = shadow_traffic.SHADOW_REPORT_WINDOW):
+    """影子流量对比: 按候选配置汇总一致率、延迟和 token 差异、不一致样例"""
+    return {
+        "runner": shadow.get_stats(),
+        "candidates": await run_in_threadpool(shadow_traffic.report, candidate, window)
+    }
+
+@app.get("/logs/stream")
+async def stream_logs(request: Request, last_id: Optional[int] = None):
+    """新写入日志的摘要推送（SSE）；断线重连带 Last-Event-ID（或 last_id 参数）补发之后的日志"""
+    header = request.headers.get("last-event-id")
+    if header and header.isdigit():
+        last_id = int(header)
+    return StreamingResponse(
+        logfeed.stream(last_id, request.is_disconnected),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/logs")
 async def get_logs(limit: int = 50):
     """获取日志"""
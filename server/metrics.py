@@ -0,0 +1,166 @@
+# Prometheus 文本格式指标（无第三方依赖，每次记录只有一次加锁和字典更新）
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry: List["_Metric"] = []
+
+# 非线上请求的后台工作（如缓存预热）在自己的上下文里标记来源，请求相关的指标不记录它们
+_background: ContextVar[Optional[str]] = ContextVar("metrics_background", default=None)
+
+def mark_background(source: str):
+    """当前上下文里的工作不计入请求指标；LLM token 改记到 BACKGROUND_TOKENS"""
+    _background.set(source)
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Sequence[str], values: Sequence, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), background: bool = False):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.background = background  # 后台工作也记录
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: Dict[str, object]) -> Tuple:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), background: bool = False):
+        super().__init__(name, documentation, labelnames, background)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        if not self.background and _background.get() is not None:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS, background: bool = False):
+        super().__init__(name, documentation, labelnames, background)
+        self.buckets = tuple(sorted(buckets))
+        # key -> [每个桶的计数..., +Inf 计数, sum]
+        self._values: Dict[Tuple, List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        if not self.background and _background.get() is not None:
+            return
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [0] * (len(self.buckets) + 2)
+            series[idx] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._values.items()]
+        for key, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            cumulative += series[len(self.buckets)]
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {series[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+class Gauge(_Metric):
+    """取值时回调的仪表，用于并发数、队列长度等现成状态"""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, fn: Callable[[], float]):
+        super().__init__(name, documentation)
+        self.fn = fn
+
+    def render(self) -> List[str]:
+        return super().render() + [f"{self.name} {self.fn()}"]
+
+def render() -> str:
+    lines: List[str] = []
+    for metric in list(_registry):
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+# ========== 指标定义 ==========
+
+REQUEST_SECONDS = Histogram("car_bot_request_duration_seconds", "HTTP endpoint latency", ["endpoint"])
+REQUEST_ERRORS = Counter("car_bot_request_errors_total", "Failed requests by endpoint and error type", ["endpoint", "error"])
+NODE_SECONDS = Histogram("car_bot_node_duration_seconds", "Workflow node latency", ["node"])
+STAGE_SECONDS = Histogram("car_bot_stage_duration_seconds", "Local processing stages (json_parse, db_write)", ["stage"])
+LLM_SECONDS = Histogram("car_bot_llm_duration_seconds", "Upstream LLM call latency", ["agent", "model"])
+LLM_TOKENS = Counter("car_bot_llm_tokens_total", "LLM tokens consumed", ["agent", "model", "type"])
+LLM_ERRORS = Counter("car_bot_llm_errors_total", "Failed upstream LLM calls", ["agent", "model"])
+CACHE_EVENTS = Counter("car_bot_cache_events_total", "Cache / reuse decisions", ["cache", "result"])
+JSON_REPAIRS = Counter("car_bot_json_repairs_total", "Model outputs repaired locally instead of re-requested", ["agent", "repair"])
+FALLBACKS = Counter("car_bot_fallbacks_total", "Escalations and local fallbacks", ["agent", "reason"])
+BACKGROUND_TOKENS = Counter("car_bot_background_llm_tokens_total", "LLM tokens consumed by background work (prewarm)",
+                            ["source", "type"], background=True)
+
+def count_tokens(input_tokens: int, output_tokens: int, **labels):
+    """LLM token 计数：线上请求记到 LLM_TOKENS（按 agent/model），后台工作按来源记到 BACKGROUND_TOKENS"""
+    source = _background.get()
+    if source is None:
+        LLM_TOKENS.inc(input_tokens, type="input", **labels)
+        LLM_TOKENS.inc(output_tokens, type="output", **labels)
+    else:
+        BACKGROUND_TOKENS.inc(input_tokens, source=source, type="input")
+        BACKGROUND_TOKENS.inc(output_tokens, source=source, type="output")
+
+def timed_node(name: str):
+    """工作流节点计时装饰器"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with NODE_SECONDS.time(node=name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
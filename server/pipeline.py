@@ -0,0 +1,147 @@
+# 单条消息的完整 Agent 流程与日志写入，供 /chat、批量接口和离线脚本共用
+import json
+import os
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import logfeed
+import metrics
+import tracing
+from agents.base import BaseAgent
+from database import SessionLocal, ChatLog, ChatTrace
+from graph.workflow import get_workflow
+from dispatch import dispatcher
+
+# 端到端请求预算（秒），各 Agent 的调用超时不会超过剩余预算
+REQUEST_BUDGET_S = float(os.getenv("REQUEST_BUDGET_S", "10"))
+
+def new_state(message: str, commands: Optional[List[Dict[str, Any]]] = None,
+              speculative: Optional[Dict[int, Dict[str, Any]]] = None,
+              vehicle_id: Optional[str] = None, quality: bool = False) -> Dict[str, Any]:
+    return {
+        "message": message,
+        "commands": list(commands or []),
+        "results": [],
+        "summary": "",
+        "current_index": 0,
+        "speculative": dict(speculative or {}),
+        "speculative_index": None,
+        "speculative_used": False,
+        "vehicle_id": vehicle_id,
+        "planned": [],
+        "quality": quality
+    }
+
+def stream_chat(message: str, commands: Optional[List[Dict[str, Any]]] = None,
+                speculative: Optional[Dict[int, Dict[str, Any]]] = None,
+                vehicle_id: Optional[str] = None, quality: bool = False) -> Iterator[Tuple[str, Any]]:
+    """逐节点产出 ("commands", 指令列表) / ("result", 单条结果) / ("summary", 回复)，最后是 ("done", 汇总)
+
+    commands 非空时跳过路由（会话追问已在本地解析），speculative 为各指令的预解析结果，
+    vehicle_id 用于按车辆状态短路已满足/相对调节的指令，并把每条结果的动作码一产生就交给该车的下发队列；
+    quality 时多条回复交给模型润色。
+    需在独立的 contextvars 上下文中调用。
+    """
+    start_time = time.time()
+    received_ns = time.perf_counter_ns()  # 下发队列据此统计从收到请求到车辆确认的耗时
+    BaseAgent.reset_tokens()  # 重置 token 计数
+    BaseAgent.set_request_budget(REQUEST_BUDGET_S)
+    trace = tracing.start_trace("request", message=message)
+
+    # 使用 LangGraph 工作流
+    result = None
+    ready: Dict[int, Dict[str, Any]] = {}
+    emitted = 0
+    for update in get_workflow().stream(new_state(message, commands, speculative, vehicle_id, quality)):
+        for node, state in update.items():
+            result = state
+            if node == "split":
+                yield "commands", state["commands"]
+            elif node == "process":
+                # 一次 process 处理一组同模块指令，交错的模块（A、B、A）里后一条 A 会先于 B 出结果；
+                # 只放出按指令顺序已连续的部分，下发和推送都保持用户说的顺序
+                ready.update((item["index"], item) for item in state["results"])
+                order = [cmd["index"] for cmd in state["commands"]]
+                while emitted < len(order) and order[emitted] in ready:
+                    item = ready[order[emitted]]
+                    emitted += 1
+                    dispatcher.submit(vehicle_id, item, received_ns, trace.trace_id)
+                    yield "result", item
+            elif node == "summarize":
+                yield "summary", state["summary"]
+
+    yield "done", {
+        "commands": result["commands"],
+        "results": result["results"],
+        "summary": result["summary"],
+        "speculative_hit": result.get("speculative_used", False),
+        "state_hits": len(result.get("planned", [])),
+        "latency_ms": int((time.time() - start_time) * 1000),
+        "token_usage": BaseAgent.get_tokens(),
+        "escalations": BaseAgent.get_escalations(),
+        "degraded": bool(BaseAgent.get_degraded()),
+        "trace": trace
+    }
+
+def run_chat(message: str, commands: Optional[List[Dict[str, Any]]] = None,
+             speculative: Optional[Dict[int, Dict[str, Any]]] = None,
+             vehicle_id: Optional[str] = None, quality: bool = False) -> Dict[str, Any]:
+    """跑完整工作流并返回汇总（需在独立的 contextvars 上下文中调用）"""
+    output = None
+    for event, payload in stream_chat(message, commands, speculative, vehicle_id, quality):
+        if event == "done":
+            output = payload
+    return output
+
+def _chat_log(message: str, output: Dict[str, Any]) -> ChatLog:
+    results = output["results"]
+    raw = {k: v for k, v in output.items() if k != "trace"}
+    return ChatLog(
+        user_input=message,
+        intent_detected=",".join([r["intent"] for r in results]),
+        full_prompt="Multi-agent workflow",
+        raw_response=json.dumps(raw, ensure_ascii=False),
+        parsed_action=json.dumps([r["action"] for r in results], ensure_ascii=False),
+        latency_ms=output["latency_ms"],
+        token_usage=json.dumps(output["token_usage"])
+    )
+
+def save_chat_logs(items: List[Tuple[str, Dict[str, Any]]]) -> List[int]:
+    """一个事务内批量写入 ChatLog 及其 trace，返回各自的 log_id"""
+    if not items:
+        return []
+    db = SessionLocal()
+    try:
+        with metrics.STAGE_SECONDS.time(stage="db_write"):
+            start_ns = time.time_ns()
+            logs = [_chat_log(message, output) for message, output in items]
+            db.add_all(logs)
+            db.flush()
+            end_ns = time.time_ns()
+
+            traces = []
+            for log, (_, output) in zip(logs, items):
+                trace = output["trace"]
+                trace.record("log_write", start_ns, end_ns, rows=len(logs))
+                trace.root.set(log_id=log.id, **output["token_usage"])
+                trace.finish()
+                compact = trace.to_compact()
+                output["trace_compact"] = compact
+                traces.append(ChatTrace(
+                    log_id=log.id,
+                    trace_id=trace.trace_id,
+                    spans=json.dumps(compact["spans"], ensure_ascii=False, separators=(",", ":"))
+                ))
+            db.add_all(traces)
+            # 提交前取好 id 和摘要（提交后访问属性会逐行回查）
+            log_ids = [log.id for log in logs]
+            events = [logfeed.summarize(log.id, message, output, log.timestamp)
+                      for log, (message, output) in zip(logs, items)]
+            with logfeed.log_feed.committing():
+                db.commit()
+                logfeed.log_feed.publish(events)
+    finally:
+        db.close()
+    for _, output in items:
+        tracing.export(output["trace"])
+    return log_ids
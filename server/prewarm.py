@@ -0,0 +1,222 @@
+# 结果缓存预热：取历史日志里最常见的输入和当前知识库的代表性问法，后台跑一遍流程把各 Agent 的结果写进缓存
+import contextvars
+import os
+import socket
+import threading
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import func
+
+import metrics
+from admission import admission
+from agents.llmcache import kb_version, normalize
+from database import SessionLocal, ChatLog
+from shared_store import store
+
+PREWARM = os.getenv("PREWARM", "1") == "1"
+PREWARM_TOP_N = int(os.getenv("PREWARM_TOP_N", "200"))
+PREWARM_LOG_WINDOW = int(os.getenv("PREWARM_LOG_WINDOW", "20000"))  # 只统计最近这么多条日志
+PREWARM_CONCURRENCY = int(os.getenv("PREWARM_CONCURRENCY", "2"))
+PREWARM_TOKEN_BUDGET = int(os.getenv("PREWARM_TOKEN_BUDGET", "50000"))
+# 预热过的输入覆盖到这个比例的历史流量就报告就绪，其余继续在后台跑完
+PREWARM_TARGET_COVERAGE = float(os.getenv("PREWARM_TARGET_COVERAGE", "0.8"))
+PREWARM_READY_TIMEOUT_S = float(os.getenv("PREWARM_READY_TIMEOUT_S", "60"))
+# 多 worker 时每个知识库版本只由抢到这个锁的 worker 预热，结果缓存在共享存储里大家共用；锁到期后可再次预热
+PREWARM_LOCK_TTL_S = float(os.getenv("PREWARM_LOCK_TTL_S", "600"))
+# 线上请求占满准入名额或在排队时暂停提交新的预热，每隔这么久再看一次
+PREWARM_PAUSE_S = float(os.getenv("PREWARM_PAUSE_S", "0.5"))
+
+def top_utterances(limit: int = PREWARM_TOP_N, window: int = PREWARM_LOG_WINDOW) -> Tuple[List[Tuple[str, int]], int]:
+    """最近 window 条日志里归一化后最常见的输入，返回 ([(输入, 次数)], 总次数)"""
+    db = SessionLocal()
+    try:
+        recent = db.query(ChatLog.user_input).order_by(ChatLog.id.desc()).limit(window).subquery()
+        rows = db.query(recent.c.user_input, func.count()).group_by(recent.c.user_input).all()
+    finally:
+        db.close()
+    counts: Counter = Counter()
+    for text, n in rows:
+        key = normalize(text or "")
+        if key:
+            counts[key] += n
+    return counts.most_common(limit), sum(counts.values())
+
+def kb_queries(kb: Dict[str, Any]) -> List[str]:
+    """知识库里的示例问法，跳过带 【位置】 之类占位符的模板"""
+    queries = (normalize(item.get("query") or "") for item in kb.get("intents", []))
+    return list(dict.fromkeys(q for q in queries if q and "【" not in q and "[" not in q))
+
+def _warm(text: str) -> Dict[str, Any]:
+    """跑一遍流程；标记为后台工作，不计入请求延迟、token 等线上指标"""
+    import pipeline
+
+    metrics.mark_background("prewarm")
+    return pipeline.run_chat(text)
+
+class WarmJob:
+    """按权重从高到低跑候选输入；覆盖率达到目标时置 reached，预算用完、跑完或被取消时置 finished"""
+
+    def __init__(self, candidates: List[Tuple[str, int]], total_weight: int,
+                 target: float = PREWARM_TARGET_COVERAGE, token_budget: int = PREWARM_TOKEN_BUDGET,
+                 concurrency: int = PREWARM_CONCURRENCY):
+        self.candidates = candidates
+        self.total_weight = total_weight
+        self.target = target
+        self.token_budget = token_budget
+        self.concurrency = max(1, concurrency)
+        self.state = "running"
+        self.warmed = 0
+        self.failed = 0
+        self.tokens = 0
+        self.covered = 0
+        self.pauses = 0
+        self.paused = False
+        self.started = time.monotonic()
+        self.reached_ms: Optional[int] = None
+        self.finished_ms: Optional[int] = None
+        self.reached = threading.Event()
+        self.finished = threading.Event()
+        self._cancelled = False
+
+    @property
+    def coverage(self) -> float:
+        return self.covered / self.total_weight if self.total_weight else 1.0
+
+    def cancel(self):
+        self._cancelled = True
+
+    def _yield_to_traffic(self) -> bool:
+        """线上请求占满名额或在排队时不提交新的预热"""
+        busy = admission.saturated()
+        if busy and not self.paused:
+            self.pauses += 1
+        self.paused = busy
+        return busy
+
+    def run(self):
+        pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="prewarm")
+        futures: Dict[Any, Tuple[str, int]] = {}
+        next_candidate = 0
+        try:
+            while True:
+                paused = False
+                while (len(futures) < self.concurrency and not self._cancelled
+                       and self.tokens < self.token_budget and next_candidate < len(self.candidates)):
+                    if self._yield_to_traffic():
+                        paused = True
+                        break
+                    candidate = self.candidates[next_candidate]
+                    try:
+                        future = pool.submit(contextvars.copy_context().run, _warm, candidate[0])
+                    except RuntimeError:  # 进程退出中，不再提交
+                        self._cancelled = True
+                        break
+                    next_candidate += 1
+                    futures[future] = candidate
+                if not futures:
+                    if paused:
+                        time.sleep(PREWARM_PAUSE_S)
+                        continue
+                    break
+                done, _ = wait(futures, timeout=PREWARM_PAUSE_S if paused else None, return_when=FIRST_COMPLETED)
+                for future in done:
+                    _, weight = futures.pop(future)
+                    try:
+                        output = future.result()
+                    except Exception:
+                        self.failed += 1
+                        continue
+                    self.tokens += output["token_usage"].get("total_tokens", 0)
+                    if output["degraded"]:
+                        self.failed += 1  # 降级结果不进缓存，不算预热过
+                        continue
+                    self.warmed += 1
+                    self.covered += weight
+                if not self.reached.is_set() and self.coverage >= self.target:
+                    self._mark_reached()
+        finally:
+            pool.shutdown(wait=True)
+            self.paused = False
+            if self._cancelled:
+                self.state = "cancelled"
+            elif self.tokens >= self.token_budget and self.warmed + self.failed < len(self.candidates):
+                self.state = "budget_exhausted"
+            else:
+                self.state = "done"
+            self.finished_ms = int((time.monotonic() - self.started) * 1000)
+            self.finished.set()
+
+    def _mark_reached(self):
+        self.reached_ms = int((time.monotonic() - self.started) * 1000)
+        self.reached.set()
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "candidates": len(self.candidates),
+            "warmed": self.warmed,
+            "failed": self.failed,
+            "tokens": self.tokens,
+            "token_budget": self.token_budget,
+            "coverage": round(self.coverage, 3),
+            "paused": self.paused,
+            "pauses": self.pauses,
+            "target_coverage": self.target,
+            "reached_ms": self.reached_ms,
+            "finished_ms": self.finished_ms
+        }
+
+def build_candidates(kb: Dict[str, Any]) -> Tuple[List[Tuple[str, int]], int]:
+    """历史高频输入按出现次数计权；没有历史日志时知识库问法各计 1，用它们算覆盖率"""
+    top, total = top_utterances()
+    seen = {text for text, _ in top}
+    queries = [q for q in kb_queries(kb) if q not in seen]
+    if total:
+        return top + [(q, 0) for q in queries], total
+    return [(q, 1) for q in queries], len(queries)
+
+_lock = threading.Lock()
+_job: Optional[WarmJob] = None
+_owner: Optional[str] = None  # 本版本由别的 worker 预热时记下是谁
+
+def start(kb: Dict[str, Any]) -> Optional[WarmJob]:
+    """（重新）开始预热；知识库切换时调用，旧任务会被取消。别的 worker 已在预热这个版本时不启动，返回 None"""
+    global _job, _owner
+    if not PREWARM:
+        return None
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    with _lock:
+        if _job is not None:
+            _job.cancel()
+            _job = None
+        if not store.add("prewarm", kb_version(), worker, PREWARM_LOCK_TTL_S):
+            owner = store.get("prewarm", kb_version())
+            if owner != worker:
+                _owner = owner
+                return None
+        _owner = None
+    job = WarmJob(*build_candidates(kb))
+    with _lock:
+        _job = job
+    threading.Thread(target=job.run, name="prewarm", daemon=True).start()
+    return job
+
+def wait_ready(timeout: float = PREWARM_READY_TIMEOUT_S) -> bool:
+    """等到覆盖率达标或任务结束（启动预热的最后一步）；超时也返回，不让就绪无限期挂起"""
+    job = _job
+    if job is None:
+        return True
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if job.reached.wait(0.05) or job.finished.is_set():
+            return True
+    return False
+
+def status() -> Optional[Dict[str, Any]]:
+    job = _job
+    if job is None and _owner is not None:
+        return {"state": "elsewhere", "owner": _owner}
+    return job.status() if job is not None else None
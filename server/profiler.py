@@ -0,0 +1,162 @@
+# 按需采样分析器：定时抓取所有线程的调用栈，按线程状态区分 on-CPU / 等待，并标注当时所在的流程节点
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+import tracing
+
+PROFILE_MAX_S = float(os.getenv("PROFILE_MAX_S", "60"))
+PROFILE_MIN_INTERVAL_MS = float(os.getenv("PROFILE_MIN_INTERVAL_MS", "1"))
+PROFILE_MAX_DEPTH = int(os.getenv("PROFILE_MAX_DEPTH", "128"))
+
+CPU, WAIT = "cpu", "wait"
+NO_NODE = "-"
+
+# 栈帧: (函数, 文件, 行号)；一条样本: (状态, 节点, 栈帧元组从根到叶)
+Frame = Tuple[str, str, int]
+Sample = Tuple[str, str, Tuple[Frame, ...]]
+
+class ProfilerBusy(Exception):
+    pass
+
+def _thread_state(native_id: Optional[int]) -> str:
+    """/proc 里的线程调度状态: R 为正在跑（或可运行），其余（S/D 等）算等待；读不到时按 CPU 计"""
+    if native_id is None:
+        return CPU
+    try:
+        with open(f"/proc/self/task/{native_id}/stat", "rb") as f:
+            stat = f.read()
+    except OSError:
+        return CPU
+    # 第 2 个字段是括号里的线程名，可能含空格，状态在最后一个 ')' 之后
+    return CPU if stat[stat.rindex(b")") + 2:stat.rindex(b")") + 3] == b"R" else WAIT
+
+def _stack(frame) -> Tuple[Frame, ...]:
+    frames: List[Frame] = []
+    while frame is not None and len(frames) < PROFILE_MAX_DEPTH:
+        code = frame.f_code
+        frames.append((code.co_name, code.co_filename, frame.f_lineno))
+        frame = frame.f_back
+    frames.reverse()
+    return tuple(frames)
+
+class Profile:
+    """一次采样的结果；样本按 (状态, 节点, 栈) 计数"""
+
+    def __init__(self, seconds: float, interval_s: float):
+        self.seconds = seconds
+        self.interval_s = interval_s
+        self.counts: Counter = Counter()
+        self.ticks = 0
+        self.started = time.time()
+        self.elapsed = 0.0
+
+    def summary(self) -> Dict[str, Any]:
+        by_state: Counter = Counter()
+        by_node: Counter = Counter()
+        for (state, node, _), n in self.counts.items():
+            by_state[state] += n
+            by_node[(node, state)] += n
+        return {
+            "seconds": round(self.elapsed, 3),
+            "interval_ms": self.interval_s * 1000,
+            "ticks": self.ticks,
+            "samples": sum(self.counts.values()),
+            "states": dict(by_state),
+            "nodes": [{"node": node, "state": state, "samples": n} for (node, state), n in by_node.most_common()]
+        }
+
+    def collapsed(self) -> str:
+        """flamegraph.pl / speedscope 都能读的折叠栈: 状态;节点;帧;...;帧 次数"""
+        lines = []
+        for (state, node, stack), n in self.counts.most_common():
+            frames = ";".join(f"{name} ({os.path.basename(path)}:{line})" for name, path, line in stack)
+            lines.append(f"{state};node:{node};{frames} {n}")
+        return "\n".join(lines) + "\n"
+
+    def speedscope(self, name: str = "car-bot") -> Dict[str, Any]:
+        """speedscope 文件格式，on-CPU 和等待各一个 sampled profile，节点作为最外层的伪帧"""
+        frames: List[Dict[str, Any]] = []
+        frame_index: Dict[Tuple[str, str, int], int] = {}
+
+        def index(key: Tuple[str, str, int]) -> int:
+            i = frame_index.get(key)
+            if i is None:
+                i = frame_index[key] = len(frames)
+                frame = {"name": key[0]}
+                if key[1]:
+                    frame.update(file=key[1], line=key[2])
+                frames.append(frame)
+            return i
+
+        profiles = []
+        for state in (CPU, WAIT):
+            samples, weights = [], []
+            for (s, node, stack), n in self.counts.items():
+                if s != state:
+                    continue
+                samples.append([index((f"node:{node}", "", 0))] + [index(f) for f in stack])
+                weights.append(n * self.interval_s)
+            profiles.append({
+                "type": "sampled",
+                "name": f"{name} {state}",
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": round(self.elapsed, 6),
+                "samples": samples,
+                "weights": weights
+            })
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": frames},
+            "profiles": profiles,
+            "name": name,
+            "activeProfileIndex": 0,
+            "exporter": "car-bot profiler"
+        }
+
+_busy = threading.Lock()
+
+def sample(seconds: float, interval_ms: float = 10, idle: bool = False) -> Profile:
+    """在调用线程里采样 seconds 秒（同一时间只允许一个）
+
+    idle=False 时丢掉不在任何 span 里且处于等待的线程（空闲的线程池、事件循环在 select 上），
+    只看请求相关的等待。
+    """
+    seconds = min(max(seconds, 0.01), PROFILE_MAX_S)
+    interval_s = max(interval_ms, PROFILE_MIN_INTERVAL_MS) / 1000
+    if not _busy.acquire(blocking=False):
+        raise ProfilerBusy("a profile is already running")
+    try:
+        profile = Profile(seconds, interval_s)
+        me = threading.get_ident()
+        start = time.perf_counter()
+        deadline = start + seconds
+        next_tick = start
+        while True:
+            native_ids = {t.ident: getattr(t, "native_id", None) for t in threading.enumerate()}
+            nodes = tracing.thread_spans()
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                node = nodes.get(ident, NO_NODE)
+                state = _thread_state(native_ids.get(ident))
+                if state == WAIT and node == NO_NODE and not idle:
+                    continue
+                profile.counts[(state, node, _stack(frame))] += 1
+            profile.ticks += 1
+            next_tick += interval_s
+            now = time.perf_counter()
+            if next_tick >= deadline:
+                break
+            if next_tick > now:
+                time.sleep(next_tick - now)
+            else:
+                next_tick = now  # 采样跟不上时不补采
+        profile.elapsed = time.perf_counter() - start
+        return profile
+    finally:
+        _busy.release()
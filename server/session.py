@@ -0,0 +1,144 @@
+# 会话状态：最近几轮对话、上一条指令的模块/意图、各模块已知参数（如座椅位置）
+import os
+import re
+import secrets
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
+
+from metrics import CACHE_EVENTS
+from agents.modules import MODULE_INTENTS
+from shared_store import store
+
+SESSION_HISTORY = int(os.getenv("SESSION_HISTORY", "6"))
+SESSION_TTL_S = float(os.getenv("SESSION_TTL_S", "1800"))
+SESSION_MAX = int(os.getenv("SESSION_MAX", "10000"))
+
+# 可连续调节的意图族: (模块, 上一条意图, 调高, 调低)，调高/调低为 (意图, 附加参数)
+ADJUSTABLE = [
+    ("AC", {"设置温度", "升温", "降温", "降到最低", "升到最高", "打开制热", "打开制冷"},
+     ("升温", {}), ("降温", {})),
+    ("AC", {"设置风量", "调高风量", "调低风量", "打开风扇"},
+     ("调高风量", {}), ("调低风量", {})),
+    ("MEDIA", {"设置音量", "调高音量", "调低音量", "播放音乐", "播放歌曲", "播放歌手", "打开电台"},
+     ("调高音量", {}), ("调低音量", {})),
+    ("SEAT", {"打开座椅加热", "座椅加热档位", "调高座椅温度", "调低座椅温度"},
+     ("调高座椅温度", {}), ("调低座椅温度", {})),
+    ("SEAT", {"打开座椅通风", "座椅通风档位", "座椅通风增大", "座椅通风减小"},
+     ("座椅通风增大", {}), ("座椅通风减小", {})),
+    ("SEAT", {"调节座椅"},
+     ("调节座椅", {"direction": "上"}), ("调节座椅", {"direction": "下"})),
+    ("WINDOW", {"打开车窗", "车窗开一半", "车窗开大一点", "车窗关小一点", "车窗降下"},
+     ("车窗开大一点", {}), ("车窗关小一点", {})),
+    ("WINDOW", {"打开天窗", "天窗开一半", "天窗开大一点", "天窗关小一点"},
+     ("天窗开大一点", {}), ("天窗关小一点", {})),
+    ("LIGHT", {"打开氛围灯", "氛围灯调亮", "氛围灯调暗", "调节氛围灯"},
+     ("氛围灯调亮", {}), ("氛围灯调暗", {})),
+]
+
+# "再高一点" / "调大些" / "再亮点儿"；必须带 再/还 或 点/些，避免误伤 "大灯" 之类
+_ADJUST_RE = re.compile(r"^(再|还|稍微|再稍微)?(调|开|往|给我)?([高大热亮响低小冷暗轻])(一点|一些|点|些)?儿?(吧|呀|啊)?$")
+_UP = set("高大热亮响")
+# "关掉" / "关了吧" / "把它关了"
+_OFF_RE = re.compile(r"^(把它|帮我)?(关掉|关了|关上|关闭)(它)?(吧|呀|啊)?$")
+
+def _normalize(text: str) -> str:
+    return "".join(ch for ch in text if not ch.isspace() and ch not in "，。！？、,.!?~～")
+
+class Session:
+    __slots__ = ("session_id", "history", "last_module", "last_intent", "slots")
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.history = deque(maxlen=SESSION_HISTORY)  # (用户输入, 回复)
+        self.last_module: Optional[str] = None
+        self.last_intent: Optional[str] = None
+        self.slots: Dict[str, Dict[str, Any]] = {}    # 模块 -> 参数名 -> 最近一次的值
+
+    def resolve(self, text: str) -> Optional[Tuple[List[Dict[str, Any]], Dict[int, Dict[str, Any]]]]:
+        """把依赖上文的追问在本地解析成 (commands, 预解析结果)，无法解析时返回 None"""
+        if not self.last_module or not self.last_intent:
+            return None
+        text = _normalize(text)
+        target = None
+
+        m = _ADJUST_RE.match(text)
+        if m and (m.group(1) or m.group(4)):
+            up = m.group(3) in _UP
+            for module, family, up_target, down_target in ADJUSTABLE:
+                if module == self.last_module and self.last_intent in family:
+                    target = up_target if up else down_target
+                    break
+        elif _OFF_RE.match(text) and self.last_intent.startswith("打开"):
+            intent = "关闭" + self.last_intent[2:]
+            if intent in MODULE_INTENTS.get(self.last_module, {}):
+                target = (intent, {})
+
+        CACHE_EVENTS.inc(cache="session_followup", result="miss" if target is None else "hit")
+        if target is None:
+            return None
+        intent, extra = target
+        known = self.slots.get(self.last_module, {})
+        params = {name: known[name] for name in MODULE_INTENTS[self.last_module][intent]["params"] if name in known}
+        params.update(extra)
+        command = {"index": 1, "module": self.last_module, "text": text, "confidence": 1.0}
+        return [command], {1: {"intent": intent, "params": params}}
+
+    def record(self, message: str, output: Dict[str, Any]):
+        """一轮结束后更新会话状态"""
+        self.history.append((message, output["summary"]))
+        for result in output["results"]:
+            if result["intent"] not in MODULE_INTENTS.get(result["module"], {}):
+                continue
+            self.last_module = result["module"]
+            self.last_intent = result["intent"]
+            params = {k: v for k, v in (result.get("params") or {}).items() if v not in (None, "")}
+            if params:
+                self.slots.setdefault(result["module"], {}).update(params)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "session_id": self.session_id,
+            "turns": len(self.history),
+            "history": [{"user": u, "reply": r} for u, r in self.history],
+            "last_module": self.last_module,
+            "last_intent": self.last_intent,
+            "slots": self.slots
+        }
+
+    def to_state(self) -> Dict[str, Any]:
+        """存入共享存储的形式"""
+        return {
+            "history": [list(turn) for turn in self.history],
+            "last_module": self.last_module,
+            "last_intent": self.last_intent,
+            "slots": self.slots
+        }
+
+    @classmethod
+    def from_state(cls, session_id: str, state: Dict[str, Any]) -> "Session":
+        session = cls(session_id)
+        session.history.extend(tuple(turn) for turn in state.get("history", []))
+        session.last_module = state.get("last_module")
+        session.last_intent = state.get("last_intent")
+        session.slots = {module: dict(params) for module, params in state.get("slots", {}).items()}
+        return session
+
+class SessionStore:
+    """会话放在共享存储里（见 shared_store），多 worker 时同一会话可落到任意进程；
+    按最近使用淘汰，超过 TTL 未活动的会话视为过期"""
+
+    def __init__(self, max_sessions: int = SESSION_MAX, ttl_s: float = SESSION_TTL_S):
+        self.max_sessions = max_sessions
+        self.ttl_s = ttl_s
+
+    def get(self, session_id: Optional[str] = None) -> Session:
+        """取出会话（不存在或已过期则新建），未指定 ID 时生成一个"""
+        session_id = session_id or secrets.token_hex(8)
+        state = store.get("session", session_id)
+        return Session(session_id) if state is None else Session.from_state(session_id, state)
+
+    def save(self, session: Session):
+        """一轮结束（record 之后）写回，同时刷新过期时间"""
+        store.set("session", session.session_id, session.to_state(), self.ttl_s, self.max_sessions)
+
+sessions = SessionStore()
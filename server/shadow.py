@@ -0,0 +1,206 @@
+# 影子流量：按比例抽取 /chat 请求，响应发出后用候选配置在后台重跑一遍，记录与主流程在意图、动作、回复、延迟和 token 上的差异
+import contextvars
+import hashlib
+import json
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from database import SessionLocal, ShadowResult
+
+SHADOW_RATE = float(os.getenv("SHADOW_RATE", "0"))  # 抽样比例，0 关闭
+# 候选配置（JSON），键: model / model_<agent>（如 model_router）、local_classifier、local_intent_threshold、
+# speculative_parse、router_stream、summary_mode、cache（默认不读写结果缓存，否则只会拿到主流程的结果）
+SHADOW_CONFIG: Dict[str, Any] = json.loads(os.getenv("SHADOW_CONFIG", "") or "{}")
+SHADOW_NAME = os.getenv("SHADOW_NAME", "")  # 候选配置名，默认取配置的哈希
+SHADOW_CONCURRENCY = int(os.getenv("SHADOW_CONCURRENCY", "2"))
+SHADOW_QUEUE = int(os.getenv("SHADOW_QUEUE", "20"))  # 排队加运行中超过这个数的抽样直接丢弃
+SHADOW_REPORT_WINDOW = int(os.getenv("SHADOW_REPORT_WINDOW", "5000"))
+
+def candidate_name(config: Dict[str, Any]) -> str:
+    canonical = json.dumps(config, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()[:12]
+
+def snapshot(output: Dict[str, Any]) -> Dict[str, Any]:
+    """比较要用的字段（不持有 trace 等大对象）"""
+    return {
+        "results": [{k: r.get(k) for k in ("index", "module", "intent", "params", "action")}
+                    for r in output["results"]],
+        "summary": output["summary"],
+        "latency_ms": output["latency_ms"],
+        "tokens": output["token_usage"].get("total_tokens", 0)
+    }
+
+def compare(primary: Dict[str, Any], shadow: Dict[str, Any]) -> Dict[str, Any]:
+    """按指令序号对齐比较；条数不同算意图不一致，多出或缺少的指令记为 None"""
+    diff: List[Dict[str, Any]] = []
+    p_results = {r["index"]: r for r in primary["results"]}
+    s_results = {r["index"]: r for r in shadow["results"]}
+    matches = {"intent": len(p_results) == len(s_results), "params": True, "action": True}
+    for index in sorted(set(p_results) | set(s_results)):
+        p, s = p_results.get(index, {}), s_results.get(index, {})
+        for field, key in (("intent", ("module", "intent")), ("params", ("params",)), ("action", ("action",))):
+            p_value = [p.get(k) for k in key] if p else None
+            s_value = [s.get(k) for k in key] if s else None
+            if p_value != s_value:
+                matches[field] = False
+                diff.append({"index": index, "field": field,
+                             "primary": p_value if p_value is None or len(key) > 1 else p_value[0],
+                             "shadow": s_value if s_value is None or len(key) > 1 else s_value[0]})
+    reply_match = primary["summary"] == shadow["summary"]
+    if not reply_match:
+        diff.append({"index": None, "field": "reply", "primary": primary["summary"], "shadow": shadow["summary"]})
+    return {"intent_match": matches["intent"], "params_match": matches["params"],
+            "action_match": matches["action"], "reply_match": reply_match, "diff": diff}
+
+def _percentile(values: List[int], q: float) -> Optional[int]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+class ShadowRunner:
+    """自己的线程池和排队上限，和正常请求的线程池、准入名额互不占用"""
+
+    def __init__(self, rate: float = SHADOW_RATE, config: Optional[Dict[str, Any]] = None,
+                 name: str = SHADOW_NAME, concurrency: int = SHADOW_CONCURRENCY, queue: int = SHADOW_QUEUE):
+        self.rate = rate
+        self.config = {"cache": False, **(SHADOW_CONFIG if config is None else config)}
+        self.name = name or candidate_name(self.config)
+        self.queue = queue
+        self._pool = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="shadow")
+        self._pending = 0
+        self._lock = threading.Lock()
+        self.stats = {"sampled": 0, "skipped": 0, "dropped": 0, "completed": 0, "failed": 0}
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def sample(self, output: Dict[str, Any]) -> bool:
+        """是否抽中这条请求；依赖车辆状态或会话的、降级的、熔断期间的请求不抽（两边结果不可比或不该加压）"""
+        if self.rate <= 0 or random.random() >= self.rate:
+            return False
+        from agents.base import llm_breaker
+        if output["degraded"] or output["state_hits"] or llm_breaker.any_open():
+            self._count("skipped")
+            return False
+        return True
+
+    def submit(self, message: str, primary: Dict[str, Any], log_id: Optional[int], quality: bool = False):
+        """在响应发出后（BackgroundTasks）调用；只入队，不等待。quality 与主流程一致，两边的回复才可比"""
+        with self._lock:
+            if self._pending >= self.queue:
+                self.stats["dropped"] += 1
+                return
+            self._pending += 1
+            self.stats["sampled"] += 1
+        try:
+            # 全新的上下文: 不继承请求的 span、token 计数
+            self._pool.submit(contextvars.Context().run, self._run, message, primary, log_id, quality)
+        except RuntimeError:  # 进程退出中
+            with self._lock:
+                self._pending -= 1
+
+    def _run(self, message: str, primary: Dict[str, Any], log_id: Optional[int], quality: bool = False):
+        import pipeline
+        from agents.base import BaseAgent
+
+        row = ShadowResult(log_id=log_id, candidate=self.name, user_input=message,
+                           primary_cached=primary["tokens"] == 0,
+                           primary_latency_ms=primary["latency_ms"], primary_tokens=primary["tokens"])
+        try:
+            BaseAgent.set_overrides(self.config)
+            shadow = snapshot(pipeline.run_chat(message, quality=quality))
+            result = compare(primary, shadow)
+            row.intent_match = result["intent_match"]
+            row.params_match = result["params_match"]
+            row.action_match = result["action_match"]
+            row.reply_match = result["reply_match"]
+            row.diff = json.dumps(result["diff"], ensure_ascii=False)
+            row.shadow_latency_ms = shadow["latency_ms"]
+            row.shadow_tokens = shadow["tokens"]
+            self._count("completed")
+        except Exception as e:
+            row.error = f"{type(e).__name__}: {e}"
+            self._count("failed")
+        finally:
+            with self._lock:
+                self._pending -= 1
+        db = SessionLocal()
+        try:
+            db.add(row)
+            db.commit()
+        finally:
+            db.close()
+
+    def _count(self, key: str):
+        with self._lock:
+            self.stats[key] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self.stats, "pending": self._pending, "rate": self.rate, "candidate": self.name,
+                    "config": self.config}
+
+def report(candidate: Optional[str] = None, window: int = SHADOW_REPORT_WINDOW,
+           examples: int = 5) -> Dict[str, Any]:
+    """最近 window 条影子结果按候选配置汇总: 各项一致率、延迟和 token 对比、最近的不一致样例
+
+    主流程命中结果缓存或本地分类器（没消耗 token）的样本只参与一致率，不参与延迟和 token 对比。
+    """
+    db = SessionLocal()
+    try:
+        query = db.query(ShadowResult)
+        if candidate:
+            query = query.filter(ShadowResult.candidate == candidate)
+        rows = query.order_by(ShadowResult.id.desc()).limit(window).all()
+    finally:
+        db.close()
+
+    groups: Dict[str, List[ShadowResult]] = {}
+    for row in rows:
+        groups.setdefault(row.candidate, []).append(row)
+
+    def rate(values: List[bool]) -> Optional[float]:
+        return round(sum(1 for v in values if v) / len(values), 4) if values else None
+
+    def mean(values: List[int]) -> Optional[float]:
+        return round(sum(values) / len(values), 1) if values else None
+
+    out = {}
+    for name, items in groups.items():
+        ok = [r for r in items if r.error is None]
+        comparable = [r for r in ok if not r.primary_cached]
+        p_lat = [r.primary_latency_ms for r in comparable]
+        s_lat = [r.shadow_latency_ms for r in comparable]
+        mismatched = [r for r in ok if not (r.intent_match and r.params_match and r.action_match and r.reply_match)]
+        out[name] = {
+            "samples": len(items),
+            "errors": len(items) - len(ok),
+            "intent_match": rate([r.intent_match for r in ok]),
+            "params_match": rate([r.params_match for r in ok]),
+            "action_match": rate([r.action_match for r in ok]),
+            "reply_match": rate([r.reply_match for r in ok]),
+            "latency_ms": {
+                "compared": len(comparable),
+                "primary_p50": _percentile(p_lat, 0.5),
+                "shadow_p50": _percentile(s_lat, 0.5),
+                "primary_p95": _percentile(p_lat, 0.95),
+                "shadow_p95": _percentile(s_lat, 0.95),
+                "mean_delta": round(sum(s - p for p, s in zip(p_lat, s_lat)) / len(p_lat), 1) if p_lat else None
+            },
+            "tokens": {
+                "primary_mean": mean([r.primary_tokens for r in comparable]),
+                "shadow_mean": mean([r.shadow_tokens for r in comparable]),
+                "mean_delta": mean([r.shadow_tokens - r.primary_tokens for r in comparable])
+            },
+            "mismatches": [{"log_id": r.log_id, "user_input": r.user_input, "diff": json.loads(r.diff)}
+                           for r in mismatched[:examples]],
+            "recent_errors": [{"log_id": r.log_id, "error": r.error} for r in items if r.error][:examples]
+        }
+    return out
+
+shadow = ShadowRunner()
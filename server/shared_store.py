@@ -0,0 +1,420 @@
+# 跨 worker 共享的键值存储：会话、车辆状态、限流令牌桶、结果缓存、预热锁
+#
+#   STORE_BACKEND=memory  进程内（默认，单 worker / 开发模式）
+#   STORE_BACKEND=socket  本机 unix socket 服务，纯 Python，多 worker 共用: python shared_store.py serve
+#   STORE_BACKEND=redis   可选，需要安装 redis 包，地址见 STORE_URL
+#
+# 存储不可用时读返回空、写丢弃、限流放行，请求本身不受影响
+import json
+import os
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from metrics import Counter
+
+STORE_BACKEND = os.getenv("STORE_BACKEND", "memory")
+STORE_SOCKET = os.getenv("STORE_SOCKET", "/tmp/car_bot_store.sock")
+STORE_URL = os.getenv("STORE_URL", "redis://localhost:6379/0")
+STORE_TIMEOUT_S = float(os.getenv("STORE_TIMEOUT_S", "0.5"))
+# 每个命名空间最多保留的键数，按最近使用淘汰（写入时可单独指定）
+STORE_MAX_KEYS = int(os.getenv("STORE_MAX_KEYS", "10000"))
+
+STORE_ERRORS = Counter("car_bot_store_errors_total", "Shared store calls that failed and were skipped", ["backend", "op"])
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> Tuple[bool, float]:
+        """取一个令牌，失败时返回需要等待的秒数"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True, 0.0
+        return False, (1 - self.tokens) / self.rate
+
+class MemoryStore:
+    """进程内实现，同时也是 socket 服务端背后的存储；值须可 JSON 序列化"""
+    backend = "memory"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # 命名空间 -> 键 -> (值, 过期时刻)
+        self._spaces: Dict[str, "OrderedDict[str, Tuple[Any, Optional[float]]]"] = {}
+
+    def _space(self, ns: str) -> "OrderedDict[str, Tuple[Any, Optional[float]]]":
+        space = self._spaces.get(ns)
+        if space is None:
+            space = self._spaces[ns] = OrderedDict()
+        return space
+
+    def _live(self, ns: str, key: str) -> Optional[Tuple[Any, Optional[float]]]:
+        space = self._space(ns)
+        item = space.get(key)
+        if item is None:
+            return None
+        if item[1] is not None and item[1] <= time.monotonic():
+            del space[key]
+            return None
+        space.move_to_end(key)
+        return item
+
+    def _put(self, ns: str, key: str, value: Any, ttl_s: Optional[float], max_keys: Optional[int]):
+        space = self._space(ns)
+        space[key] = (value, time.monotonic() + ttl_s if ttl_s else None)
+        space.move_to_end(key)
+        while len(space) > (max_keys or STORE_MAX_KEYS):
+            space.popitem(last=False)
+
+    def get(self, ns: str, key: str) -> Any:
+        with self._lock:
+            item = self._live(ns, key)
+            return None if item is None else item[0]
+
+    def set(self, ns: str, key: str, value: Any, ttl_s: Optional[float] = None, max_keys: Optional[int] = None):
+        with self._lock:
+            self._put(ns, key, value, ttl_s, max_keys)
+
+    def add(self, ns: str, key: str, value: Any, ttl_s: Optional[float] = None,
+            max_keys: Optional[int] = None) -> bool:
+        """键不存在（或已过期）时写入并返回 True，否则不动并返回 False；用作跨 worker 的锁"""
+        with self._lock:
+            if self._live(ns, key) is not None:
+                return False
+            self._put(ns, key, value, ttl_s, max_keys)
+            return True
+
+    def merge(self, ns: str, key: str, updates: Dict[str, Any], removed: List[str],
+              ttl_s: Optional[float] = None, max_keys: Optional[int] = None):
+        """对字典值做局部更新，并发写不同字段时互不覆盖"""
+        with self._lock:
+            item = self._live(ns, key)
+            value = dict(item[0]) if item is not None else {}
+            for name in removed:
+                value.pop(name, None)
+            value.update(updates)
+            self._put(ns, key, value, ttl_s, max_keys)
+
+    def adjust(self, ns: str, key: str, field: str, delta: float, low: float, high: float,
+               ttl_s: Optional[float] = None, max_keys: Optional[int] = None) -> Optional[List[float]]:
+        """字典值里的数值字段原子地加 delta（限制在 [low, high]），返回 [原值, 新值]；字段不存在时不动，返回 None"""
+        with self._lock:
+            item = self._live(ns, key)
+            if item is None or not isinstance(item[0].get(field), (int, float)):
+                return None
+            value = dict(item[0])
+            before = value[field]
+            value[field] = min(high, max(low, before + delta))
+            self._put(ns, key, value, ttl_s, max_keys)
+            return [before, value[field]]
+
+    def take(self, ns: str, key: str, rate: float, burst: float, max_keys: Optional[int] = None) -> Tuple[bool, float]:
+        """按键取一个令牌（令牌桶在存储端，多 worker 共用同一份限额）"""
+        with self._lock:
+            item = self._live(ns, key)
+            bucket = item[0] if item is not None else None
+            if bucket is None:
+                bucket = TokenBucket(rate, burst)
+                self._put(ns, key, bucket, None, max_keys)
+            return bucket.take()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"backend": self.backend, "keys": {ns: len(space) for ns, space in self._spaces.items()}}
+
+# ---------- unix socket 协议: 4 字节长度 + JSON，请求 [op, *args]，响应 [ok, value] ----------
+
+OPS = {"get", "set", "add", "merge", "adjust", "take", "stats"}
+
+def _send(sock: socket.socket, obj: Any):
+    data = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+    sock.sendall(struct.pack(">I", len(data)) + data)
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    buf = b""
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionError("store connection closed")
+        buf += chunk
+    return buf
+
+def _recv(sock: socket.socket) -> Any:
+    size, = struct.unpack(">I", _recv_exact(sock, 4))
+    return json.loads(_recv_exact(sock, size).decode("utf-8"))
+
+class SocketStore:
+    """socket 后端客户端，每个线程一条长连接，断开后自动重连一次"""
+    backend = "socket"
+
+    def __init__(self, path: str = STORE_SOCKET, timeout_s: float = STORE_TIMEOUT_S):
+        self.path = path
+        self.timeout_s = timeout_s
+        self._local = threading.local()
+
+    def _conn(self) -> socket.socket:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            conn.settimeout(self.timeout_s)
+            try:
+                conn.connect(self.path)
+            except OSError:
+                conn.close()
+                raise
+            self._local.conn = conn
+        return conn
+
+    def _close(self):
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+        if conn is not None:
+            conn.close()
+
+    def _call(self, op: str, *args) -> Any:
+        for attempt in range(2):
+            try:
+                conn = self._conn()
+                _send(conn, [op, *args])
+                ok, value = _recv(conn)
+                break
+            except OSError:
+                self._close()
+                if attempt:
+                    raise
+        if not ok:
+            raise RuntimeError(value)
+        return value
+
+    def get(self, ns, key):
+        return self._call("get", ns, key)
+
+    def set(self, ns, key, value, ttl_s=None, max_keys=None):
+        self._call("set", ns, key, value, ttl_s, max_keys)
+
+    def add(self, ns, key, value, ttl_s=None, max_keys=None):
+        return self._call("add", ns, key, value, ttl_s, max_keys)
+
+    def merge(self, ns, key, updates, removed, ttl_s=None, max_keys=None):
+        self._call("merge", ns, key, updates, removed, ttl_s, max_keys)
+
+    def adjust(self, ns, key, field, delta, low, high, ttl_s=None, max_keys=None):
+        return self._call("adjust", ns, key, field, delta, low, high, ttl_s, max_keys)
+
+    def take(self, ns, key, rate, burst, max_keys=None):
+        ok, retry_after = self._call("take", ns, key, rate, burst, max_keys)
+        return ok, retry_after
+
+    def stats(self):
+        return {"backend": self.backend, "path": self.path, **self._call("stats")}
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        store = self.server.store
+        while True:
+            try:
+                op, *args = _recv(self.request)
+            except (ConnectionError, ValueError, struct.error):
+                return
+            try:
+                if op not in OPS:
+                    raise ValueError(f"unknown op {op}")
+                result = getattr(store, op)(*args)
+                if op == "stats":
+                    result = {"keys": result["keys"]}
+                response = [True, result]
+            except Exception as e:
+                response = [False, str(e)]
+            _send(self.request, response)
+
+class StoreServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str = STORE_SOCKET):
+        if os.path.exists(path):
+            os.unlink(path)
+        self.store = MemoryStore()
+        super().__init__(path, _Handler)
+
+# ---------- redis 后端（可选） ----------
+
+# 局部更新、数值增减与令牌桶都在 redis 端用脚本原子执行，时间取 redis 服务器时钟
+_MERGE_LUA = """
+local raw = redis.call('GET', KEYS[1])
+local value = raw and cjson.decode(raw) or {}
+for _, name in ipairs(cjson.decode(ARGV[2])) do value[name] = nil end
+for name, v in pairs(cjson.decode(ARGV[1])) do value[name] = v end
+raw = next(value) and cjson.encode(value) or '{}'
+if tonumber(ARGV[3]) > 0 then
+  redis.call('SET', KEYS[1], raw, 'PX', math.floor(tonumber(ARGV[3]) * 1000))
+else
+  redis.call('SET', KEYS[1], raw)
+end
+"""
+
+_ADJUST_LUA = """
+local raw = redis.call('GET', KEYS[1])
+if not raw then return nil end
+local value = cjson.decode(raw)
+local before = value[ARGV[1]]
+if type(before) ~= 'number' then return nil end
+local after = math.min(tonumber(ARGV[4]), math.max(tonumber(ARGV[3]), before + tonumber(ARGV[2])))
+value[ARGV[1]] = after
+if tonumber(ARGV[5]) > 0 then
+  redis.call('SET', KEYS[1], cjson.encode(value), 'PX', math.floor(tonumber(ARGV[5]) * 1000))
+else
+  redis.call('SET', KEYS[1], cjson.encode(value))
+end
+return {tostring(before), tostring(after)}
+"""
+
+_TAKE_LUA = """
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens, updated = tonumber(state[1]) or burst, tonumber(state[2]) or now
+tokens = math.min(burst, tokens + (now - updated) * rate)
+local ok = 0
+if tokens >= 1 then tokens = tokens - 1; ok = 1 end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+if ok == 1 then return {1, '0'} end
+return {0, tostring((1 - tokens) / rate)}
+"""
+
+class RedisStore:
+    """redis 后端，适合多机部署；键名为 car_bot:<命名空间>:<键>，淘汰交给 redis 的过期与内存策略"""
+    backend = "redis"
+
+    def __init__(self, url: str = STORE_URL, timeout_s: float = STORE_TIMEOUT_S):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("STORE_BACKEND=redis 需要先安装 redis 包: pip install redis")
+        self.client = redis.Redis.from_url(url, socket_timeout=timeout_s, decode_responses=True)
+        self._merge = self.client.register_script(_MERGE_LUA)
+        self._adjust = self.client.register_script(_ADJUST_LUA)
+        self._take = self.client.register_script(_TAKE_LUA)
+
+    @staticmethod
+    def _key(ns: str, key: str) -> str:
+        return f"car_bot:{ns}:{key}"
+
+    def get(self, ns, key):
+        raw = self.client.get(self._key(ns, key))
+        return None if raw is None else json.loads(raw)
+
+    def set(self, ns, key, value, ttl_s=None, max_keys=None):
+        self.client.set(self._key(ns, key), json.dumps(value, ensure_ascii=False),
+                        px=int(ttl_s * 1000) if ttl_s else None)
+
+    def add(self, ns, key, value, ttl_s=None, max_keys=None):
+        return bool(self.client.set(self._key(ns, key), json.dumps(value, ensure_ascii=False),
+                                    px=int(ttl_s * 1000) if ttl_s else None, nx=True))
+
+    def merge(self, ns, key, updates, removed, ttl_s=None, max_keys=None):
+        self._merge(keys=[self._key(ns, key)],
+                    args=[json.dumps(updates, ensure_ascii=False), json.dumps(removed, ensure_ascii=False), ttl_s or 0])
+
+    def adjust(self, ns, key, field, delta, low, high, ttl_s=None, max_keys=None):
+        result = self._adjust(keys=[self._key(ns, key)], args=[field, delta, low, high, ttl_s or 0])
+        return None if result is None else [int(float(v)) if float(v).is_integer() else float(v) for v in result]
+
+    def take(self, ns, key, rate, burst, max_keys=None):
+        ok, retry_after = self._take(keys=[self._key(ns, key)], args=[rate, burst])
+        return bool(int(ok)), float(retry_after)
+
+    def stats(self):
+        return {"backend": self.backend, "url": STORE_URL.split("@")[-1]}
+
+# ---------- 对外接口 ----------
+
+class SharedStore:
+    """按 STORE_BACKEND 选择后端；共享后端出错时降级（读为空、写丢弃、限流放行）并计数"""
+
+    def __init__(self, backend: str = STORE_BACKEND):
+        self.backend = backend
+        self._impl = None
+        self._lock = threading.Lock()
+
+    @property
+    def impl(self):
+        if self._impl is None:
+            with self._lock:
+                if self._impl is None:
+                    if self.backend == "socket":
+                        self._impl = SocketStore()
+                    elif self.backend == "redis":
+                        self._impl = RedisStore()
+                    else:
+                        self._impl = MemoryStore()
+        return self._impl
+
+    def _guard(self, op: str, default: Any, *args) -> Any:
+        try:
+            return getattr(self.impl, op)(*args)
+        except Exception:
+            if self.backend == "memory":
+                raise
+            STORE_ERRORS.inc(backend=self.backend, op=op)
+            return default
+
+    def get(self, ns: str, key: str) -> Any:
+        return self._guard("get", None, ns, key)
+
+    def set(self, ns: str, key: str, value: Any, ttl_s: Optional[float] = None, max_keys: Optional[int] = None):
+        self._guard("set", None, ns, key, value, ttl_s, max_keys)
+
+    def add(self, ns: str, key: str, value: Any, ttl_s: Optional[float] = None,
+            max_keys: Optional[int] = None) -> bool:
+        """存储不可用时返回 True（各 worker 自行其是，与限流放行一致）"""
+        return self._guard("add", True, ns, key, value, ttl_s, max_keys)
+
+    def merge(self, ns: str, key: str, updates: Dict[str, Any], removed: List[str],
+              ttl_s: Optional[float] = None, max_keys: Optional[int] = None):
+        self._guard("merge", None, ns, key, updates, removed, ttl_s, max_keys)
+
+    def adjust(self, ns: str, key: str, field: str, delta: float, low: float, high: float,
+               ttl_s: Optional[float] = None, max_keys: Optional[int] = None) -> Optional[List[float]]:
+        return self._guard("adjust", None, ns, key, field, delta, low, high, ttl_s, max_keys)
+
+    def take(self, ns: str, key: str, rate: float, burst: float, max_keys: Optional[int] = None) -> Tuple[bool, float]:
+        return self._guard("take", (True, 0.0), ns, key, rate, burst, max_keys)
+
+    def stats(self) -> Dict[str, Any]:
+        return self._guard("stats", {"backend": self.backend, "error": "unavailable"})
+
+store = SharedStore()
+
+def main(argv: Optional[List[str]] = None):
+    import argparse
+    parser = argparse.ArgumentParser(description="共享存储服务（STORE_BACKEND=socket）")
+    parser.add_argument("command", choices=["serve"])
+    parser.add_argument("--socket", default=STORE_SOCKET)
+    args = parser.parse_args(argv)
+
+    server = StoreServer(args.socket)
+    print(f"shared store listening on {args.socket}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+# 启动画像与就绪状态：记录导入和预热各阶段耗时，预热完成前 /ready 返回 503
+import builtins
+import importlib
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# 关闭后启动即就绪，重量级依赖全部在首个请求时加载
+WARMUP = os.getenv("WARMUP", "1") == "1"
+# 必需的预热步骤失败后按指数退避重试（首次间隔、最长间隔），一直重试到成功
+WARMUP_RETRY_S = float(os.getenv("WARMUP_RETRY_S", "1"))
+WARMUP_RETRY_MAX_S = float(os.getenv("WARMUP_RETRY_MAX_S", "30"))
+# 启动导入阶段逐个模块计时（含其依赖），只记耗时不低于这个值的，0 关闭
+IMPORT_PROFILE_MIN_MS = float(os.getenv("IMPORT_PROFILE_MIN_MS", "5"))
+
+_started = time.time()
+_t0 = _last = time.perf_counter()
+_lock = threading.Lock()
+_phases: Dict[str, float] = {}
+_pending: List[str] = []
+_ready = threading.Event()
+_ready_ms: Optional[float] = None
+_error: Optional[str] = None
+_skipped: List[str] = []  # 失败后跳过的可选步骤 "名称: 错误"
+
+def _record(name: str, seconds: float):
+    with _lock:
+        _phases[name] = round(seconds * 1000, 1)
+
+def mark(name: str):
+    """记录从上一个 mark（或本模块导入）到现在的耗时"""
+    global _last
+    now = time.perf_counter()
+    _record(name, now - _last)
+    _last = now
+
+@contextmanager
+def phase(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(name, time.perf_counter() - start)
+
+_original_import = builtins.__import__
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    """启动导入阶段替换 __import__：首次导入的模块记一条 import:<模块名>（包含它导入的依赖，嵌套的也各记一条）"""
+    if level or name in sys.modules:
+        return _original_import(name, globals, locals, fromlist, level)
+    start = time.perf_counter()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        seconds = time.perf_counter() - start
+        if seconds * 1000 >= IMPORT_PROFILE_MIN_MS:
+            _record(f"import:{name}", seconds)
+
+def end_imports():
+    """模块导入阶段结束：记下总耗时，停止逐个模块计时"""
+    mark("imports")
+    if builtins.__import__ is _timed_import:
+        builtins.__import__ = _original_import
+
+def lazy_import(name: str) -> Any:
+    """首次用到时才导入重量级依赖（pandas、dashscope 等），耗时记入启动画像"""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    with phase(f"import:{name}"):
+        return importlib.import_module(name)
+
+def start_warm_up(steps: List[Tuple[Any, ...]]):
+    """在后台线程依次执行预热步骤 (名称, 函数[, 可选])，必需步骤全部成功后标记就绪
+
+    必需步骤失败时按指数退避重试；可选步骤（首次使用时也会按需加载的）失败一次就跳过，记入 skipped。
+    """
+    if not WARMUP:
+        _set_ready()
+        return
+    with _lock:
+        _pending[:] = [step[0] for step in steps]
+    threading.Thread(target=_warm_up, args=(steps,), name="warm-up", daemon=True).start()
+
+def _warm_up(steps: List[Tuple[Any, ...]]):
+    global _error
+    for name, fn, *rest in steps:
+        optional = bool(rest and rest[0])
+        delay, attempt = WARMUP_RETRY_S, 1
+        while True:
+            try:
+                with phase(f"warm:{name}"):
+                    fn()
+                _error = None
+                break
+            except Exception as e:
+                if optional:
+                    with _lock:
+                        _skipped.append(f"{name}: {e}")
+                    break
+                _error = f"{name} (attempt {attempt}): {e}"
+            time.sleep(delay)
+            delay, attempt = min(delay * 2, WARMUP_RETRY_MAX_S), attempt + 1
+        with _lock:
+            _pending.remove(name)
+    _set_ready()
+
+def _set_ready():
+    global _ready_ms
+    _ready_ms = round((time.perf_counter() - _t0) * 1000, 1)
+    _ready.set()
+
+def is_ready() -> bool:
+    return _ready.is_set()
+
+def status() -> Dict[str, Any]:
+    with _lock:
+        phases = dict(_phases)
+        pending = list(_pending)
+        skipped = list(_skipped)
+    return {
+        "ready": _ready.is_set(),
+        "uptime_s": round(time.time() - _started, 1),
+        "ready_ms": _ready_ms,
+        "pending": pending,
+        "error": _error,
+        "skipped": skipped,
+        "profile": phases
+    }
+
+if IMPORT_PROFILE_MIN_MS > 0:
+    builtins.__import__ = _timed_import
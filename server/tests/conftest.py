@@ -0,0 +1,5 @@
+# 测试从 server 目录导入模块（与 uvicorn main_v2:app 的运行方式一致）
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,89 @@
+# 多条执行结果的合并回复
+import pytest
+
+from agents.composer import NOOP_ACTION, UNKNOWN_ACTION, compose, failed, fit
+
+
+def result(module, intent, reply="", action="", index=0, **params):
+    return {"index": index, "module": module, "intent": intent, "action": action, "reply": reply, "params": params}
+
+
+@pytest.mark.parametrize("results, expected", [
+    # 单条
+    ([result("AC", "打开空调", "好的，空调已打开")], "好的，已打开空调"),
+    ([result("AC", "设置温度", temperature=26)], "好的，温度已调到26度"),
+    ([result("NAV", "导航到目的地", destination="公司")], "好的，正在导航到公司"),
+    ([result("LIGHT", "打开氛围灯", color="红色")], "好的，已打开红色氛围灯"),
+    ([result("SEAT", "打开座椅加热", position="主驾")], "好的，已打开主驾座椅加热"),
+    ([result("WINDOW", "关闭车窗", position="全部")], "好的，已关闭车窗"),
+    # 模板参数缺失、意图对不上时用执行器的回复，去掉客套开头和句末标点
+    ([result("AC", "设置温度", "好的，温度已设置。")], "好的，温度已设置"),
+    ([result("MEDIA", "随便听听")], "好的，操作完成"),
+    # 同前缀同动词合并，重复的对象只说一次
+    ([result("AC", "打开空调"), result("SEAT", "打开座椅加热", position="主驾")],
+     "好的，已打开空调和主驾座椅加热"),
+    ([result("AC", "打开空调"), result("LIGHT", "打开雾灯"), result("MEDIA", "打开电台")],
+     "好的，已打开空调、雾灯和电台"),
+    ([result("AC", "打开空调"), result("AC", "打开空调")], "好的，已打开空调"),
+    # 不同动词分句，保持首次出现的位置
+    ([result("AC", "打开空调"), result("MEDIA", "播放音乐"), result("LIGHT", "打开雾灯")],
+     "好的，已打开空调和雾灯，正在播放音乐"),
+])
+def test_compose(results, expected):
+    assert compose(results) == expected
+
+
+@pytest.mark.parametrize("results, expected", [
+    # 未执行成功的原样使用并放在最前面，整句不加 "好的，"
+    ([result("AC", "打开空调"), result("", "", "抱歉，我没听懂", action=UNKNOWN_ACTION)],
+     "抱歉，我没听懂，已打开空调"),
+    # 回复表明没做成时不按意图名改写成 "已打开…"
+    ([result("CAR", "打开后备箱", "抱歉，暂不支持打开后备箱。")], "抱歉，暂不支持打开后备箱"),
+    ([result("", "", action=UNKNOWN_ACTION)], "操作失败"),
+])
+def test_compose_failures(results, expected):
+    assert compose(results) == expected
+
+
+def test_compose_verbatim():
+    results = [
+        result("AC", "打开空调", "空调已经打开了", action=NOOP_ACTION, index=0),
+        result("AC", "升温", "温度已调到27度", action="TEMP_SET_27", index=1),
+        result("LIGHT", "打开雾灯", index=2),
+    ]
+    # NOOP 的回复总是原样使用；verbatim 中的序号不套模板
+    assert compose(results) == "好的，空调已经打开了，温度已调高，已打开雾灯"
+    assert compose(results, verbatim=[1]) == "好的，空调已经打开了，温度已调到27度，已打开雾灯"
+
+
+@pytest.mark.parametrize("clauses, budget, polite, expected", [
+    (["已打开空调"], 30, True, "好的，已打开空调"),
+    (["已打开空调"], 30, False, "已打开空调"),
+    # 刚好放下时不加 "好的，"
+    (["已打开空调"], 5, True, "已打开空调"),
+    (["已打开空调", "正在播放音乐", "已关闭车窗"], 18, True, "已打开空调，正在播放音乐，已关闭车窗"),
+    (["已打开空调", "正在播放音乐", "已关闭车窗"], 15, True, "已打开空调，另有2项已完成"),
+    (["已打开空调", "正在播放音乐", "已关闭主驾和副驾车窗"], 20, True, "已打开空调，正在播放音乐，另有1项已完成"),
+    # 一句也放不下
+    (["已打开空调和主驾座椅加热"], 8, True, "已完成1项操作"),
+])
+def test_fit(clauses, budget, polite, expected):
+    assert fit(clauses, budget, polite) == expected
+
+
+def test_compose_budget():
+    results = [result("AC", "设置温度", temperature=26), result("NAV", "导航到目的地", destination="公司"),
+               result("MEDIA", "播放歌手", artist_name="周杰伦"), result("", "", "抱歉，我没听懂", action=UNKNOWN_ACTION)]
+    # 失败的在最前面，不会被概括掉
+    assert compose(results, budget=24) == "抱歉，我没听懂，温度已调到26度，另有2项已完成"
+
+
+@pytest.mark.parametrize("res, expected", [
+    (result("AC", "打开空调", "好的，已打开空调"), False),
+    (result("", "", action=UNKNOWN_ACTION), True),
+    (result("CAR", "打开后备箱", "暂不支持该功能"), True),
+    (result("AC", "打开空调", "空调打开失败"), True),
+    ({"action": "AC_ON"}, False),
+])
+def test_failed(res, expected):
+    assert failed(res) is expected
@@ -0,0 +1,82 @@
+# 下发队列：同一车辆未发出的动作合并（作废、相对调节累加、抵消），不同状态保持入队顺序
+import threading
+
+import pytest
+
+from dispatch import ActionSink, Dispatcher
+
+
+class GatedSink(ActionSink):
+    """第一条动作卡在发送中，直到放行；记录实际发出的 (动作码, 重复次数)"""
+
+    def __init__(self):
+        self.gate = threading.Event()
+        self.sending = threading.Event()
+        self.sent = []
+
+    def send(self, vehicle_id, item):
+        self.sending.set()
+        assert self.gate.wait(5)
+        self.sent.append((item.action, item.repeat))
+        return {}
+
+
+def result(index, module, action, **params):
+    return {"index": index, "module": module, "action": action, "params": params}
+
+
+def dispatch(results):
+    sink = GatedSink()
+    dispatcher = Dispatcher(sink, workers=1)
+    # 先占住发送端，后面的动作都留在队列里等待合并
+    dispatcher.submit("v1", result(0, "MEDIA", "MEDIA_PLAY"))
+    assert sink.sending.wait(5)
+    items = [dispatcher.submit("v1", r) for r in results]
+    sink.gate.set()
+    assert dispatcher.flush()
+    return sink.sent[1:], items, dispatcher.get_stats()
+
+
+@pytest.mark.parametrize("results, sent", [
+    # 绝对设置作废之前未发出的同一状态
+    ([result(1, "AC", "TEMP_SET_26"), result(2, "AC", "TEMP_SET_24")], [("TEMP_SET_24", 1)]),
+    ([result(1, "AC", "AC_ON"), result(2, "AC", "AC_OFF")], [("AC_OFF", 1)]),
+    # "全部" 位置覆盖单个位置
+    ([result(1, "WINDOW", "WINDOW_OPEN", position="主驾"), result(2, "WINDOW", "WINDOW_CLOSE", position="全部")],
+     [("WINDOW_CLOSE", 1)]),
+    # 单个位置不覆盖其他位置
+    ([result(1, "WINDOW", "WINDOW_OPEN", position="主驾"), result(2, "WINDOW", "WINDOW_OPEN", position="副驾")],
+     [("WINDOW_OPEN", 1), ("WINDOW_OPEN", 1)]),
+    # 相对调节累加步数
+    ([result(1, "AC", "TEMP_UP"), result(2, "AC", "TEMP_UP")], [("TEMP_UP", 2)]),
+    ([result(1, "MEDIA", "VOL_DOWN"), result(2, "MEDIA", "VOL_DOWN"), result(3, "MEDIA", "VOL_UP")],
+     [("VOL_DOWN", 1)]),
+    # 相对调节并入之前的绝对设置，按上下限截断
+    ([result(1, "AC", "TEMP_SET_26"), result(2, "AC", "TEMP_UP")], [("TEMP_SET_27", 1)]),
+    ([result(1, "AC", "TEMP_SET_32"), result(2, "AC", "TEMP_UP")], [("TEMP_SET_32", 1)]),
+    # 一升一降抵消，什么都不发
+    ([result(1, "AC", "TEMP_UP"), result(2, "AC", "TEMP_DOWN")], []),
+    # 不同状态按入队顺序
+    ([result(1, "AC", "AC_ON"), result(2, "MEDIA", "VOL_UP"), result(3, "AC", "TEMP_UP")],
+     [("AC_ON", 1), ("VOL_UP", 1), ("TEMP_UP", 1)]),
+    # 不影响已建模状态的动作照常下发
+    ([result(1, "NAV", "NAV_HOME"), result(2, "NAV", "NAV_HOME")], [("NAV_HOME", 1), ("NAV_HOME", 1)]),
+])
+def test_coalescing(results, sent):
+    assert dispatch(results)[0] == sent
+
+
+def test_coalescing_stats():
+    _, items, stats = dispatch([result(1, "AC", "TEMP_SET_26"), result(2, "AC", "TEMP_SET_24"),
+                                result(3, "AC", "TEMP_UP"), result(4, "AC", "AC_ON")])
+    # 被合并进已有条目时返回那一条
+    assert [(item.action, item.status) for item in items] == [
+        ("TEMP_SET_26", "superseded"), ("TEMP_SET_25", "acked"), ("TEMP_SET_25", "acked"), ("AC_ON", "acked")]
+    assert items[1] is items[2]
+    assert (stats["enqueued"], stats["superseded"], stats["coalesced"], stats["acked"]) == (4, 1, 1, 3)
+
+
+@pytest.mark.parametrize("vehicle_id, action", [(None, "AC_ON"), ("v1", "NOOP"), ("v1", "UNKNOWN"), ("v1", "")])
+def test_skipped(vehicle_id, action):
+    dispatcher = Dispatcher(GatedSink(), workers=1)
+    assert dispatcher.submit(vehicle_id, result(1, "AC", action)) is None
@@ -0,0 +1,70 @@
+# 容错 JSON 提取与流式数组解析
+import pytest
+
+from agents.jsonparse import JSONArrayStream, extract_json
+
+
+@pytest.mark.parametrize("text, expected, repairs", [
+    ('{"intent": "打开空调", "params": {}}', {"intent": "打开空调", "params": {}}, []),
+    ('```json\n{"intent": "打开空调"}\n```', {"intent": "打开空调"}, []),
+    ('好的，结果如下：[{"module": "AC"}]，请确认', [{"module": "AC"}], []),
+    ('{"a": 1, "b": [1, 2,],}', {"a": 1, "b": [1, 2]}, ["trailing_comma"]),
+    ('{"intent": "设置温度", "params": {"temperature": 26', {"intent": "设置温度", "params": {"temperature": 26}},
+     ["truncated"]),
+    ('[{"module": "AC", "text": "打开空', [{"module": "AC", "text": "打开空"}], ["truncated"]),
+    ("{'intent': '打开空调', 'ok': True, 'x': None}", {"intent": "打开空调", "ok": True, "x": None},
+     ["python_literal", "quotes"]),
+    ('{“intent”: “打开空调”}', {"intent": "打开空调"}, ["quotes"]),
+    ('{"intent"：打开空调，"ok"：true}', {"intent": "打开空调", "ok": True}, ["bare_word", "fullwidth"]),
+])
+def test_extract_json(text, expected, repairs):
+    assert extract_json(text) == (expected, repairs)
+
+
+@pytest.mark.parametrize("text", ["", "没有 JSON", "抱歉，我无法理解"])
+def test_extract_json_without_json(text):
+    with pytest.raises(ValueError):
+        extract_json(text)
+
+
+@pytest.mark.parametrize("text, accept, expected", [
+    # 闲聊里的 [1] 不满足结构校验，跳过
+    ('第 [1] 条：{"intent": "打开空调"}', lambda d: isinstance(d, dict), {"intent": "打开空调"}),
+    ('[1] 然后 [{"module": "AC"}]', lambda d: isinstance(d, list) and all(isinstance(x, dict) for x in d),
+     [{"module": "AC"}]),
+    # 需要修复的候选也参与校验（内层完整的 {} 不满足校验，取修复后的外层）
+    ('[1] {"intent": "打开空调",}', lambda d: isinstance(d, dict), {"intent": "打开空调"}),
+    ('{"intent"：打开空调，"params"：{}}', lambda d: "intent" in d, {"intent": "打开空调", "params": {}}),
+    # 都不满足时返回第一个能解析的，由调用方按校验失败处理
+    ('[1] [2]', lambda d: isinstance(d, dict), [1]),
+])
+def test_extract_json_schema_mismatch(text, accept, expected):
+    assert extract_json(text, accept)[0] == expected
+
+
+@pytest.mark.parametrize("chunks, streamed, closed", [
+    (['[{"module": "AC", "text": "打开', '空调"}, {"module": ', '"MEDIA", "text": "播放音乐"}]'],
+     [{"module": "AC", "text": "打开空调"}, {"module": "MEDIA", "text": "播放音乐"}], []),
+    # 根节点是对象时整个对象作为唯一元素
+    (['{"module": "NAV",', ' "text": "导航回家"}'], [{"module": "NAV", "text": "导航回家"}], []),
+    # 字符串里的括号不影响分段
+    (['[{"text": "a]b}"}', ', {"text": "c"}]'], [{"text": "a]b}"}, {"text": "c"}], []),
+    # 截断的最后一个元素在 close 时修复
+    (['```json\n[{"module": "AC"}, {"module": "SE'], [{"module": "AC"}], [{"module": "SE"}]),
+    (['[{"module": "AC",}]'], [{"module": "AC"}], []),
+])
+def test_array_stream(chunks, streamed, closed):
+    stream = JSONArrayStream()
+    items = []
+    for chunk in chunks:
+        items.extend(stream.feed(chunk))
+    assert items == streamed
+    assert stream.close() == closed
+
+
+def test_array_stream_char_by_char():
+    text = '[{"module": "AC", "text": "打开空调"}, {"module": "MEDIA", "text": "播放音乐"}] 以上'
+    stream = JSONArrayStream()
+    items = [item for ch in text for item in stream.feed(ch)]
+    assert [item["module"] for item in items] == ["AC", "MEDIA"]
+    assert stream.done
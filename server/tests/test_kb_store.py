@@ -0,0 +1,71 @@
+# 知识库二进制格式（CKB1）编解码与内容寻址存储
+import json
+import os
+
+import pytest
+
+from kb_store import HEADER, KBStore, content_hash, decode, encode, read_header
+
+DEFAULT_KB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                          "data", "knowledge_base.default.json")
+
+
+def intent(domain, intent, query="", **extra):
+    return dict({"domain": domain, "ability": "", "feature": "", "intent": intent, "query": query}, **extra)
+
+
+@pytest.mark.parametrize("kb", [
+    {"rules": [], "intents": []},
+    {"rules": ["1. 只输出 JSON"], "intents": [intent("AC", "打开空调", "打开空调")]},
+    # 重复字符串只存一份，解码后各处仍是原值
+    {"rules": ["规则", "规则"], "intents": [intent("AC", "打开空调", "打开空调"), intent("AC", "关闭空调", "打开空调")]},
+    # 其余字段以 JSON 保存
+    {"rules": [], "intents": [intent("NAV", "导航", "导航去【位置】", params=["destination"], weight=2)]},
+    {"rules": ["emoji 🚗 与换行\n第二行", ""], "intents": [intent("MEDIA", "播放", "播放 \"周杰伦\" 的歌")]},
+])
+def test_round_trip(kb):
+    data, version = encode(kb)
+    assert decode(data) == kb
+    assert version == content_hash(kb)
+    header = read_header(data)
+    assert (header["rules"], header["intents"], header["version"]) == (len(kb["rules"]), len(kb["intents"]), version)
+
+
+def test_round_trip_default_kb():
+    with open(DEFAULT_KB, "r", encoding="utf-8") as f:
+        kb = json.load(f)
+    data, _ = encode(kb)
+    assert decode(data) == {"rules": kb.get("rules", []), "intents": kb.get("intents", [])}
+    assert len(data) < len(json.dumps(kb, ensure_ascii=False).encode("utf-8"))
+
+
+def test_missing_fields_decode_as_empty():
+    kb = {"rules": [], "intents": [{"domain": "AC", "intent": "打开空调", "query": None}]}
+    assert decode(encode(kb)[0])["intents"] == [intent("AC", "打开空调")]
+
+
+def test_version_ignores_other_keys():
+    kb = {"rules": ["r"], "intents": [intent("AC", "打开空调")]}
+    assert encode(dict(kb, name="另一个文件"))[1] == encode(kb)[1]
+    assert encode(dict(kb, rules=["r2"]))[1] != encode(kb)[1]
+
+
+@pytest.mark.parametrize("data", [b"JSON" + bytes(HEADER.size), b"CKB1" + b"\x02\x00" + bytes(HEADER.size)])
+def test_rejects_other_formats(data):
+    with pytest.raises(ValueError):
+        read_header(data)
+
+
+def test_store_put_load_activate(tmp_path):
+    store = KBStore(str(tmp_path))
+    kb = {"rules": ["r"], "intents": [intent("AC", "打开空调", "打开空调")]}
+    name, duplicate = store.put(kb, "catalogue")
+    assert (name, duplicate) == ("catalogue", False)
+    # 同样的内容不再写对象，返回已有名称
+    assert store.put(dict(kb), "again") == ("catalogue", True)
+    version = store.activate("catalogue")
+    assert store.active() == {"name": "catalogue", "version": version}
+    assert store.load(version) == kb
+    assert KBStore(str(tmp_path)).load(version) == kb
+    assert store.delete("catalogue") == version
+    assert not os.path.exists(store.object_path(version))
@@ -0,0 +1,116 @@
+# 车辆状态：已满足的指令、相对调节换算、同句冲突指令合并
+import pytest
+
+from vehicle_state import NOOP_ACTION, VehicleState, merge_commands
+
+
+@pytest.mark.parametrize("values, module, intent, params, expected", [
+    # 状态未知或意图不影响已建模状态时交给执行器
+    ({}, "AC", "打开空调", {}, None),
+    ({"ac": "on"}, "NAV", "导航回家", {}, None),
+    ({"ac": "on"}, "AC", "不存在的意图", {}, None),
+    ({"ac": "off"}, "AC", "打开空调", {}, None),
+    ({"temperature": 26}, "AC", "设置温度", {"temperature": "27度"}, None),
+    ({"temperature": 26}, "AC", "设置温度", {}, None),
+    # 已满足
+    ({"ac": "on"}, "AC", "打开空调", {}, {"action": NOOP_ACTION, "reply": "空调已经打开了"}),
+    ({"media": "paused"}, "MEDIA", "暂停播放", {}, {"action": NOOP_ACTION, "reply": "音乐已经暂停了"}),
+    ({"temperature": 26}, "AC", "设置温度", {"temperature": "26度"}, {"action": NOOP_ACTION, "reply": "温度已经是26度了"}),
+    # 超出范围的设定值先夹到边界再比较
+    ({"temperature": 32}, "AC", "设置温度", {"temperature": 40}, {"action": NOOP_ACTION, "reply": "温度已经是32度了"}),
+    # 带位置的键：没有该位置的值时用 "全部" 的值，未给位置时用默认位置
+    ({"window:全部": "open"}, "WINDOW", "打开车窗", {"position": "主驾"},
+     {"action": NOOP_ACTION, "reply": "主驾车窗已经打开了"}),
+    ({"window:全部": "open", "window:主驾": "closed"}, "WINDOW", "打开车窗", {"position": "主驾"}, None),
+    ({"window:全部": "closed"}, "WINDOW", "关闭车窗", {}, {"action": NOOP_ACTION, "reply": "车窗已经关闭了"}),
+    ({"seat_heat:主驾": "on"}, "SEAT", "打开座椅加热", {}, {"action": NOOP_ACTION, "reply": "主驾座椅加热已经打开了"}),
+    ({"seat_heat:主驾": "on"}, "SEAT", "打开座椅加热", {"position": "副驾"}, None),
+    # 带了其他参数（氛围灯颜色）的不算重复
+    ({"ambient": "on"}, "LIGHT", "打开氛围灯", {}, {"action": NOOP_ACTION, "reply": "氛围灯已经打开了"}),
+    ({"ambient": "on"}, "LIGHT", "打开氛围灯", {"color": "红色"}, None),
+    ({"ambient": "on"}, "LIGHT", "打开氛围灯", {"color": ""}, {"action": NOOP_ACTION, "reply": "氛围灯已经打开了"}),
+])
+def test_plan(values, module, intent, params, expected):
+    state = VehicleState(values)
+    assert state.plan(module, intent, params) == expected
+    assert state.values == values  # 非相对调节不改状态
+
+
+@pytest.mark.parametrize("values, module, intent, expected, after", [
+    ({"temperature": 26}, "AC", "升温", {"action": "TEMP_SET_27", "reply": "温度已调到27度"}, 27),
+    ({"temperature": 26}, "AC", "降温", {"action": "TEMP_SET_25", "reply": "温度已调到25度"}, 25),
+    ({"fan": 3}, "AC", "调高风量", {"action": "FAN_SET_4", "reply": "风量已调到4档"}, 4),
+    ({"volume": 95}, "MEDIA", "调高音量", {"action": "VOL_SET_100", "reply": "音量已调到100"}, 100),
+    # 已在边界
+    ({"temperature": 32}, "AC", "升温", {"action": NOOP_ACTION, "reply": "温度已经是最高了"}, 32),
+    ({"fan": 1}, "AC", "调低风量", {"action": NOOP_ACTION, "reply": "风量已经是最低了"}, 1),
+    ({"volume": 0}, "MEDIA", "调低音量", {"action": NOOP_ACTION, "reply": "音量已经是最低了"}, 0),
+])
+def test_plan_delta(values, module, intent, expected, after):
+    state = VehicleState(values)
+    assert state.plan(module, intent, {}) == expected
+    key = next(iter(values))
+    assert state.values[key] == after  # 相对调节在 plan 里就记入状态
+
+
+def test_plan_delta_unknown():
+    state = VehicleState({})
+    assert state.plan("AC", "升温", {}) is None
+    assert state.values == {}
+
+
+def test_plan_delta_shared_adjust():
+    calls = []
+
+    def adjust(key, delta, low, high):
+        calls.append((key, delta, low, high))
+        return [28, 29]  # 共享存储里的值已被别的 worker 改过
+
+    state = VehicleState({"temperature": 20}, adjust=adjust)
+    assert state.plan("AC", "升温", {}) == {"action": "TEMP_SET_29", "reply": "温度已调到29度"}
+    assert calls == [("temperature", 1, 16, 32)]
+    assert state.values["temperature"] == 29
+
+    state = VehicleState({"temperature": 20}, adjust=lambda *args: None)
+    assert state.plan("AC", "升温", {}) is None
+    assert "temperature" not in state.values
+
+
+def test_apply():
+    persisted = []
+    state = VehicleState({"window:主驾": "open", "window:副驾": "open"},
+                         persist=lambda updates, removed: persisted.append((updates, sorted(removed))))
+    state.apply("WINDOW_CLOSE", {"position": "全部"})
+    assert state.snapshot() == {"window:全部": "closed"}
+    assert persisted == [({"window:全部": "closed"}, ["window:主驾", "window:副驾"])]
+
+    state.apply("TEMP_SET_40", {})
+    state.apply("NAV_HOME", {})
+    assert state.snapshot() == {"window:全部": "closed", "temperature": 32}
+
+
+def command(index, module, text):
+    return {"index": index, "module": module, "text": text}
+
+
+@pytest.mark.parametrize("commands, parsed, kept", [
+    # 同一状态键只保留最后一条
+    ([command(0, "AC", "打开空调"), command(1, "AC", "关掉空调")],
+     {0: {"intent": "打开空调"}, 1: {"intent": "关闭空调"}}, [1]),
+    # 相对调节可以叠加
+    ([command(0, "AC", "升温"), command(1, "AC", "升温")],
+     {0: {"intent": "升温"}, 1: {"intent": "升温"}}, [0, 1]),
+    # 没解析出的按文本判重，忽略空白和标点
+    ([command(0, "NAV", "导航回家"), command(1, "NAV", "导航 回家！")], {}, [1]),
+    ([command(0, "NAV", "导航回家"), command(1, "MEDIA", "导航回家")], {}, [0, 1]),
+    # 不同位置是不同的键
+    ([command(0, "WINDOW", "打开主驾车窗"), command(1, "WINDOW", "关闭副驾车窗")],
+     {0: {"intent": "打开车窗", "params": {"position": "主驾"}},
+      1: {"intent": "关闭车窗", "params": {"position": "副驾"}}}, [0, 1]),
+    ([command(0, "AC", "打开空调"), command(1, "MEDIA", "播放音乐"), command(2, "AC", "关闭空调")],
+     {0: {"intent": "打开空调"}, 2: {"intent": "关闭空调"}}, [1, 2]),
+])
+def test_merge_commands(commands, parsed, kept):
+    result, dropped = merge_commands(commands, parsed)
+    assert [c["index"] for c in result] == kept
+    assert [c["index"] for c in dropped] == [c["index"] for c in commands if c["index"] not in kept]
@@ -0,0 +1,256 @@
+# 单请求 span 树：request → split → parse/execute → summarize → log_write
+import json
+import os
+import queue
+import secrets
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Any, Dict, List, Optional
+
+# OTLP/HTTP 采集地址（如 http://localhost:4318）或本地 JSONL 文件，均可选
+OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT", "")
+TRACE_EXPORT_FILE = os.getenv("TRACE_EXPORT_FILE", "")
+SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "car-bot")
+TRACE_EXPORT_QUEUE = int(os.getenv("TRACE_EXPORT_QUEUE", "1000"))  # 待导出的 trace 超过这个数时丢弃新的
+
+class Span:
+    __slots__ = ("span_id", "parent_id", "name", "start_ns", "end_ns", "attrs", "status")
+
+    def __init__(self, name: str, parent_id: Optional[str], attrs: Dict[str, Any]):
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attrs = attrs
+        self.status = "ok"
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+class Trace:
+    def __init__(self, name: str, **attrs):
+        self.trace_id = secrets.token_hex(16)
+        self._lock = threading.Lock()
+        self.spans: List[Span] = []
+        self.root = self._add(name, None, attrs)
+
+    def _add(self, name: str, parent_id: Optional[str], attrs: Dict[str, Any]) -> Span:
+        span = Span(name, parent_id, attrs)
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    def record(self, name: str, start_ns: int, end_ns: int, **attrs) -> Span:
+        """补记一个已结束的 span，挂在根 span 下"""
+        span = self._add(name, self.root.span_id, attrs)
+        span.start_ns = start_ns
+        span.end_ns = end_ns
+        return span
+
+    def finish(self):
+        if self.root.end_ns is None:
+            self.root.end_ns = time.time_ns()
+
+    def to_compact(self) -> Dict[str, Any]:
+        """存库用的紧凑格式: [name, parent 下标, 起始偏移ms, 耗时ms, attrs, status]"""
+        with self._lock:
+            spans = list(self.spans)
+        index = {span.span_id: i for i, span in enumerate(spans)}
+        base = self.root.start_ns
+        rows = []
+        for span in spans:
+            end = span.end_ns or time.time_ns()
+            rows.append([
+                span.name,
+                index.get(span.parent_id, -1),
+                round((span.start_ns - base) / 1e6, 2),
+                round((end - span.start_ns) / 1e6, 2),
+                span.attrs,
+                span.status
+            ])
+        return {"trace_id": self.trace_id, "start_ns": base, "spans": rows}
+
+    def to_tree(self) -> Dict[str, Any]:
+        return compact_to_tree(self.to_compact())
+
+    def to_otlp(self) -> Dict[str, Any]:
+        """OTLP/HTTP JSON (ExportTraceServiceRequest)"""
+        with self._lock:
+            spans = list(self.spans)
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": [_otlp_attr("service.name", SERVICE_NAME)]},
+                "scopeSpans": [{
+                    "scope": {"name": "car_bot.tracing"},
+                    "spans": [{
+                        "traceId": self.trace_id,
+                        "spanId": span.span_id,
+                        "parentSpanId": span.parent_id or "",
+                        "name": span.name,
+                        "kind": 1,
+                        "startTimeUnixNano": str(span.start_ns),
+                        "endTimeUnixNano": str(span.end_ns or span.start_ns),
+                        "attributes": [_otlp_attr(k, v) for k, v in span.attrs.items()],
+                        "status": {"code": 2 if span.status == "error" else 1}
+                    } for span in spans]
+                }]
+            }]
+        }
+
+def _otlp_attr(key: str, value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    if not isinstance(value, str):
+        value = json.dumps(value, ensure_ascii=False)
+    return {"key": key, "value": {"stringValue": value}}
+
+def compact_to_tree(compact: Dict[str, Any]) -> Dict[str, Any]:
+    """把紧凑格式还原成嵌套的 span 树，供前端画瀑布图"""
+    nodes = []
+    for name, parent, start_ms, duration_ms, attrs, status in compact["spans"]:
+        nodes.append({
+            "name": name,
+            "start_ms": start_ms,
+            "duration_ms": duration_ms,
+            "attrs": attrs,
+            "status": status,
+            "children": [],
+            "_parent": parent
+        })
+    root = None
+    for node in nodes:
+        parent = node.pop("_parent")
+        if parent < 0:
+            root = node
+        else:
+            nodes[parent]["children"].append(node)
+    for node in nodes:
+        node["children"].sort(key=lambda n: n["start_ms"])
+    return {"trace_id": compact["trace_id"], "root": root}
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+def start_trace(name: str, **attrs) -> Trace:
+    trace = Trace(name, **attrs)
+    _current_trace.set(trace)
+    _current_span.set(trace.root)
+    return trace
+
+# span 路径（如 process/parse/llm）随上下文传到线程池；另按线程记一份给采样分析器标注样本（contextvar 从别的线程读不到）
+_span_path: ContextVar[str] = ContextVar("span_path", default="")
+_thread_spans: Dict[int, str] = {}
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+def thread_spans() -> Dict[int, str]:
+    return dict(_thread_spans)
+
+@contextmanager
+def span(name: str, **attrs):
+    """在当前 trace 下开一个子 span；没有活动 trace 时几乎无开销"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+    parent = _current_span.get()
+    s = trace._add(name, parent.span_id if parent else None, attrs)
+    token = _current_span.set(s)
+    outer_path = _span_path.get()
+    path = f"{outer_path}/{name}" if outer_path else name
+    path_token = _span_path.set(path)
+    ident = threading.get_ident()
+    outer = _thread_spans.get(ident)
+    _thread_spans[ident] = path
+    try:
+        yield s
+    except BaseException as e:
+        s.status = "error"
+        s.attrs["error"] = str(e)
+        raise
+    finally:
+        s.end_ns = time.time_ns()
+        _current_span.reset(token)
+        _span_path.reset(path_token)
+        if outer is None:
+            _thread_spans.pop(ident, None)
+        else:
+            _thread_spans[ident] = outer
+
+def traced(name: str):
+    """把函数调用包成一个 span"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def annotate(**attrs):
+    """给当前 span 添加属性"""
+    s = _current_span.get()
+    if s is not None:
+        s.attrs.update(attrs)
+
+_export_queue: "queue.Queue[Trace]" = queue.Queue(maxsize=TRACE_EXPORT_QUEUE)
+_export_lock = threading.Lock()
+_exporter: Optional[threading.Thread] = None
+export_stats = {"exported": 0, "failed": 0, "dropped": 0}
+
+def export(trace: Trace):
+    """导出到 OTLP 采集器和/或本地文件：交给唯一的后台导出线程，不阻塞请求；积压满了丢弃并计数"""
+    global _exporter
+    if not OTLP_ENDPOINT and not TRACE_EXPORT_FILE:
+        return
+    with _export_lock:
+        if _exporter is None:
+            _exporter = threading.Thread(target=_export_loop, name="trace-export", daemon=True)
+            _exporter.start()
+    try:
+        _export_queue.put_nowait(trace)
+    except queue.Full:
+        with _export_lock:
+            export_stats["dropped"] += 1
+
+def get_export_stats() -> Dict[str, int]:
+    with _export_lock:
+        return {**export_stats, "pending": _export_queue.qsize()}
+
+def _export_loop():
+    while True:
+        trace = _export_queue.get()
+        try:
+            _export(trace.to_otlp())
+            outcome = "exported"
+        except Exception:
+            outcome = "failed"
+        with _export_lock:
+            export_stats[outcome] += 1
+
+def _export(payload: Dict[str, Any]):
+    body = json.dumps(payload, ensure_ascii=False)
+    if TRACE_EXPORT_FILE:
+        with open(TRACE_EXPORT_FILE, "a", encoding="utf-8") as f:
+            f.write(body + "\n")
+    if OTLP_ENDPOINT:
+        req = urllib.request.Request(
+            OTLP_ENDPOINT.rstrip("/") + "/v1/traces",
+            data=body.encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="POST"
+        )
+        try:
+            urllib.request.urlopen(req, timeout=2).close()
+        except Exception:
+            pass
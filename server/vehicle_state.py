@@ -0,0 +1,268 @@
+# 车辆状态：由下发的动作码更新，用于识别已满足的指令、把相对调节解析成绝对值、合并同句内的冲突指令
+import os
+import re
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from agents.modules import MODULE_INTENTS
+from shared_store import store
+
+VEHICLE_STATE = os.getenv("VEHICLE_STATE", "1") == "1"
+# 状态只来自本服务下发的动作，用户在车上手动操作时会过时；超过这么久没有更新（或车辆上报）的状态不再可信
+VEHICLE_STATE_TTL_S = float(os.getenv("VEHICLE_STATE_TTL_S", "300"))
+VEHICLE_STATE_MAX = int(os.getenv("VEHICLE_STATE_MAX", "10000"))
+
+# 动作码 -> (状态键, 类型, 值)
+#   set:   置为固定值
+#   param: 置为参数（值为参数名）或动作码数值后缀，如 TEMP_SET_26
+#   delta: 在当前值上增减
+EFFECTS: Dict[str, Tuple[str, str, Any]] = {
+    "AC_ON": ("ac", "set", "on"), "AC_OFF": ("ac", "set", "off"),
+    "TEMP_SET": ("temperature", "param", "temperature"),
+    "TEMP_UP": ("temperature", "delta", 1), "TEMP_DOWN": ("temperature", "delta", -1),
+    "TEMP_MIN": ("temperature", "set", 16), "TEMP_MAX": ("temperature", "set", 32),
+    "FAN_SET": ("fan", "param", "level"),
+    "FAN_UP": ("fan", "delta", 1), "FAN_DOWN": ("fan", "delta", -1),
+    "FAN_ON": ("fan_power", "set", "on"), "FAN_OFF": ("fan_power", "set", "off"),
+    "AC_COOL": ("cooling", "set", "on"), "AC_COOL_OFF": ("cooling", "set", "off"),
+    "AC_HEAT": ("heating", "set", "on"), "AC_HEAT_OFF": ("heating", "set", "off"),
+    "DEFROST_ON": ("defrost", "set", "on"), "DEFROST_OFF": ("defrost", "set", "off"),
+    "DEFROST_FRONT_ON": ("defrost_front", "set", "on"), "DEFROST_FRONT_OFF": ("defrost_front", "set", "off"),
+    "DEFROST_REAR_ON": ("defrost_rear", "set", "on"), "DEFROST_REAR_OFF": ("defrost_rear", "set", "off"),
+    "DEFROST_MAX_ON": ("defrost_max", "set", "on"), "DEFROST_MAX_OFF": ("defrost_max", "set", "off"),
+    "DEMIST_ON": ("demist", "set", "on"), "DEMIST_OFF": ("demist", "set", "off"),
+    "AC_INNER": ("circulation", "set", "inner"), "AC_INNER_OFF": ("circulation", "set", "outer"),
+    "AC_OUTER": ("circulation", "set", "outer"), "AC_OUTER_OFF": ("circulation", "set", "inner"),
+    "AC_AUTO": ("ac_auto", "set", "on"), "AC_AUTO_OFF": ("ac_auto", "set", "off"),
+    "AC_ZONE_ON": ("ac_zone", "set", "on"), "AC_ZONE_OFF": ("ac_zone", "set", "off"),
+    "MEDIA_PLAY": ("media", "set", "playing"), "MEDIA_PAUSE": ("media", "set", "paused"),
+    "VOL_SET": ("volume", "param", "volume"),
+    "VOL_UP": ("volume", "delta", 10), "VOL_DOWN": ("volume", "delta", -10),
+    "RADIO_ON": ("radio", "set", "on"), "RADIO_OFF": ("radio", "set", "off"),
+    "WINDOW_OPEN": ("window:{position}", "set", "open"), "WINDOW_CLOSE": ("window:{position}", "set", "closed"),
+    "WINDOW_HALF": ("window:{position}", "set", "half"),
+    "WINDOW_LOCK": ("window_lock", "set", "locked"), "WINDOW_UNLOCK": ("window_lock", "set", "unlocked"),
+    "SUNROOF_OPEN": ("sunroof", "set", "open"), "SUNROOF_CLOSE": ("sunroof", "set", "closed"),
+    "SUNROOF_HALF": ("sunroof", "set", "half"),
+    "SHADE_OPEN": ("shade:{position}", "set", "open"), "SHADE_CLOSE": ("shade:{position}", "set", "closed"),
+    "SEAT_HEAT_ON": ("seat_heat:{position}", "set", "on"), "SEAT_HEAT_OFF": ("seat_heat:{position}", "set", "off"),
+    "SEAT_VENT_ON": ("seat_vent:{position}", "set", "on"), "SEAT_VENT_OFF": ("seat_vent:{position}", "set", "off"),
+    "SEAT_MASSAGE_ON": ("seat_massage:{position}", "set", "on"),
+    "SEAT_MASSAGE_OFF": ("seat_massage:{position}", "set", "off"),
+    "WHEEL_HEAT_ON": ("wheel_heat", "set", "on"), "WHEEL_HEAT_OFF": ("wheel_heat", "set", "off"),
+    "LIGHT_ON": ("light", "set", "on"), "LIGHT_OFF": ("light", "set", "off"),
+    "LIGHT_LOW": ("low_beam", "set", "on"), "LIGHT_LOW_OFF": ("low_beam", "set", "off"),
+    "LIGHT_HIGH": ("high_beam", "set", "on"), "LIGHT_HIGH_OFF": ("high_beam", "set", "off"),
+    "FOG_LIGHT_ON": ("fog_light", "set", "on"), "FOG_LIGHT_OFF": ("fog_light", "set", "off"),
+    "AMBIENT_ON": ("ambient", "set", "on"), "AMBIENT_OFF": ("ambient", "set", "off"),
+}
+
+BOUNDS = {"temperature": (16, 32), "fan": (1, 7), "volume": (0, 100)}
+# 相对调节解析成绝对值后使用的动作码
+ABSOLUTE = {"temperature": "TEMP_SET", "fan": "FAN_SET", "volume": "VOL_SET"}
+UNITS = {"temperature": "度", "fan": "档", "volume": ""}
+DEFAULT_POSITION = {"window": "全部", "shade": "全部", "seat_heat": "主驾", "seat_vent": "主驾", "seat_massage": "主驾"}
+ALL_POSITIONS = "全部"
+
+NAMES = {
+    "ac": "空调", "temperature": "温度", "fan": "风量", "fan_power": "风扇", "cooling": "制冷", "heating": "制热",
+    "defrost": "除霜", "defrost_front": "前除霜", "defrost_rear": "后除霜", "defrost_max": "最大除霜",
+    "demist": "除雾", "circulation": "空调", "ac_auto": "自动空调", "ac_zone": "分区空调",
+    "media": "音乐", "volume": "音量", "radio": "电台",
+    "window": "车窗", "window_lock": "车窗", "sunroof": "天窗", "shade": "遮阳帘",
+    "seat_heat": "座椅加热", "seat_vent": "座椅通风", "seat_massage": "座椅按摩", "wheel_heat": "方向盘加热",
+    "light": "车灯", "low_beam": "近光灯", "high_beam": "远光灯", "fog_light": "雾灯", "ambient": "氛围灯",
+}
+STATE_WORDS = {
+    "on": "打开", "off": "关闭", "open": "打开", "closed": "关闭", "half": "开了一半",
+    "playing": "在播放", "paused": "暂停", "inner": "是内循环", "outer": "是外循环",
+    "locked": "锁定", "unlocked": "解锁",
+}
+
+NOOP_ACTION = "NOOP"
+
+def _number(value: Any) -> Optional[int]:
+    m = re.search(r"-?\d+", str(value)) if value is not None else None
+    return int(m.group()) if m else None
+
+def effect(action: str, params: Dict[str, Any]) -> Optional[Tuple[str, str, Any, Optional[str]]]:
+    """动作码 -> (状态键, set/delta, 值, 取值用到的参数名)，不影响已建模状态时返回 None"""
+    spec = EFFECTS.get(action)
+    suffix = None
+    if spec is None:
+        base, _, suffix = action.rpartition("_")
+        spec = EFFECTS.get(base)
+        if spec is None or spec[1] != "param":
+            return None
+    key, kind, value = spec
+    if "{position}" in key:
+        prefix = key.split(":")[0]
+        key = key.format(position=params.get("position") or DEFAULT_POSITION[prefix])
+    used = None
+    if kind == "param":
+        used = value
+        value = _number(suffix if suffix is not None else params.get(value))
+        if value is None:
+            return None
+        low, high = BOUNDS[key]
+        value, kind = min(high, max(low, value)), "set"
+    return key, kind, value, used
+
+def intent_effect(module: str, intent: str, params: Dict[str, Any]):
+    spec = MODULE_INTENTS.get(module, {}).get(intent)
+    return (spec, effect(spec["action"], params)) if spec else (None, None)
+
+def _label(key: str) -> str:
+    prefix, _, position = key.partition(":")
+    name = NAMES.get(prefix, prefix)
+    return name if not position or position == ALL_POSITIONS else position + name
+
+def _normalize(text: str) -> str:
+    return "".join(ch for ch in text if not ch.isspace() and ch not in "，。！？、,.!?")
+
+class VehicleState:
+    """单车状态快照，键如 ac / temperature / window:主驾，只记录由本服务下发过的动作"""
+    __slots__ = ("values", "_persist", "_adjust", "_lock")
+
+    def __init__(self, values: Optional[Dict[str, Any]] = None,
+                 persist: Optional[Callable[[Dict[str, Any], List[str]], None]] = None,
+                 adjust: Optional[Callable[[str, int, int, int], Optional[List[int]]]] = None):
+        self.values: Dict[str, Any] = dict(values or {})
+        self._persist = persist  # (更新的键, 删除的键) -> 写回共享存储
+        self._adjust = adjust  # (键, 增量, 下限, 上限) -> 在共享存储里原子增减，返回 [原值, 新值]
+        self._lock = threading.Lock()
+
+    def _get(self, key: str) -> Any:
+        if key in self.values:
+            return self.values[key]
+        prefix, _, position = key.partition(":")
+        return self.values.get(f"{prefix}:{ALL_POSITIONS}") if position else None
+
+    def _step(self, key: str, delta: int) -> Optional[Tuple[int, int]]:
+        """相对调节记入状态，返回 (原值, 新值)；有共享存储时以存储里的当前值为准，并发的调节不会互相覆盖"""
+        low, high = BOUNDS[key]
+        with self._lock:
+            if self._adjust is None:
+                current = self._get(key)
+                if current is None:
+                    return None
+                self.values[key] = min(high, max(low, current + delta))
+                return current, self.values[key]
+        result = self._adjust(key, delta, low, high)
+        with self._lock:
+            if result is None:
+                self.values.pop(key, None)  # 别的 worker 已作废或过期
+                return None
+            self.values[key] = result[1]
+        return result[0], result[1]
+
+    def plan(self, module: str, intent: str, params: Dict[str, Any]) -> Optional[Dict[str, str]]:
+        """状态已知时直接给出结果: 已满足的指令返回 NOOP，相对调节换算成绝对值；其余返回 None 交给执行器
+
+        相对调节在这里就原子地记入状态（返回的绝对动作码不需要再 apply）。
+        """
+        spec, eff = intent_effect(module, intent, params)
+        if eff is None:
+            return None
+        key, kind, value, used = eff
+        with self._lock:
+            current = self._get(key)
+        if current is None:
+            return None
+
+        label = _label(key)
+        if kind == "delta":
+            step = self._step(key, value)
+            if step is None:
+                return None
+            current, target = step
+            if target == current:
+                return {"action": NOOP_ACTION, "reply": f"{label}已经是最{'高' if value > 0 else '低'}了"}
+            return {"action": f"{ABSOLUTE[key]}_{target}", "reply": f"{label}已调到{target}{UNITS[key]}"}
+
+        # 带了其他参数（如氛围灯颜色）的指令不算重复
+        extra = [p for p in spec["params"] if p not in ("position", used) and params.get(p) not in (None, "")]
+        if current != value or extra:
+            return None
+        if key in BOUNDS:
+            return {"action": NOOP_ACTION, "reply": f"{label}已经是{value}{UNITS[key]}了"}
+        return {"action": NOOP_ACTION, "reply": f"{label}已经{STATE_WORDS.get(value, value)}了"}
+
+    def apply(self, action: str, params: Dict[str, Any]):
+        """按实际下发的动作码更新状态"""
+        eff = effect(action, params)
+        if eff is None:
+            return
+        key, kind, value, _ = eff
+        if kind == "delta":
+            self._step(key, value)
+            return
+        with self._lock:
+            prefix, _, position = key.partition(":")
+            removed = []
+            if position == ALL_POSITIONS:
+                removed = [k for k in self.values if k.startswith(prefix + ":")]
+                for other in removed:
+                    del self.values[other]
+            self.values[key] = value
+        if self._persist is not None:
+            self._persist({key: value}, removed)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self.values)
+
+def merge_commands(commands: List[Dict[str, Any]],
+                   parsed: Dict[int, Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """同一句话里重复或冲突的指令只保留最后一条，如 "打开空调…算了关掉空调" 只执行关闭
+
+    parsed 为模型已解析出的意图（推测解析），没解析出的指令只按文本判重；
+    相对调节（升温、调高音量）可以叠加，不参与合并。返回 (保留的指令, 被合并掉的指令)。
+    """
+    keys: List[Any] = []
+    for cmd in commands:
+        result = parsed.get(cmd["index"])
+        eff = None
+        if result:
+            _, eff = intent_effect(cmd["module"], result.get("intent", ""), result.get("params") or {})
+        if eff is None:
+            keys.append(("text", cmd["module"], _normalize(cmd["text"])))
+        elif eff[1] == "delta":
+            keys.append(None)
+        else:
+            keys.append(("state", eff[0]))
+    last = {key: i for i, key in enumerate(keys) if key is not None}
+    kept, dropped = [], []
+    for i, (cmd, key) in enumerate(zip(commands, keys)):
+        (kept if key is None or last[key] == i else dropped).append(cmd)
+    return kept, dropped
+
+class VehicleStateStore:
+    """各车状态放在共享存储里（见 shared_store），多 worker 共用；按最近使用淘汰，长时间没有更新的状态清空重来"""
+
+    def __init__(self, max_vehicles: int = VEHICLE_STATE_MAX, ttl_s: float = VEHICLE_STATE_TTL_S):
+        self.max_vehicles = max_vehicles
+        self.ttl_s = ttl_s
+
+    def get(self, vehicle_id: Optional[str]) -> Optional[VehicleState]:
+        """读出当前快照；之后 apply 的变化逐键写回，不同请求改不同的键时互不覆盖"""
+        if not vehicle_id or not VEHICLE_STATE:
+            return None
+        return VehicleState(store.get("vehicle", vehicle_id),
+                            lambda updates, removed: store.merge("vehicle", vehicle_id, updates, removed,
+                                                                 self.ttl_s, self.max_vehicles),
+                            lambda key, delta, low, high: store.adjust("vehicle", vehicle_id, key, delta, low, high,
+                                                                       self.ttl_s, self.max_vehicles))
+
+    def report(self, vehicle_id: str, values: Dict[str, Any]) -> Dict[str, Any]:
+        """车辆上报的实际状态整体替换服务端推算的状态；未建模的键丢弃，返回保存的状态"""
+        values = {k: v for k, v in values.items() if k.partition(":")[0] in NAMES}
+        store.set("vehicle", vehicle_id, values, self.ttl_s, self.max_vehicles)
+        return values
+
+    def invalidate(self, vehicle_id: str, keys: List[str]):
+        """动作最终没有下发成功时清掉对应的键（apply 在下发前已按成功记下），下次按未知状态处理"""
+        if vehicle_id and keys:
+            store.merge("vehicle", vehicle_id, {}, keys, self.ttl_s, self.max_vehicles)
+
+vehicle_states = VehicleStateStore()